@@ -25,31 +25,33 @@
 Create the ArcticNet 15' x 30' basemap tiles based on a given MB-System datalist
 """
 
-import math as m
 import argparse
 from sys import exit, argv
-from os import path
+from os import path, remove
 import subprocess
-import numpy as np
+from multiprocessing.pool import ThreadPool
 import geospatial as geo
 import basetile_bathy as btbathy
 import basetile_amp as btamp
 import basetile_ss as btss
+import tile_timing
+import tile_job
+import tile_plan
+import tile_queue
+import tile_pipeline
+import tile_catalog
+import scratch
 
-    
-def round_bounds(x, base=0.5, direction='up'):
-    """Round a floating point value up or down according to base
 
-    Keyword arguments:
-    x -- number to round
-    base -- base to which to round. Default 0.5.
-    direction -- round up or down depending on value. Default up.
-    """
-    if direction == 'up':
-        return base * m.ceil(float(x) / base)
-    elif direction == 'down':
-        return base * m.floor(float(x) / base)
-    
+
+LON_STEP = 0.5
+LAT_STEP = 0.25
+TILE_DATALIST_SUFFIX = '_datalist.mb-1'
+
+# Concurrent tiles of the pipeline stages following the gridding. The map scripts set the GMT defaults of
+# the working directory and must be run one at a time.
+PIPELINE_WORKERS = {'make_esri_grid': 1, 'make_chunked_grid': 1, 'ps_plot': 1, 'make_gif_plot': 1, 'make_quicklook': 2}
+
 
 
 def proj_limits(region, path_tilename):
@@ -98,47 +100,16 @@ def proj_limits(region, path_tilename):
     
     
     
-def main():
-    LON_STEP = 0.5
-    LAT_STEP = 0.25
-    
-    parser = argparse.ArgumentParser(description= \
-                                     "Create the ArcticNet 15' x 30' basemap tiles based on a given MB-System datalist, region and spatial resolution")
-    parser.add_argument('datalist', type=str, help='MB-System datalist')
-    parser.add_argument('datatype', type=int, default='2', help='MB-System datatype (bathymetry = 1; amplitude = 2; sidescan = 3')
-    parser.add_argument('gridkind', type=int, default='1', help='MB-System gridkind (netCDF = 1; ESRI Grid = 2')
-    parser.add_argument('mapkind',  type=int, default='1', help='MB-System mapkind (Postscript = 1; gif = 2')
-    parser.add_argument('region',   type=str, help='region in west/east/south/north format')
-    parser.add_argument('cellsize', type=float, help='cellsize')
-    parser.add_argument('psviewer', type=str, help='Name of the ps viewer')
-    parser.add_argument('disp_ps',  type=str, help='Flag to display Postscript files as they are being generated')
-    parser.add_argument('-D', '--outdir', help='output directory in which to store the products')
-    parser.add_argument('-l', '--logo', default='logos.sun', help='logo to display in legend. Default: logos.sun')
-    args = parser.parse_args()
-   
-    # Check that mb-system is installed
-    try:
-        subprocess.check_call(['which', 'mbinfo'])
-    except subprocess.CalledProcessError:
-        print 'Could not call mbinfo! Please make sure MB-Sysem is properly installed.'
-        exit()
+def subdatalist_name(region):
+    """Name of the sub-datalist of a region
 
-    # Split the region boundaries    
-    (xmin_true, xmax_true, ymin_true, ymax_true) = args.region.split('/')
-    
-    # Compute the bounds for the ArcticNet basemap tiles
-    xmin_tile = round_bounds(xmin_true, LON_STEP, 'down')
-    xmax_tile = round_bounds(xmax_true, LON_STEP, 'up')
-    ymin_tile = round_bounds(ymin_true, LAT_STEP, 'down')
-    ymax_tile = round_bounds(ymax_true, LAT_STEP, 'up')
-    
-    # Create the loop lists
-    xsteps = (xmax_tile - xmin_tile) / LON_STEP
-    ysteps = (ymax_tile - ymin_tile) / LAT_STEP
-    lon = np.linspace(xmin_tile, xmax_tile, num=xsteps, endpoint=False)
-    lat = np.linspace(ymax_tile, ymin_tile, num=ysteps, endpoint=False)
+    Keyword arguments:
+    region -- region in west/east/south/north format
 
-    # Create a new sub-datalist with filename composed with region extent
+    Returns:
+    subdatalist -- filename composed with the region extent
+    """
+    (xmin_true, xmax_true, ymin_true, ymax_true) = region.split('/')
     xmind, xminm, xmins, xminh = geo.decdeg2dms_hem(float(xmin_true), 'lon')
     xmaxd, xmaxm, xmaxs, xmaxh = geo.decdeg2dms_hem(float(xmax_true), 'lon')
     ymind, yminm, ymins, yminh = geo.decdeg2dms_hem(float(ymin_true), 'lat')
@@ -150,9 +121,27 @@ def main():
                   str(ymind) + 'd' + str(yminm) + 'm' + yminh + '_to_' + \
                   str(ymaxd) + 'd' + str(ymaxm) + 'm' + ymaxh + '.mb-1'
 
+    return subdatalist
+
+
+
+def make_subdatalist(datalist, region, choice=None):
+    """Create the sub-datalist of the swath files within a region
+
+    Keyword arguments:
+    datalist -- MB-System datalist
+    region -- region in west/east/south/north format
+    choice -- 'e' to use an existing sub-datalist, 'c' to create a new one. Default: ask the user when the sub-datalist exists.
+
+    Returns:
+    subdatalist -- filename of the sub-datalist
+    """
+    subdatalist = subdatalist_name(region)
+
     # Check if a datalist for the specified region already exists. If it does, let the user decide whether to use this datalist ('e') or recreate a new one ('c')
-    choice = 'c'     # Force the creation of the datalist. Only changed if the file exists and the user wishes to use the existing datalist.
-    if path.isfile(subdatalist):
+    if not path.isfile(subdatalist):
+        choice = 'c'     # Force the creation of the datalist.
+    elif choice is None:
         print "\nThe datalist %s already exists! Would you like to use the existing datalist or create a new one?\n" % (subdatalist)
         choices = set(['e', 'c'])
         choice = raw_input('Enter your choice: use existing (\'e\') or create a new datalist (\'c\')?: ')
@@ -162,89 +151,627 @@ def main():
     if (choice == 'c'):
         try:
             subprocess.check_call(['which', 'mbdatalist'])
-        except selfubprocess.CalledProcessError:
+        except subprocess.CalledProcessError:
             print "\nCould not call mbdatalist! Please make sure MB-Sysem is properly installed\n."
             exit(-1)
         else:
             print "Running mbdatalist to generate datalist %s.\n"  % (subdatalist)
             print "Please be patient. This may take some time...\n"
-            subprocess.check_output("mbdatalist -F-1 -I %s -R%s > %s" % (args.datalist, args.region, subdatalist), shell=True)
+            subprocess.check_output("mbdatalist -F-1 -I %s -R%s > %s" % (datalist, region, subdatalist), shell=True)
     elif (choice == 'e'):
-        print "using existing datalist %s\n" % (subdatalist)   
+        print "using existing datalist %s\n" % (subdatalist)
+
+    return subdatalist
+
+
+
+def new_tile(tilename, region, datatype, cellsize):
+    """Instantiate the basemap tile of a given datatype
+
+    Keyword arguments:
+    tilename -- name of the basemap tile
+    region -- geographic extent of the tile
+    datatype -- MB-System datatype (topography = 1 or 2; amplitude = 3; sidescan = 4)
+    cellsize -- the spatial resolution of the tile
+
+    Returns:
+    (tile, make_grid, make_ps_plot) -- the tile with its gridding and Postscript map functions. (None, None, None) for an unknown datatype.
+    """
+    if (datatype == 1 or datatype == 2):
+        # Instantiate a bathy grid
+        tile = btbathy.BasetileBathy(tilename, region, cellsize)
+        return (tile, tile.make_bathy_grid, tile.make_ps_plot)
+    elif (datatype == 3):
+        # Instantiate an amplitude grid
+        tile = btamp.BasetileAmp(tilename, region, cellsize)
+        return (tile, tile.make_amp_grid, tile.make_ps_plot)
+    elif (datatype == 4):
+        # Instantiate a sidescan grid
+        tile = btss.BasetileSs(tilename, region, cellsize)
+        return (tile, tile.make_ss_grid, tile.make_ps_plot)
+
+    return (None, None, None)
+
+
+
+def work_dir(args):
+    """Directory of the intermediate files of the tiles: the scratch workspace, or the output directory without one
+
+    Keyword argument:
+    args -- parsed command line arguments (outdir, scratch)
+
+    Returns:
+    workdir -- directory path
+    """
+    if args.scratch is not None:
+        return args.scratch.directory
+
+    return args.outdir
+
+
+
+def sweep_tile(tilename, args):
+    """Remove the intermediate files of a basemap tile left in the scratch workspace
+
+    Keyword arguments:
+    tilename -- name of the basemap tile
+    args -- parsed command line arguments (scratch)
+    """
+    if args.scratch is not None:
+        args.scratch.sweep(tilename)
+
+
+
+def make_tile_datalist(datalist, tilename, region, outdir):
+    """Create the datalist of the swath files within a tile, shared by all the products of the tile
+
+    Keyword arguments:
+    datalist -- MB-System datalist
+    tilename -- name of the basemap tile
+    region -- geographic extent of the tile
+    outdir -- directory path in which to store the datalist
+
+    Returns:
+    tile_datalist -- path to the tile datalist. None when no swath file lies within the tile.
+    """
+    tile_datalist = path.join(outdir, tilename+TILE_DATALIST_SUFFIX)
+    subprocess.check_output("mbdatalist -F-1 -I %s -R%s > %s" % (datalist, region, tile_datalist), shell=True)
+
+    if path.getsize(tile_datalist) == 0:
+        remove(tile_datalist)
+        return None
+
+    return tile_datalist
+
+
+
+def scatter_tiles(tiles, datalist, datatypes, args):
+    """Grid the tiles of a region in a single pass over its soundings per datatype (--gridder scatter)
+
+    The grids are left in the scratch workspace, or in the output directory for the workers of a distributed
+    run, where the make_*_grid() functions of the tiles find them.
+
+    Keyword arguments:
+    tiles -- list of (tilename, tile region) tuples
+    datalist -- MB-System datalist of the swath files of the region
+    datatypes -- list of MB-System datatypes to make. The backscatter datatypes are mosaicked.
+    args -- parsed command line arguments (cellsize, outdir, scratch, queue)
+    """
+    import tile_scatter
+
+    outdir = work_dir(args)
+    if args.queue:
+        outdir = args.outdir
+
+    for datatype in datatypes:
+        if not tiles:
+            continue
+        method = 'mean'
+        if datatype in [3, 4]:
+            method = 'mosaic'
+        basetiles = [new_tile(tilename, region, datatype, args.cellsize)[0] for (tilename, region) in tiles]
+        tile_scatter.scatter(datalist, basetiles, datatype, outdir, method)
+
+
+
+def grid_tile(tilename, region, datalist, datatypes, args, timer=None):
+    """Make the grids of one or several datatypes for a basemap tile in a single pass
+
+    The datalist of the tile, its mask and its metadata are shared by all the products,
+    and the gridding/mosaicking of the products are run concurrently.
+
+    Keyword arguments:
+    tilename -- name of the basemap tile
+    region -- geographic extent of the tile
+    datalist -- MB-System datalist of the swath files to grid
+    datatypes -- list of MB-System datatypes to make (topography = 1 or 2; amplitude = 3; sidescan = 4)
+    args -- parsed command line arguments (gridkind, mapkind, cellsize, outdir, scratch, logo, psviewer, disp_ps, gridder, soundings)
+    timer -- optional TileTimer recording the time spent in each stage
+
+    Returns:
+    products -- list of the products of the tile, one dict per datatype with the 'tile', its stage functions and timing 'record'. Empty when there is no data in the tile.
+    """
+    # Datalist of the tile shared by all the products
+    tile_datalist = make_tile_datalist(datalist, tilename, region, work_dir(args))
+    if tile_datalist is None:
+        print "No data to grid for basetile %s!\n" % (tilename)
+        return []
+
+    products = []
+    for datatype in datatypes:
+        (tile, make_grid, make_ps_plot) = new_tile(tilename, region, datatype, args.cellsize)
+        if tile is None:
+            print "\nError: unknown datatype %s.\n" % (datatype)
+            exit(-1)
+        tile.gridder = args.gridder
+        tile.scratch = args.scratch
+        if args.soundings:
+            # The tiles read their partitions of the sounding store: no pass over the swath files is needed
+            tile.sounding_store = args.soundings
+            if args.gridder == 'scatter':
+                tile.gridder = 'python'
+        elif args.gridder == 'scatter' and not [d for d in [work_dir(args), args.outdir] if path.isfile(path.join(d, tile.nc_grid['grid']))]:
+            # The single pass grid was used up by an interrupted or failed attempt of the tile, e.g. a retried queue item
+            print "No single pass grid of datatype %s for basetile %s, gridding in-process" % (datatype, tilename)
+            tile.gridder = 'python'
+
+        product = {'datatype': datatype, 'tile': tile, 'make_grid': make_grid, 'ps_plot': make_ps_plot, \
+                   'make_esri_grid': tile.make_esri_grid, 'make_chunked_grid': tile.make_chunked_grid, 'make_gif_plot': tile.make_gif_plot, \
+                   'make_quicklook': tile.make_quicklook, 'record': None}
+        if timer:
+            # Time every stage of the tile. cookie_cut is called from within the gridding function.
+            record = timer.start_tile(tilename, datatype, args.cellsize)
+            tile.cookie_cut = record.wrap('cookie_cut', tile.cookie_cut)
+            for (key, stage) in [('make_grid', 'grid'), ('make_esri_grid', 'make_esri_grid'), ('make_chunked_grid', 'make_chunked_grid'), \
+                                 ('ps_plot', 'ps_plot'), ('make_gif_plot', 'make_gif_plot'), ('make_quicklook', 'make_quicklook')]:
+                product[key] = record.wrap(stage, product[key])
+            product['record'] = record
+        products.append(product)
+
+    # Mask of the tile region shared by all the products
+    mask = products[0]['tile'].new_mask(args.outdir)
+
+    def grid(product):
+        # A failing MB-System call exits: report it as an error of this product instead of killing the thread
+        try:
+            product['make_grid'](tile_datalist, args.outdir, mask)
+        except SystemExit:
+            raise RuntimeError("gridding of datatype %s failed" % (product['datatype']))
+
+    # Make the NetCDF grids concurrently
+    try:
+        if len(products) > 1:
+            pool = ThreadPool(len(products))
+            try:
+                pool.map(grid, products)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            grid(products[0])
+    finally:
+        mask.clean()
+        if path.isfile(tile_datalist):
+            remove(tile_datalist)
+
+    return products
+
+
+
+def map_stages(args):
+    """Names of the stages run on the grids of a tile, in order
+
+    Keyword arguments:
+    args -- parsed command line arguments (gridkind, mapkind)
+
+    Returns:
+    stages -- list of stage names (see tile_timing.TileTimer.STAGES)
+    """
+    stages = []
+    # Make optional grid
+    if (args.gridkind == 2):
+        stages.append('make_esri_grid')
+    elif (args.gridkind == 3):
+        # The chunked grid is made before the quick-look that reads its overviews
+        stages.append('make_chunked_grid')
+    if (args.mapkind == 3):
+        # Make the quick-look image instead of the Postscript map
+        stages.append('make_quicklook')
+    else:
+        # Make the Postscript map
+        stages.append('ps_plot')
+    # Make option gif image
+    if (args.mapkind == 2):
+        stages.append('make_gif_plot')
+
+    return stages
+
+
+
+def run_map_stage(products, stage, args):
+    """Run a stage on the grids of a tile
+
+    Keyword arguments:
+    products -- products of the tile returned by grid_tile()
+    stage -- one of 'make_esri_grid', 'make_chunked_grid', 'ps_plot', 'make_gif_plot' or 'make_quicklook'
+    args -- parsed command line arguments (outdir, logo, psviewer, disp_ps)
+    """
+    for product in products:
+        if stage == 'make_esri_grid' or stage == 'make_chunked_grid':
+            product[stage](args.outdir)
+        elif stage == 'ps_plot':
+            product[stage](args.outdir, args.logo, args.psviewer, args.disp_ps)
+        elif stage == 'make_gif_plot' or stage == 'make_quicklook':
+            product[stage](args.outdir, args.logo)
+
+
+
+def end_tile(products, args, timer=None, catalog=None):
+    """Write the timing records and catalog entries of the products of a completed tile
+
+    Keyword arguments:
+    products -- products of the tile returned by grid_tile()
+    args -- parsed command line arguments (outdir)
+    timer -- optional TileTimer recording the time spent in each stage
+    catalog -- optional TileCatalog in which to record the tiles
+
+    Returns:
+    tiles -- list of the basemap tiles made, one per datatype
+    """
+    for product in products:
+        if timer or catalog:
+            info = product['tile'].grid_info(args.outdir)
+        if timer:
+            timer.end_tile(product['record'], info)
+        if catalog:
+            catalog.upsert(tile_catalog.catalog_row(product['tile'], product['datatype'], args.outdir, info))
+
+    return [product['tile'] for product in products]
+
+
+
+def make_tile(tilename, region, datalist, datatypes, args, timer=None, catalog=None):
+    """Make the grid and map products of one or several datatypes for a basemap tile in a single pass
+
+    Keyword arguments:
+    tilename -- name of the basemap tile
+    region -- geographic extent of the tile
+    datalist -- MB-System datalist of the swath files to grid
+    datatypes -- list of MB-System datatypes to make (topography = 1 or 2; amplitude = 3; sidescan = 4)
+    args -- parsed command line arguments (gridkind, mapkind, cellsize, outdir, logo, psviewer, disp_ps)
+    timer -- optional TileTimer recording the time spent in each stage
+    catalog -- optional TileCatalog in which to record the tiles
+
+    Returns:
+    tiles -- list of the basemap tiles made, one per datatype. Empty when there is no data in the tile.
+    """
+    try:
+        products = grid_tile(tilename, region, datalist, datatypes, args, timer)
+
+        # The map scripts set the GMT defaults of the working directory and are run one at a time
+        for stage in map_stages(args):
+            run_map_stage(products, stage, args)
+
+        return end_tile(products, args, timer, catalog)
+    finally:
+        sweep_tile(tilename, args)
+
+
+
+def run_pipeline(tiles, datalist, datatypes, args, job, timer=None, catalog=None):
+    """Make the basemap tiles through a pipeline overlapping the stages of consecutive tiles
+
+    The gridding of up to args.pipeline tiles runs while the ESRI grids, Postscript maps and gif images of
+    the previous tiles are made, each of these stages working on one tile at a time.
+
+    Keyword arguments:
+    tiles -- list of (count, tilename, region) tuples of the tiles to make
+    datalist -- MB-System datalist of the swath files to grid
+    datatypes -- list of MB-System datatypes to make
+    args -- parsed command line arguments
+    job -- TileJob recording the state of each tile
+    timer -- optional TileTimer recording the time spent in each stage
+    catalog -- optional TileCatalog in which to record the tiles
+    """
+    def grid(unit):
+        print "Creating basemap tile %d for tilename %s..." % (unit['count'], unit['tilename'])
+        job.set_state(unit['tilename'], tile_job.RUNNING)
+        unit['products'] = grid_tile(unit['tilename'], unit['region'], datalist, datatypes, args, timer)
+
+    def map_stage(stage):
+        return lambda unit: run_map_stage(unit['products'], stage, args)
+
+    stages = [('grid', grid, args.pipeline)]
+    for stage in map_stages(args):
+        stages.append((stage, map_stage(stage), PIPELINE_WORKERS[stage]))
+
+    pipeline = tile_pipeline.Pipeline(stages)
+    units = [{'count': count, 'tilename': tilename, 'region': region, 'products': []} for (count, tilename, region) in tiles]
+    for (unit, error) in pipeline.run(units):
+        if error is None:
+            end_tile(unit['products'], args, timer, catalog)
+            job.set_state(unit['tilename'], tile_job.DONE)
+        else:
+            job.set_state(unit['tilename'], tile_job.FAILED, error)
+            print "\nError: basemap tile %s failed: %s\n" % (unit['tilename'], error)
+        sweep_tile(unit['tilename'], args)
+
+    print pipeline.summary()
+
+
+
+def clean_tile(tilename, region, datatypes, args):
+    """Remove the partial files left by an interrupted or failed basemap tile
+
+    Keyword arguments:
+    tilename -- name of the basemap tile
+    region -- geographic extent of the tile
+    datatypes -- list of MB-System datatypes of the tile
+    args -- parsed command line arguments (cellsize, outdir)
+    """
+    for datatype in datatypes:
+        (tile, make_grid, make_ps_plot) = new_tile(tilename, region, datatype, args.cellsize)
+        for filename in tile.clean_partial(args.outdir):
+            print "Removed partial file %s" % (filename)
+    if path.isfile(path.join(args.outdir, tilename+TILE_DATALIST_SUFFIX)):
+        remove(path.join(args.outdir, tilename+TILE_DATALIST_SUFFIX))
+
+
+
+def run_queue(queue, settings, workspace=None):
+    """Work on the tiles of a shared queue until it is empty
+
+    Keyword arguments:
+    queue -- the TileQueue
+    settings -- run settings written by the coordinator (absolute datalist, outdir and logo paths)
+    workspace -- Scratch workspace of this worker (see scratch.py). Default: None, the output directory
+
+    Returns:
+    count -- number of tiles processed by this worker
+    """
+    args = argparse.Namespace(**settings)
+    args.scratch = workspace
+    worker = tile_queue.worker_id()
+
+    # Each worker writes its own timing files
+    timer = None
+    if settings.get('timing'):
+        timer = tile_timing.TileTimer("%s_%s" % (settings['timing'], worker.replace(':', '_')))
+
+    def process(item):
+        if item['attempts'] > 1:
+            # A previous claim of the tile was interrupted or failed
+            clean_tile(item['tilename'], item['region'], args.datatypes, args)
+        print "Worker %s creating basemap tile %s (attempt %d)..." % (worker, item['tilename'], item['attempts'])
+        tiles = make_tile(item['tilename'], item['region'], args.datalist, args.datatypes, args, timer)
+        # The catalog is written by the coordinator only: SQLite locking is not reliable over NFS
+        rows = [tile_catalog.catalog_row(tile, datatype, args.outdir) for (tile, datatype) in zip(tiles, args.datatypes)]
+        return {'worker': worker, 'grids': [tile.nc_grid['tile'] for tile in tiles], 'catalog': rows}
+
+    count = tile_queue.run_worker(queue, process)
+
+    if timer:
+        print timer.close()
+
+    return count
+
+
+
+def worker_main(arguments):
+    """Worker entry point: anbasemap.py worker QUEUE
+
+    Keyword arguments:
+    arguments -- command line arguments following 'worker'
+    """
+    parser = argparse.ArgumentParser(prog='anbasemap.py worker', description= \
+                                     "Claim and make the ArcticNet basemap tiles of a shared work queue created by anbasemap.py --queue")
+    parser.add_argument('queue', type=str, help='shared queue directory')
+    parser.add_argument('--lease', type=int, default=300, help='time in seconds after which the claim of a silent worker expires. Default: 300')
+    parser.add_argument('--scratch', help='local directory (e.g. /dev/shm) in which this worker writes the intermediate files of the tiles')
+    args = parser.parse_args(arguments)
+
+    if not path.isfile(path.join(args.queue, 'settings.json')):
+        print "\nError: %s is not a tile queue. Create it with anbasemap.py --queue first.\n" % (args.queue)
+        exit(-1)
+
+    workspace = None
+    if args.scratch:
+        workspace = scratch.Scratch(args.scratch)
+
+    queue = tile_queue.TileQueue(args.queue, args.lease)
+    count = run_queue(queue, queue.settings(), workspace)
+    print "Worker %s processed %d tile(s). %s" % (tile_queue.worker_id(), count, queue)
+    if workspace:
+        print workspace.close()
+
+
+
+def main():
+    if len(argv) > 1 and argv[1] == 'worker':
+        worker_main(argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description= \
+                                     "Create the ArcticNet 15' x 30' basemap tiles based on a given MB-System datalist, region and spatial resolution")
+    parser.add_argument('datalist', type=str, help='MB-System datalist')
+    parser.add_argument('datatype', type=int, default='2', help='MB-System datatype (bathymetry = 1; amplitude = 2; sidescan = 3')
+    parser.add_argument('gridkind', type=int, default='1', help='MB-System gridkind (netCDF = 1; ESRI Grid = 2; chunked grid store = 3')
+    parser.add_argument('mapkind',  type=int, default='1', help='MB-System mapkind (Postscript = 1; gif = 2; png quick-look = 3')
+    parser.add_argument('region',   type=str, help='region in west/east/south/north format')
+    parser.add_argument('cellsize', type=float, help='cellsize')
+    parser.add_argument('psviewer', type=str, help='Name of the ps viewer')
+    parser.add_argument('disp_ps',  type=str, help='Flag to display Postscript files as they are being generated')
+    parser.add_argument('-D', '--outdir', help='output directory in which to store the products')
+    parser.add_argument('-l', '--logo', default='logos.sun', help='logo to display in legend. Default: logos.sun')
+    parser.add_argument('-T', '--timing', help='path and name, without extension, of the per-tile stage timing files (.jsonl, .csv and _summary.txt)')
+    parser.add_argument('-j', '--job', help='job state file recording the state of each tile. Default: the sub-datalist name with a _A<datatype>_job.json suffix')
+    parser.add_argument('-r', '--resume', action='store_true', help='resume an interrupted run: skip the completed tiles and clean up the partial ones')
+    parser.add_argument('-m', '--products', help='comma separated list of datatypes to make in a single pass over the tiles (e.g. 2,3,4). Overrides datatype')
+    parser.add_argument('-p', '--plan', action='store_true', help='only plan the run: list the tiles with data, their input and output volumes and predicted runtime')
+    parser.add_argument('--history', help='glob pattern of the timing files used to predict the runtime of a plan. Default: OUTDIR/basetile_timing_*.jsonl')
+    parser.add_argument('-P', '--pipeline', type=int, default=0, help='pipeline the stages of the tiles, gridding up to PIPELINE tiles while the maps of the previous tiles are made. Default: 0 (one tile at a time)')
+    parser.add_argument('-q', '--queue', help='shared directory of a distributed run: queue the tiles and work on them along with the workers started with anbasemap.py worker QUEUE')
+    parser.add_argument('--lease', type=int, default=300, help='time in seconds after which the claim of a silent worker of the queue expires. Default: 300')
+    parser.add_argument('-c', '--catalog', help='SQLite tile catalog in which to record the extent, statistics and products of each tile made')
+    parser.add_argument('--gridder', default='mbgrid', choices=['mbgrid', 'python', 'scatter'], help='gridding engine: MB-System mbgrid/mbmosaic, the in-process gridder tile by tile, or the in-process gridder of all the tiles in a single pass over the soundings (scatter). Default: mbgrid')
+    parser.add_argument('--soundings', help='sounding store (see sounding_store.py) read by the in-process gridder instead of the swath files')
+    parser.add_argument('--scratch', help='local directory (e.g. /dev/shm) in which the intermediate files of the tiles are written. Only the products are moved to the output directory. Default: the output directory')
+    args = parser.parse_args()
+
+    # Datatypes of the products to make
+    datatypes = [args.datatype]
+    if args.products:
+        datatypes = []
+        for datatype in [int(datatype) for datatype in args.products.split(',')]:
+            # The topography datatypes 1 and 2 make the same product, whose files would be overwritten by the concurrent gridding
+            same = [d for d in datatypes if d == datatype or (d in [1, 2] and datatype in [1, 2])]
+            if same:
+                print "Ignoring datatype %d of the products: it makes the same product as datatype %d." % (datatype, same[0])
+                continue
+            datatypes.append(datatype)
+
+    # Dry-run planner: only reads the datalists, .inf files and previous timings
+    if args.plan:
+        history = args.history
+        if history is None and args.outdir:
+            history = path.join(args.outdir, 'basetile_timing_*.jsonl')
+        tiles = tile_plan.plan(args.datalist, args.region, args.cellsize, args.gridkind, args.mapkind, history, LON_STEP, LAT_STEP, datatypes)
+        print tile_plan.report(tiles)
+        exit(0)
+
+    # Optional per-tile stage timings. The workers of a queue write their own.
+    timer = None
+    if args.timing and not args.queue:
+        timer = tile_timing.TileTimer(args.timing)
+
+    # Optional tile catalog
+    catalog = None
+    if args.catalog:
+        catalog = tile_catalog.TileCatalog(args.catalog)
+   
+    # Check that mb-system is installed
+    try:
+        subprocess.check_call(['which', 'mbinfo'])
+    except subprocess.CalledProcessError:
+        print 'Could not call mbinfo! Please make sure MB-Sysem is properly installed.'
+        exit()
+
+    # Optional scratch workspace of the intermediate files
+    if args.scratch:
+        args.scratch = scratch.Scratch(args.scratch)
+
+    # Create a new sub-datalist with filename composed with region extent. Reuse it when resuming.
+    choice = None
+    if args.resume:
+        choice = 'e'
+    subdatalist = make_subdatalist(args.datalist, args.region, choice)
 
     # Access the sub-datalist and check it's size
     f_datalist = open(subdatalist)
     f_datalist.seek(0,2)
     subdatalist_size = f_datalist.tell()
 
-    if (subdatalist_size > 0):   
-        # Main loop over tiles from top-left corner
+    if (subdatalist_size > 0):
+        # Job state of the run
+        if not args.job:
+            args.job = "%s_A%s_job.json" % (path.splitext(subdatalist)[0], '-'.join([str(datatype) for datatype in datatypes]))
+        settings = {'datalist': args.datalist, 'region': args.region, 'datatypes': datatypes, \
+                    'gridkind': args.gridkind, 'mapkind': args.mapkind, 'cellsize': args.cellsize, \
+                    'outdir': args.outdir, 'gridder': args.gridder, 'soundings': args.soundings}
+        tiles = geo.basemap_lattice(args.region, LON_STEP, LAT_STEP)
+
+        if args.queue:
+            # Distributed run: the workers on other hosts need absolute paths on the shared file system
+            if args.soundings:
+                settings['soundings'] = path.abspath(args.soundings)
+            settings.update({'datalist': path.abspath(subdatalist), 'outdir': path.abspath(args.outdir), \
+                             'logo': path.abspath(args.logo), 'psviewer': args.psviewer, 'disp_ps': 'False', \
+                             'timing': None})
+            if args.timing:
+                settings['timing'] = path.abspath(args.timing)
+            if args.gridder == 'scatter' and not args.soundings:
+                scatter_tiles(tiles, subdatalist, datatypes, args)
+            queue = tile_queue.TileQueue(args.queue, args.lease)
+            queue.create(settings, tiles)
+            print "Queued the tiles of region %s. Start workers with: anbasemap.py worker %s" % (args.region, path.abspath(args.queue))
+            run_queue(queue, settings, args.scratch)
+
+            print queue
+            if catalog:
+                for item in queue.items(tile_queue.DONE):
+                    for row in item.get('result', {}).get('catalog', []):
+                        catalog.upsert(row)
+            for item in queue.items(tile_queue.FAILED):
+                print "Failed basemap tile %s: %s" % (item['tilename'], item.get('result', {}).get('error'))
+            f_datalist.close()
+            if catalog:
+                catalog.close()
+            if args.scratch:
+                print args.scratch.close()
+            return
+
+        job = tile_job.TileJob(args.job, settings, args.resume)
+        for (tilename, region) in tiles:
+            job.add(tilename, region)
+        job.save()
+        if args.resume:
+            print "Resuming %s" % (job)
+
+        # Tiles left to make, from top-left corner
+        todo = []
         cnt = 0
-        for y in lat:
-            yd, ym, ys, yh = geo.decdeg2dms_hem(y, 'lat')
-            for x in lon:
-                cnt = cnt + 1
-                xd, xm, xs, xh = geo.decdeg2dms_hem(x, 'lon')
-                tilename = "%.2d_%.2d_%c_%.2d_%.2d_%c" % (yd, ym, yh, xd, xm, xh)
-                print "Creating basemap tile %d for tilename %s..." % (cnt, tilename)
-
-                # Region of the tile
-                region = "%.1f/%.1f/%.2f/%.2f" % (x, x+LON_STEP, y-LAT_STEP, y)
-               
-                if (args.datatype == 1 or args.datatype == 2):
-                    # Instantiate a bathy grid
-                    tile = btbathy.BasetileBathy(tilename, region, args.cellsize)
-
-                    # Make a bathy NetCDF grid
-                    tile.make_bathy_grid(subdatalist, args.outdir)
-                    # Make optional grid
-                    if (args.gridkind == 2):
-                        tile.make_esri_grid(args.outdir)
-
-                    # Make the Postscript map
-                    tile.make_bathy_ps_plot(args.outdir, args.logo, args.psviewer, args.disp_ps)
-                    # Make option gif image
-                    if (args.mapkind == 2):
-                        tile.make_gif_plot(args.outdir, args.logo)
-                            
-                elif (args.datatype == 3):
-                    # Instantiate an amplitude grid
-                    tile = btamp.BasetileAmp(tilename, region, args.cellsize)
-
-                    # Make an amplitude NetCDF grid
-                    tile.make_amp_grid(subdatalist, args.outdir)
-                    # Make optional grid
-                    if (args.gridkind == 2):
-                        tile.make_esri_grid(args.outdir)
-
-                    # Make an amplitude Postscript map
-                    tile.make_amp_ps_plot(args.outdir, args.logo, args.psviewer, args.disp_ps)
-                    # Make option gif image
-                    if (args.mapkind == 2):
-                        tile.make_gif_plot(args.outdir, args.logo)
-                            
-                elif (args.datatype == 4):
-                    # Instantiate an amplitude grid
-                    tile = btss.BasetileSs(tilename, region, args.cellsize)
-
-                    # Make an sidescan NetCDF grid
-                    tile.make_ss_grid(subdatalist, args.outdir)
-                    # Make optional grid
-                    if (args.gridkind == 2):
-                        tile.make_esri_grid(args.outdir)
-
-                    # Make a sidescan Postscript map
-                    tile.make_ss_ps_plot(args.outdir, args.logo, args.psviewer, args.disp_ps)
-                    # Make option gif image
-                    if (args.mapkind == 2):
-                        tile.make_gif_plot(args.outdir, args.logo)
-                    
+        for (tilename, region) in tiles:
+            cnt = cnt + 1
+            state = job.get_state(tilename)
+            if state == tile_job.DONE:
+                print "Skipping completed basemap tile %d for tilename %s..." % (cnt, tilename)
+                continue
+            elif state != tile_job.PENDING:
+                # The tile was interrupted or failed: remove its partial files before starting again
+                clean_tile(tilename, region, datatypes, args)
+            todo.append((cnt, tilename, region))
+
+        if args.gridder == 'scatter' and not args.soundings:
+            # Single pass over the soundings of the tiles left to make
+            scatter_tiles([(tilename, region) for (cnt, tilename, region) in todo], subdatalist, datatypes, args)
+
+        if args.pipeline > 0:
+            run_pipeline(todo, subdatalist, datatypes, args, job, timer, catalog)
+            todo = []
+
+        # Main loop over tiles
+        for (cnt, tilename, region) in todo:
+            print "Creating basemap tile %d for tilename %s..." % (cnt, tilename)
+            job.set_state(tilename, tile_job.RUNNING)
+            try:
+                make_tile(tilename, region, subdatalist, datatypes, args, timer, catalog)
+            except Exception as e:
+                job.set_state(tilename, tile_job.FAILED, str(e))
+                print "\nError: basemap tile %s failed: %s\n" % (tilename, e)
+            except SystemExit:
+                job.set_state(tilename, tile_job.FAILED, 'exit')
+                raise
+            else:
+                job.set_state(tilename, tile_job.DONE)
+
+        print job
     else:
-        print "No data to grid for tilename %s!\n" % (tilename)
+        print "No data to grid in region %s!\n" % (args.region)
 
     # Close the datalist file
     f_datalist.close()
 
+    # Write the timing summary
+    if timer:
+        print timer.close()
+
+    # Report and remove the scratch workspace
+    if args.scratch:
+        print args.scratch.close()
+
+    if catalog:
+        catalog.close()
+
             
 if __name__ == '__main__':
     # print 'Running as script...'
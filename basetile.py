@@ -25,9 +25,13 @@
 Class for parent basemap tile
 """
 
-from os import path, remove
+from os import path, remove, rename
+import glob
+import shutil
 import sys
 import subprocess
+import threading
+import numpy as np
 
 class Basetile(object):
     """ArcticNet basemap tile and associated functionalities"""
@@ -38,10 +42,13 @@ class Basetile(object):
     __suffix = {'mask': '_mask', \
                 'tile': '_tile', \
                 'lcc': '_lcc', \
-                'polygon': '_lcc_coord.txt'}
+                'polygon': '_lcc_coord.txt', \
+                'part': '.part'}
     
     __extension = {'grd': '.grd', \
                    'flt': '.flt', \
+                   'hdr': '.hdr', \
+                   'prj': '.prj', \
                    'cmd': '.cmd', \
                    'ps': '.ps',  \
                    'cpt': '.cpt', \
@@ -49,7 +56,16 @@ class Basetile(object):
                    'mb-1': '.mb-1', \
                    'aux': '.aux', \
                    'xml': '.xml', \
-                   'gif': '.gif'}
+                   'gif': '.gif', \
+                   'png': '.png', \
+                   'zgd': '.zgd'}
+
+    # Templates of the Postscript map scripts, one per datatype (see plot_template())
+    __plot_templates = {}
+    __plot_lock = threading.Lock()
+
+    # Geodesic and projected corners of the regions already computed, shared by the products of a tile
+    __regions = {}
 
 
     
@@ -66,6 +82,10 @@ class Basetile(object):
         """
         import pyproj
 
+        # The corners of a region are only computed once
+        if (region, src_proj, dst_proj) in self.__regions:
+            return self.__regions[(region, src_proj, dst_proj)]
+
         # Dictionnary to store tile geo metadata
         geoinfo = dict()
         
@@ -86,6 +106,7 @@ class Basetile(object):
         geoinfo['lr'] = pyproj.transform(p1, p2, geoinfo['xmax'], geoinfo['ymin'])
         geoinfo['ll'] = pyproj.transform(p1, p2, geoinfo['xmin'], geoinfo['ymin'])
 
+        self.__regions[(region, src_proj, dst_proj)] = geoinfo
         return geoinfo
     
 
@@ -104,6 +125,11 @@ class Basetile(object):
         """
         PROJ4_LCC = "+proj=lcc +lat_1=70 +lat_2=73 +lat_0=70 +lon_0=-105 +x_0=2000000 +y_0=2000000 +datum=WGS84 +units=m +no_defs" 
         PROJ4_GEO = "+proj=latlong +datum=WGS84"
+        ESRI_WKT_LCC = 'PROJCS["unnamed",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],' \
+                       'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]],PROJECTION["Lambert_Conformal_Conic"],' \
+                       'PARAMETER["standard_parallel_1",70],PARAMETER["standard_parallel_2",73],PARAMETER["latitude_of_origin",70],' \
+                       'PARAMETER["central_meridian",-105],PARAMETER["false_easting",2000000],PARAMETER["false_northing",2000000],' \
+                       'UNIT["Meter",1]]'
         GMT_SCALE = "-105/70/70/73/"
         GMT_PROJ = "l"
         PRIM_MERD = -105
@@ -115,9 +141,13 @@ class Basetile(object):
         self.metadata['cellsize'] = cellsize
         self.metadata['proj4_proj_lcc'] = PROJ4_LCC
         self.metadata['proj4_proj_geo'] = PROJ4_GEO
+        self.metadata['esri_wkt_lcc'] = ESRI_WKT_LCC
         self.metadata['gmt_proj'] = GMT_PROJ
         self.metadata['gmt_scale'] = GMT_SCALE
         self.metadata['prim_merd'] = PRIM_MERD
+
+        # Statistics of the cookie cut grid (see cookie_cut())
+        self.stats = None
     
         # netCDF grid instance attributes
         self.nc_grid = {}
@@ -132,8 +162,14 @@ class Basetile(object):
         # ESRI grid instance attibutes
         self.esri_grid = {}
         self.esri_grid['grid'] = self.nc_grid['no_ext']+self.__suffix['tile']+self.__extension['flt']
+        self.esri_grid['hdr'] = self.nc_grid['no_ext']+self.__suffix['tile']+self.__extension['hdr']
+        self.esri_grid['prj'] = self.nc_grid['no_ext']+self.__suffix['tile']+self.__extension['prj']
         self.esri_grid['xml'] = self.esri_grid['grid']+self.__extension['aux']+self.__extension['xml']
 
+        # Chunked grid store instance attributes
+        self.chunked_grid = {}
+        self.chunked_grid['grid'] = self.nc_grid['no_ext']+self.__suffix['tile']+self.__extension['zgd']
+
         # ps map instance attributes
         self.ps_map = {}
         self.ps_map['no_ext'] = self.metadata['name']+datatype
@@ -148,6 +184,24 @@ class Basetile(object):
         self.gif_map = {}
         self.gif_map['lcc_map'] = self.ps_map['lcc_no_ext']+self.__extension['gif']
 
+        # png quick-look instance attributes
+        self.png_map = {}
+        self.png_map['lcc_map'] = self.ps_map['lcc_no_ext']+self.__extension['png']
+
+        # Color mapping of the quick-look (mbm_grdplot -G2: color shaded relief with the Haxby palette)
+        self.colors = {'palette': 'haxby', 'flip': False, 'equalize': False, 'shade': True}
+
+        # mbm_grdplot options of the Postscript map and description of the tile in its legend (see make_ps_plot())
+        self.plot = {'options': ['-G2', '-A0.5/270/15'], 'datatype': 'Bathymetry gridded', \
+                     'source_header': 'Vertical Datum', 'source': 'Mean Sea Level'}
+
+        # Gridding engine of the soundings: MB-System ('mbgrid') or in-process ('python', see grid_soundings())
+        self.gridder = 'mbgrid'
+        # Directory of the sounding store read by the in-process gridding instead of the swath files (see sounding_store.py)
+        self.sounding_store = None
+        # Scratch workspace of the intermediate files (see scratch.py). Default: None, the output directory
+        self.scratch = None
+
 
 
     def __str__(self):
@@ -175,44 +229,175 @@ class Basetile(object):
         
 
 
-    def __make_poly_ascii(self, outdir):
-        """Generate a ascii file containing coordinates defining the tile's region
+    def __polygon(self):
+        """Corners of the tile's region in projected coordinates
+
+        Returns:
+        polygon -- list of the (x, y) upper left, upper right, lower right and lower left corners
+        """
+        return [self.metadata['region'][corner] for corner in ['ul', 'ur', 'lr', 'll']]
+
+
+
+
+    def part_name(self, filename):
+        """Name of the partial file in which a product is written before being renamed to its final name
+
+        Keyword argument:
+        filename -- path to the final product
+
+        Returns:
+        partname -- path to the partial file (e.g. name.part.grd for name.grd)
+        """
+        (root, ext) = path.splitext(filename)
+        return root+self.__suffix['part']+ext
+
+
+
+
+    def commit_part(self, filename):
+        """Atomically rename the partial file of a product to its final name
+
+        Keyword argument:
+        filename -- path to the final product
+
+        Returns:
+        status -- True when the partial file existed and was renamed. False otherwise.
+        """
+        partname = self.part_name(filename)
+        if path.isfile(partname):
+            rename(partname, filename)
+            return True
+
+        return False
+
+
+
+
+    def work_dir(self, outdir):
+        """Directory of the intermediate files of the tile: the scratch workspace, or the output directory without one
+
+        Keyword argument:
+        outdir -- directory path in which the tile products are stored
+
+        Returns:
+        workdir -- directory path terminated by a '/' character
+        """
+        if self.scratch is None:
+            return self.__check_dir(outdir)
+
+        return self.scratch.directory
+
+
+
+
+    def publish(self, outdir, filename, keep=False):
+        """Move a product made in the scratch workspace to the output directory (see scratch.Scratch.publish())
 
         Keyword arguments:
-        outdir -- directory path in which to store the ascii file
+        outdir -- directory path in which the tile products are stored
+        filename -- name of the product
+        keep -- leave the product in the workspace, for the following stages of the tile. Default: False
+        """
+        outdir = self.__check_dir(outdir)
+        workdir = self.work_dir(outdir)
+        if workdir != outdir and path.isfile(workdir+filename):
+            self.scratch.publish(workdir+filename, outdir+filename, self.part_name(outdir+filename), keep)
+
+
+
+
+    def fetch_grid(self, outdir):
+        """Move the raw grid left in the output directory by the single pass gridding of a distributed run
+        (see tile_scatter.py) to the scratch workspace
+
+        Keyword argument:
+        outdir -- directory path in which the tile products are stored
+        """
+        outdir = self.__check_dir(outdir)
+        workdir = self.work_dir(outdir)
+        if workdir != outdir and path.isfile(outdir+self.nc_grid['grid']) and not path.isfile(workdir+self.nc_grid['grid']):
+            shutil.move(outdir+self.nc_grid['grid'], workdir+self.nc_grid['grid'])
+
+
+
+
+    def tile_grid(self, outdir):
+        """Path to the cookie cut NetCDF grid read by the map stages: its copy in the scratch workspace when there is one
+
+        Keyword argument:
+        outdir -- directory path in which the tile products are stored
 
         Returns:
-        filename -- complete path to the ascii file
+        filename -- path to the grid
         """
-        import pyproj
-       
-        # Open a file to store results
         outdir = self.__check_dir(outdir)
-        
-        filename = outdir+self.metadata['name']+self.__suffix['polygon']           
-        out = open(filename, 'w')
-
-        # Print to file
-        out.write('''{ulx} {uly}
-{urx} {ury}
-{lrx} {lry}
-{llx} {lly}
-{ulx} {uly}'''.format(ulx=self.metadata['region']['ul'][0], \
-                      uly=self.metadata['region']['ul'][1], \
-                      urx=self.metadata['region']['ur'][0], \
-                      ury=self.metadata['region']['ur'][1], \
-                      lrx=self.metadata['region']['lr'][0], \
-                      lry=self.metadata['region']['lr'][1], \
-                      llx=self.metadata['region']['ll'][0], \
-                      lly=self.metadata['region']['ll'][1]))
-
-        # Close the file and return
-        out.close()
-        return filename
+        workdir = self.work_dir(outdir)
+        if path.isfile(workdir+self.nc_grid['tile']):
+            return workdir+self.nc_grid['tile']
+
+        return outdir+self.nc_grid['tile']
+
+
+
+
+    def clean_partial(self, outdir):
+        """Remove the intermediate and partial files left behind by an interrupted tile
+
+        Positional arguments:
+        outdir -- directory path in which the tile products are stored
+
+        Returns:
+        removed -- list of the removed files
+        """
+        outdir = self.__check_dir(outdir)
+
+        intermediates = [self.nc_grid['grid'], \
+                         self.nc_grid['mask'], \
+                         self.nc_grid['cmd_script'], \
+                         self.nc_grid['tile_int'], \
+                         self.metadata['name']+self.__suffix['polygon'], \
+                         self.ps_map['shell'], \
+                         self.esri_grid['xml']]
+        products = [self.nc_grid['tile'], \
+                    self.esri_grid['grid'], \
+                    self.esri_grid['hdr'], \
+                    self.esri_grid['prj'], \
+                    self.chunked_grid['grid'], \
+                    self.ps_map['lcc_map'], \
+                    self.gif_map['lcc_map'], \
+                    self.png_map['lcc_map']]
+        partials = [self.part_name(product) for product in products]
+        partials.append(self.part_name(self.esri_grid['grid'])+self.__extension['aux']+self.__extension['xml'])
+
+        # Mask grids shared by the products of the tile
+        intermediates.extend([path.basename(maskfile) for maskfile in glob.glob(outdir+self.metadata['name']+self.__suffix['mask']+'*'+self.__extension['grd'])])
+
+        removed = []
+        for filename in intermediates+partials:
+            if path.isfile(outdir+filename):
+                remove(outdir+filename)
+                removed.append(outdir+filename)
+
+        return removed
         
 
         
         
+    def new_mask(self, outdir):
+        """Create the mask of the tile's region to share it between the products of the tile
+
+        Positional arguments:
+        outdir -- directory path in which the tile products are stored
+
+        Returns:
+        mask -- a TileMask to pass to cookie_cut()
+        """
+        return TileMask(self.__polygon())
+
+
+
+
     def make_grid(self, datalist, outdir):
         """Make a netCDF bathymetry grid from the specified datalist and basetile metadata
 
@@ -235,76 +420,208 @@ class Basetile(object):
             
             
 
-    def cookie_cut(self, outdir):
+    def sounding_accumulator(self, method='mean', clip=2):
+        """Empty grid accumulator of the soundings of the tile
+
+        The lattice of the tile is extended by the clip distance so that the gaps along the edges of the tile
+        are filled as by a gridding of the whole survey.
+
+        Keyword arguments:
+        method -- 'mean' or 'median' of the soundings of a node (see gridder.GridAccumulator), or 'mosaic' of
+                  backscatter samples (see gridder.MosaicAccumulator). Default: 'mean'
+        clip -- gap filling distance in nodes, as in mbgrid -C<clip>/<mode>. Default: 2
+
+        Returns:
+        accumulator -- gridder.GridAccumulator or gridder.MosaicAccumulator
+        """
+        import gridder
+
+        cellsize = float(self.metadata['cellsize'])
+        (xmin, ymin, nx, ny) = gridder.grid_lattice(self.__polygon(), cellsize)
+        (xmin, ymin, nx, ny) = (xmin - clip * cellsize, ymin - clip * cellsize, nx + 2 * clip, ny + 2 * clip)
+        if method == 'mosaic':
+            return gridder.MosaicAccumulator(xmin, ymin, nx, ny, cellsize)
+        return gridder.GridAccumulator(xmin, ymin, nx, ny, cellsize, method)
+
+
+
+    def sounding_bounds(self, clip=2):
+        """Geographic bounds of the soundings used by the accumulator of the tile
+
+        Keyword argument:
+        clip -- gap filling distance in nodes. Default: 2
+
+        Returns:
+        bounds -- (west, east, south, north) tuple
+        """
+        import soundings
+
+        # Soundings of the farthest node used by the gap filling of a node of the tile, diagonals included
+        return soundings.halo_bounds(self.metadata['region'], (clip + 1) * np.sqrt(2) * float(self.metadata['cellsize']))
+
+
+
+    def write_sounding_grid(self, outdir, accumulator, datatype, clip=2, mode=2):
+        """Fill the gaps of the accumulated soundings and write the netCDF grid where mbgrid writes it, ready for cookie_cut()
+
+        Positional arguments:
+        outdir -- directory path in which to store the grid
+        accumulator -- grid accumulator returned by sounding_accumulator()
+        datatype -- MB-System datatype of the values
+
+        Keyword arguments:
+        clip -- gap filling distance in nodes, as in mbgrid -C<clip>/<mode>. Default: 2
+        mode -- gap filling mode, as in mbgrid -C<clip>/<mode>. Default: 2
+        """
+        import gridder
+        import gridio
+
+        outdir = self.__check_dir(outdir)
+        (nx, ny) = (accumulator.nx - 2 * clip, accumulator.ny - 2 * clip)
+        z = gridder.fill_gaps(accumulator.result(), clip, mode)[clip:clip+ny, clip:clip+nx]
+        history = "anbasemap in-process gridding: -A%d -E%s -C%d/%d %s" % (datatype, self.metadata['cellsize'], clip, mode, accumulator.method)
+        gridio.create_grid(outdir+self.nc_grid['grid'], accumulator.x()[clip:clip+nx], accumulator.y()[clip:clip+ny], z, \
+                           title=self.nc_grid['no_ext'], history=history)
+
+
+
+    def grid_soundings(self, datalist, outdir, datatype, method='mean', clip=2, mode=2):
+        """Make the netCDF grid of the soundings of a datalist in-process, without mbgrid or mbmosaic
+
+        The soundings are read from the sounding store of the tile when it has one, the swath files being listed otherwise.
+
+        Positional arguments:
+        datalist -- MB-System datalist
+        outdir -- directory path in which to store the grid
+        datatype -- MB-System datatype of the values (topography = 1 or 2; amplitude = 3; sidescan = 4)
+
+        Keyword arguments:
+        method -- 'mean' or 'median' of the soundings of a node, or 'mosaic' of backscatter samples weighted by
+                  the priority of their grazing angle (see sounding_accumulator()). Default: 'mean'
+        clip -- gap filling distance in nodes, as in mbgrid -C<clip>/<mode>. Default: 2
+        mode -- gap filling mode, as in mbgrid -C<clip>/<mode>. Default: 2
+
+        Returns:
+        soundings -- number of soundings gridded
+        """
+        import soundings
+
+        accumulator = self.sounding_accumulator(method, clip)
+        if self.sounding_store is not None:
+            # Partitions of the sounding store under the lattice of the tile
+            import sounding_store
+            (x, y) = (accumulator.x(), accumulator.y())
+            half = 0.5 * accumulator.cellsize
+            chunks = sounding_store.SoundingStore(self.sounding_store).iter_soundings((x[0] - half, x[-1] + half, y[0] - half, y[-1] + half), \
+                                                                                      datatype, grazing=(method == 'mosaic'))
+        else:
+            region = "%.8f/%.8f/%.8f/%.8f" % self.sounding_bounds(clip)
+            chunks = soundings.iter_soundings(datalist, region, datatype, proj4=self.metadata['proj4_proj_lcc'], grazing=(method == 'mosaic'))
+        for chunk in chunks:
+            if method == 'mosaic':
+                # Backscatter samples with their grazing angles
+                accumulator.add(chunk[0], chunk[1], chunk[2], grazing=chunk[3])
+            else:
+                accumulator.add(chunk[0], chunk[1], chunk[2])
+        self.write_sounding_grid(outdir, accumulator, datatype, clip, mode)
+
+        return accumulator.soundings
+
+
+
+    def cookie_cut(self, outdir, mask=None):
         """Cookie cut the netCDF grid based on basetile extent
 
+        The grid is read once, the cells outside of the tile's polygon are set to NaN and the statistics of
+        the remaining cells are stored in self.stats before the cookie cut grid is written.
+
         Positional arguments:
         outdir -- directory path in which to store the grid
 
+        Keyword argument:
+        mask -- TileMask shared by the products of the tile. Default: a mask for this grid only
+
         Returns:
         status -- True when the NetCDF grid has valid data. False otherwise.
         """
+        import gridio
+
         status = False
         outdir = self.__check_dir(outdir)
+        workdir = self.work_dir(outdir)
 
-        # Make polygon in projected coordinates
-        polyfile = self.__make_poly_ascii(outdir)
-        
-        # Mask based on projected polygon
-        try:
-            subprocess.check_call(['which', 'grdmask'])
-        except subprocess.CalledProcessError:
-            print "\nCould not call grdmask! Please make sure GMT is properly installed\n."
-            exit(-1)
-        else:            
-            subprocess.call(["grdmask", polyfile, "-G"+outdir+self.nc_grid['mask'], "-R"+outdir+self.nc_grid['grid'], "-NNaN/1/1", "-V"])
+        if mask is None:
+            mask = TileMask(self.__polygon())
 
-        # Perform mask
-        try:
-            subprocess.check_call(['which', 'grdmath'])
-        except subprocess.CalledProcessError:
-            print "\nCould not call grdmath! Please make sure GMT is properly installed\n."
-            exit(-1)
-        else:        
-            subprocess.call(["grdmath", outdir+self.nc_grid['grid'], outdir+self.nc_grid['mask'], "OR", "=", outdir+self.nc_grid['tile']])
+        if not path.isfile(workdir+self.nc_grid['grid']):
+            print "\nError: NetCDF file %s not found!\n" % (self.nc_grid['grid'])
+            return status
 
-        # Remove unnecessary files
-        if path.isfile(polyfile):
-            # polygon file
-            remove(polyfile)
+        # Perform mask
+        grid = gridio.read_grid(workdir+self.nc_grid['grid'])
+        z = grid['z']
+        inside = mask.inside(grid['x'], grid['y'])
+        z[~inside] = np.nan
+        self.stats = gridio.grid_stats(z)
+        self.stats['ny'], self.stats['nx'] = z.shape
+        self.stats['tile_cells'] = int(np.count_nonzero(inside))
 
-        if path.isfile(outdir+self.nc_grid['grid']):
-            # original NetCDF grid
-            remove(outdir+self.nc_grid['grid'])
-            
-        if path.isfile(outdir+self.nc_grid['mask']):
-            # NetCDF grid mask
-            remove(outdir+self.nc_grid['mask'])
-          
         # Check if the NetCDF grid contains valid data
-        try:
-            subprocess.check_call(['which', 'grdinfo'])
-        except subprocess.CalledProcessError:
-            print "\nCould not call grdinfo! Please make sure gmt is properly installed\n."
-            exit(-1)
+        if self.stats['valid_cells'] > 0:
+            # There is elevation data in the file. Set the return status to True
+            status = True
+            gridio.write_grid(self.part_name(workdir+self.nc_grid['tile']), workdir+self.nc_grid['grid'], z)
+            self.commit_part(workdir+self.nc_grid['tile'])
+            # The copy in the scratch workspace is read by the map stages
+            self.publish(outdir, self.nc_grid['tile'], keep=True)
         else:
-            zrange = subprocess.check_output("grdinfo %s | grep 'z_min'"  % (outdir+self.nc_grid['tile']), shell=True)
-            zmin = float(zrange.split(' ')[2])
-            zmax = float(zrange.split(' ')[4])
-            if not((zmax == 0) and (zmin == 0)):
-                # There is elevation data in the file. Set the return status to True
-                status = True
-            else:
-                # There is no elevation data in the file. Delete the NetCDF grid and mb-1 file
-                if path.isfile(outdir+self.nc_grid['tile']):
+            # There is no elevation data in the file. Delete the NetCDF grid and mb-1 file
+            for directory in set([outdir, workdir]):
+                if path.isfile(directory+self.nc_grid['tile']):
                     # tiled NetCDF grid
-                    remove(outdir+self.nc_grid['tile'])
+                    remove(directory+self.nc_grid['tile'])
 
-                if path.isfile(outdir+self.nc_grid['datalist']):
-                    # tiled NetCDF grid
-                    remove(outdir+self.nc_grid['datalist'])
+            if path.isfile(workdir+self.nc_grid['datalist']):
+                # tiled NetCDF grid
+                remove(workdir+self.nc_grid['datalist'])
+
+        # Remove unnecessary files
+        if path.isfile(workdir+self.nc_grid['grid']):
+            # original NetCDF grid
+            remove(workdir+self.nc_grid['grid'])
+
+        return status
+
+
+
+
+
+    def grid_info(self, outdir):
+        """Get the size and number of data cells of the cookie cut NetCDF grid
+
+        Positional arguments:
+        outdir -- directory path in which the grid is stored
+
+        Returns:
+        info -- dict with the 'nx', 'ny', 'cells', 'valid_cells', 'zmin', 'zmax', 'zmean' and 'grid_bytes'
+                of the grid, and the 'tile_cells' within the tile's region when known. Empty when the grid does not exist.
+        """
+        import gridio
+
+        outdir = self.__check_dir(outdir)
+        info = dict()
+
+        if path.isfile(outdir+self.nc_grid['tile']):
+            if self.stats:
+                # Statistics computed by cookie_cut()
+                info = dict(self.stats)
+            else:
+                grid = gridio.read_grid(self.tile_grid(outdir))
+                info = gridio.grid_stats(grid['z'])
+                info['ny'], info['nx'] = grid['z'].shape
+            info['grid_bytes'] = path.getsize(outdir+self.nc_grid['tile'])
 
-        return status        
+        return info
 
 
 
@@ -316,21 +633,22 @@ class Basetile(object):
         Positional arguments:
         outdir -- directory path in which to store the grid
         """
+        import gridio
+
         outdir = self.__check_dir(outdir)
         
         if path.isfile(outdir+self.nc_grid['tile']):
             # Convert NetCDF grid to ESRI Grid
-            try:
-                subprocess.check_call(['which', 'gdal_translate'])
-            except subprocess.CalledProcessError:
-                print "\nCould not call gdal_translate! Please make sure GDAL is properly installed\n."
-                exit(-1)
-            else:                
-                subprocess.call(["gdal_translate", "-a_srs", self.metadata['proj4_proj_lcc'], "-of", "EHdr", "-a_nodata", "-99999", outdir+self.nc_grid['tile'], outdir+self.esri_grid['grid']])
-
-                # Remove unnecessary files
-                if path.isfile(outdir+self.esri_grid['xml']):
-                    remove(outdir+self.esri_grid['xml'])
+            grid = gridio.read_grid(self.tile_grid(outdir))
+            gridio.write_ehdr(self.part_name(outdir+self.esri_grid['grid']), \
+                              self.part_name(outdir+self.esri_grid['hdr']), \
+                              self.part_name(outdir+self.esri_grid['prj']), \
+                              grid['z'], grid['x'], grid['y'], self.metadata['esri_wkt_lcc'])
+
+            # Rename the header files first so that a .flt file is never left without its header
+            self.commit_part(outdir+self.esri_grid['hdr'])
+            self.commit_part(outdir+self.esri_grid['prj'])
+            self.commit_part(outdir+self.esri_grid['grid'])
             
         else:
             print "\nError: NetCDF file %s not found!\n" % (self.nc_grid['tile'])
@@ -339,39 +657,170 @@ class Basetile(object):
 
 
 
-    def modify_ps_plot(self, outdir, org_cmd, new_cmd, logo, display=False):
-        """Create a new a c-shell script based in the one generated by MB-System's mb_grdplot command to mix a geographic basemap with a projected grid
+    def make_chunked_grid(self, outdir):
+        """Make a chunked grid store (.zgd) with overviews from the pre-generated NetCDF grid
 
         Positional arguments:
-        outdir -- directory path in which to store the c-shell script
-        org_cmd -- name of the original c-shell script
-        new_cmd -- name of the modified c-shell script
-        logo -- logo to display in the legend
+        outdir -- directory path in which to store the grid
+        """
+        import gridio
+        import gridstore
 
-        Kerword argument:
-        display -- flag to determine if the resulting ps map should be launched upon execution (default: don't display)
+        outdir = self.__check_dir(outdir)
+
+        if path.isfile(outdir+self.nc_grid['tile']):
+            gridstore.write_store(self.part_name(outdir+self.chunked_grid['grid']), gridio.read_grid(self.tile_grid(outdir)))
+            self.commit_part(outdir+self.chunked_grid['grid'])
+        else:
+            print "\nError: NetCDF file %s not found!\n" % (self.nc_grid['tile'])
+            print "Generated a NetCDF grid first running either bathy_grid(), amp_grid() or ss_grid().\n" 
+
+
+
+
+    def plot_template(self, outdir):
+        """Template of the c-shell script of the Postscript maps of the datatype, compiled from the mbm_grdplot
+        script of the first tile plotted and shared by the tiles of the run (see plot_template.py)
+
+        Positional arguments:
+        outdir -- directory path in which the tile products are stored
+
+        Returns:
+        (template, compiled) -- the template, and True when it was compiled from the grid of this tile
         """
-        # This function must be performed by the inheritated class
-        print "Function %s is not implemented in the parent class!\n" % (sys._getframe().f_code.co_name)
-        pass
+        import plot_template
+
+        workdir = self.work_dir(outdir)
+        key = self.__class__.__name__
+        with Basetile.__plot_lock:
+            if key in Basetile.__plot_templates:
+                return (Basetile.__plot_templates[key], False)
+
+            try:
+                subprocess.check_call(['which', 'mbm_grdplot'])
+            except subprocess.CalledProcessError:
+                print "\nCould not call mbm_grdplot! Please make sure MB-Sysem is properly installed\n."
+                exit(-1)
+            else:
+                print "Ploting..."
+                subprocess.call(["mbm_grdplot", "-I", self.tile_grid(outdir), \
+                                 "-O", workdir+self.ps_map['no_ext']] + \
+                                self.plot['options'] + \
+                                ["-MGDANNOT_FONT_PRIMARY/Helvetica-Bold", \
+                                 "-MGDANNOT_FONT_SIZE/0.5c", \
+                                 "-MGDELLIPSOID/WGS-84", \
+                                 "-MGDFRAME_WIDTH/1.25p", \
+                                 "-MGDBASEMAP_TYPE/plain", \
+                                 "-PA", \
+                                 "-V"])
+
+            if not path.isfile(workdir+self.ps_map['shell']):
+                print "\nError: mbm_grdplot script %s not found!\n" % (self.ps_map['shell'])
+                exit(-1)
+            cmd_f = open(workdir+self.ps_map['shell'], 'r')
+            template = plot_template.PlotTemplate(cmd_f.readlines(), self.tile_grid(outdir), workdir+self.ps_map['no_ext'], self.plot)
+            cmd_f.close()
+            remove(workdir+self.ps_map['shell'])
+
+            Basetile.__plot_templates[key] = template
+            return (template, True)
+
 
-            
 
-        
 
-    def make_ps_plot(self, outdir, logo, display=False):
+    def make_ps_plot(self, outdir, logo, psviewer, display='False'):
         """Make a Postscript map from the pre-generated NetCDF grid
 
+        The c-shell script of the map is rendered from the template of the datatype (see plot_template()): only
+        the first tile of a run calls mbm_grdplot.
+
         Keyword arguments:
         outdir -- directory path in which to store the map
         logo -- logo to display in the legend
+        psviewer -- name of the psviewer
 
         Kerword argument:
         display -- flag to determine if the resulting ps map should be launched upon execution (default: don't display)
         """
-        # This function must be performed by the inheritated class
-        print "Function %s is not implemented in the parent class!\n" % (sys._getframe().f_code.co_name)
-        pass
+        import gridio
+
+        outdir = self.__check_dir(outdir)
+        workdir = self.work_dir(outdir)
+        grid = self.tile_grid(outdir)
+
+        if path.isfile(grid):
+            (template, compiled) = self.plot_template(outdir)
+
+            # Values of the tile
+            if self.colors['equalize']:
+                z = gridio.read_grid(grid)['z']
+                (zmin, zmax) = (float(np.nanmin(z)), float(np.nanmax(z)))
+            else:
+                z = None
+                info = self.grid_info(outdir)
+                (zmin, zmax) = (info['zmin'], info['zmax'])
+            region = gridio.grid_header(grid)[:4]
+            if compiled:
+                template.reference(region, zmin, zmax)
+
+            # Page layout of the map and width of the geographic basemap
+            (scale, x_offset, y_offset) = template.layout(region)
+            if (self.metadata['region']['xmin'] >= self.metadata['prim_merd']):
+                # Tile is East of prime meridian
+                xmax = float(self.metadata['region']['lr'][0])
+                xmin = float(self.metadata['region']['ul'][0])
+            elif (self.metadata['region']['xmax'] <= self.metadata['prim_merd']):
+                # Tile is West of prime meridian
+                xmax = float(self.metadata['region']['ur'][0])
+                xmin = float(self.metadata['region']['ll'][0])
+            else:
+                print "\nError: Basetile %s is not well defined with respect to Prime Meridian.\n" % (self.metadata['name'])
+                exit(-1)
+            plot_width = scale * (xmax - xmin)
+
+            # Bring the map up to leave room for the legend
+            y_offset = y_offset + 1
+
+            viewer = "%s %s &" % (psviewer, workdir+self.ps_map['lcc_map'])
+            if display != 'True':
+                viewer = "# "+viewer
+
+            values = {'PS_FILE': self.part_name(workdir+self.ps_map['lcc_map']), \
+                      'CPT_FILE': workdir+self.ps_map['lcc_cpt'], \
+                      'GRID': grid, \
+                      'STEM': workdir+self.ps_map['no_ext'], \
+                      'MAP_SCALE': template.variables['MAP_SCALE'] if compiled else str(scale), \
+                      'MAP_SCALE2': self.metadata['gmt_scale']+str(plot_width), \
+                      'MAP_REGION': template.variables['MAP_REGION'] if compiled else "%.12g/%.12g/%.12g/%.12g" % region, \
+                      'MAP_REGION2': self.metadata['region']['geo'], \
+                      'X_OFFSET': template.variables['X_OFFSET'] if compiled else str(x_offset), \
+                      'Y_OFFSET': str(y_offset), \
+                      'CPT_TABLE': template.cpt_table(zmin, zmax, z), \
+                      'LEGEND_X': str(-1 * x_offset + 0.05), \
+                      'LEGEND_Y': str(-1 * y_offset + 0.05), \
+                      'LOGO': logo, \
+                      'TILENAME': self.metadata['name'], \
+                      'CELLSIZE': "%g" % (float(self.metadata['cellsize'])), \
+                      'VIEWER': viewer}
+            cmd_f = open(workdir+self.ps_map['lcc_shell'], 'w')
+            cmd_f.write(template.render(values))
+            cmd_f.close()
+
+            # Run new script to generate Postscript
+            try:
+                subprocess.check_call(['which', 'csh'])
+            except subprocess.CalledProcessError:
+                print "\nCould not call csh! Please make sure that the c-shell is properly installed\n."
+                exit(-1)
+            else:
+                subprocess.call(["csh", workdir+self.ps_map['lcc_shell']])
+                self.commit_part(workdir+self.ps_map['lcc_map'])
+                # The copy in the scratch workspace is read by make_gif_plot()
+                self.publish(outdir, self.ps_map['lcc_map'], keep=True)
+
+            # Remove unnecessary file
+            if path.isfile(grid+self.__extension['int']):
+                remove(grid+self.__extension['int'])
 
 
 
@@ -384,8 +833,12 @@ class Basetile(object):
         logo -- logo to display in the legend
         """
         outdir = self.__check_dir(outdir)
-        
-        if not(path.isfile(outdir+self.ps_map['lcc_map'])):
+
+        # The Postscript map is read from the scratch workspace when it is there
+        ps_map = self.work_dir(outdir)+self.ps_map['lcc_map']
+        if not path.isfile(ps_map):
+            ps_map = outdir+self.ps_map['lcc_map']
+        if not(path.isfile(ps_map)):
             self.make_ps_map(outdir, logo)
 
         # Call ImageMagik
@@ -394,4 +847,95 @@ class Basetile(object):
         except subprocess.CalledProcessError:
             print "\nCould not call convert! Please make sure ImageMagick is properly installed\n."
         else:
-            subprocess.call(["convert", "-density", "240", "-flatten", outdir+self.ps_map['lcc_map'], outdir+self.gif_map['lcc_map']])
+            subprocess.call(["convert", "-density", "240", "-flatten", ps_map, self.part_name(outdir+self.gif_map['lcc_map'])])
+            self.commit_part(outdir+self.gif_map['lcc_map'])
+
+
+
+
+    def make_quicklook(self, outdir, logo, cpt=None):
+        """Make a quick-look image (.png) of the NetCDF grid, rendered without mbm_grdplot, GMT and ImageMagick
+
+        Keyword arguments:
+        outdir -- directory path in which to store the image
+        logo -- logo (Sun raster) to display in the legend band
+
+        Keyword argument:
+        cpt -- GMT color palette table. Default: a palette spanning the values of the grid (see self.colors)
+        """
+        import gridio
+        import gridstore
+        import quicklook
+
+        outdir = self.__check_dir(outdir)
+
+        if path.isfile(outdir+self.chunked_grid['grid']):
+            # Only the overview of the size of the image is read
+            grid = quicklook.decimate(gridstore.read_preview(outdir+self.chunked_grid['grid'], quicklook.QUICKLOOK_SIZE))
+        elif path.isfile(self.tile_grid(outdir)):
+            grid = quicklook.decimate(gridio.read_grid(self.tile_grid(outdir)))
+        else:
+            print "\nError: NetCDF file %s not found!\n" % (self.nc_grid['tile'])
+            return
+
+        if cpt is None:
+            palette = quicklook.make_cpt(grid['z'], self.colors['palette'], self.colors['flip'], self.colors['equalize'])
+        else:
+            palette = quicklook.read_cpt(cpt)
+
+        shade = None
+        if self.colors['shade'] and grid['x'].size > 1 and grid['y'].size > 1:
+            shade = quicklook.intensity(grid['z'], grid['x'][1] - grid['x'][0], grid['y'][1] - grid['y'][0], 0.5, 270)
+
+        image = None
+        if logo and path.isfile(logo):
+            image = quicklook.read_sun_raster(logo)
+
+        quicklook.write_png(self.part_name(outdir+self.png_map['lcc_map']), quicklook.render(grid, palette, shade, image))
+        self.commit_part(outdir+self.png_map['lcc_map'])
+
+
+
+
+class TileMask(object):
+    """Mask of a basemap tile's region, shared by the products (bathymetry, amplitude, sidescan) of the tile"""
+
+
+
+    def __init__(self, polygon):
+        """Create a new shared tile mask
+
+        Positional arguments:
+        polygon -- list of the (x, y) corners of the tile's polygon in projected coordinates
+        """
+        self.polygon = polygon
+        self.__masks = {}
+        self.__lock = threading.Lock()
+
+
+
+    def inside(self, x, y):
+        """Get the mask matching the nodes of a grid. The mask is rasterized on first use.
+
+        Positional arguments:
+        x -- node x coordinates of the grid
+        y -- node y coordinates of the grid
+
+        Returns:
+        inside -- boolean array (ny, nx), True for the nodes within the tile's polygon
+        """
+        import gridio
+
+        key = (x.size, float(x[0]), float(x[-1]), y.size, float(y[0]), float(y[-1]))
+        with self.__lock:
+            if key not in self.__masks:
+                self.__masks[key] = gridio.polygon_mask(x, y, self.polygon)
+
+            return self.__masks[key]
+
+
+
+    def clean(self):
+        """Release the masks"""
+
+        self.__masks.clear()
@@ -55,16 +55,22 @@ the three fundamental datasets of the Canadian Arctic Mapping program:
     2) 15'x30' maps in Postscript (.ps) format
     3) 15'x30' maps in image (.gif) format
 
-Usage: ${0##*/} -I${bU}datalist${eU} [ -A${bU}datatype${eU} -D -G${bU}gridkind${eU} -H -M${bU}mapkind${eU} -R${bU}west/east/south/north${eU} -V ]
+Usage: ${0##*/} -I${bU}datalist${eU} [ -A${bU}datatype${eU} -C -D -G${bU}gridkind${eU} -H -J${bU}jobs${eU} -M${bU}mapkind${eU} -P -Q${bU}queuedir${eU} -R${bU}west/east/south/north${eU} -T -V -W ]
 
-     -A          Set the datatype to grid
+     -A          Set the datatype(s) to grid, e.g. -A2,3,4 for topography, amplitude and sidescan
+     -C          Continue an interrupted run, skipping the completed tiles
      -D          Print the content of the parameters file
      -G          Set the grid kind
      -H          Display this help and exit
      -I          Datalist containing swath data to grid
+     -J          Grid up to jobs tiles while the maps of the previous tiles are made
      -M          Set the output map kind
+     -P          Plan the run only: list the tiles, data volumes and predicted runtime
+     -Q          Share the tiles with the workers of other hosts through a queue directory
      -R          Set the region of extent
+     -T          Write per-tile stage timings to the surfaces directory
      -V          Apply verbose mode for increased verbosity
+     -W          Update the web tile pyramid of each datatype from the tile catalog
 
 For a detailed description, type: ${bB}man ./basetile_process.1${eB}
 EOF
@@ -77,16 +83,16 @@ EOF
 #
 make_tiles() {
     [ $_VERBOSE -eq 1 ] && printf "Verifying if the datatype is valid...\n"
-    if ! [[ $1 =~ ^[1-4]+$ ]]; then
-	printf "Datatype value A is not in range! Possible values are 1, 2, 3 and 4. Aborting...\n"
+    if ! [[ $1 =~ ^[1-4](,[1-4])*$ ]]; then
+	printf "Datatype value A is not in range! Possible values are 1, 2, 3 and 4, or a comma separated list of them. Aborting...\n"
 	exit 1
     else
 	datatype=$1
     fi
 
     [ $_VERBOSE -eq 1 ] && printf "Verifying if the gridkind is valid...\n"
-    if ! [[ $2 =~ ^[1-2]+$ ]]; then
-	printf "Gridkind value G is not in range! Possible values are 1 and 2. Aborting...\n"
+    if ! [[ $2 =~ ^[1-3]+$ ]]; then
+	printf "Gridkind value G is not in range! Possible values are 1, 2 and 3. Aborting...\n"
 	exit 1
     else
 	gridkind=$2
@@ -101,8 +107,8 @@ make_tiles() {
     fi
 
     [ $_VERBOSE -eq 1 ] && printf "Verifying if the mapkind is valid...\n"
-    if ! [[ $4 =~ ^[1-2]+$ ]]; then
-	printf "Mapkind value M is not in range! Possible values are 1 and 2. Aborting...\n"
+    if ! [[ $4 =~ ^[1-3]+$ ]]; then
+	printf "Mapkind value M is not in range! Possible values are 1, 2 and 3. Aborting...\n"
 	exit 1
     else
 	mapkind=$4
@@ -148,8 +154,47 @@ make_tiles() {
     
     # Call the anbasemap.py python script 
     printf "\n\n%s UTC: Making ArcticNet basemap tiles from MB-System datalist %s...\n" $(date --utc +%Y%m%d-%H%M%S) $3
-    python $DIR_ROOT/anbasemap.py $datalist -D $DIR_SURFACES -- $DATATYPE $GRIDKIND $MAPKIND $REGION $CELLSIZE $psviewer $DISPLAY_PS
+    timing_opt=""
+    if [ $TIMING_FLAG -eq 1 ]; then
+	timing_opt="-T $DIR_SURFACES/basetile_timing_$(date --utc +%Y%m%d-%H%M%S)"
+    fi
+    resume_opt=""
+    if [ $RESUME_FLAG -eq 1 ]; then
+	resume_opt="--resume"
+    fi
+    plan_opt=""
+    if [ $PLAN_FLAG -eq 1 ]; then
+	plan_opt="--plan"
+    fi
+    pipeline_opt=""
+    if [ $PIPELINE -gt 0 ]; then
+	pipeline_opt="--pipeline $PIPELINE"
+    fi
+    queue_opt=""
+    if [ $QUEUE_FLAG -eq 1 ]; then
+	queue_opt="--queue $QUEUE"
+    fi
+    # Intermediate files of the tiles written to a local scratch directory
+    scratch_opt=""
+    if [ -n "$DIR_SCRATCH" ]; then
+	scratch_opt="--scratch $DIR_SCRATCH"
+    fi
+    # Every run records its tiles in the catalog of the surfaces directory
+    catalog_opt="--catalog $DIR_SURFACES/basetile_catalog.sqlite"
+    # Several datatypes are made in a single pass over the tiles
+    products_opt=""
+    if [[ $datatype == *,* ]]; then
+	products_opt="--products $datatype"
+    fi
+    python $DIR_ROOT/anbasemap.py $datalist -D $DIR_SURFACES $timing_opt $resume_opt $plan_opt $pipeline_opt $queue_opt $scratch_opt $catalog_opt $products_opt -- ${datatype%%,*} $GRIDKIND $MAPKIND $REGION $CELLSIZE $psviewer $DISPLAY_PS
     printf "\n\n%s UTC: Done Making ArcticNet basemap tiles.\n" $(date --utc +%Y%m%d-%H%M%S)
+
+    if [ $PYRAMID_FLAG -eq 1 ] && [ $PLAN_FLAG -eq 0 ]; then
+	for dt in ${datatype//,/ }; do
+	    printf "\n\n%s UTC: Updating the web tile pyramid of datatype %s...\n" $(date --utc +%Y%m%d-%H%M%S) $dt
+	    python $DIR_ROOT/tile_pyramid.py $DIR_SURFACES/pyramid_A${dt}_E${CELLSIZE} --catalog $DIR_SURFACES/basetile_catalog.sqlite -A $dt -E $CELLSIZE
+	done
+    fi
 }
 
 #
@@ -187,20 +232,30 @@ source parameters.dat
 DATATYPE=2
 GRIDKIND=1
 MAPKIND=1
+PIPELINE=0
 
 # Command flags
 DATALIST_FLAG=0
 REGION_FLAG=0
 HELP_FLAG=0
+TIMING_FLAG=0
+RESUME_FLAG=0
+PLAN_FLAG=0
+QUEUE_FLAG=0
+PYRAMID_FLAG=0
 
 # Parse the command line
-while getopts  ":A:DG:HI:M:R:V" opt
+while getopts  ":A:CDG:HI:J:M:PQ:R:TVW" opt
 do
     case $opt in
 	A)
 	    # Get the datatype to use
 	    DATATYPE=$OPTARG;
 	    ;;
+	C)
+	    # Continue an interrupted run
+	    RESUME_FLAG=1
+	    ;;
 	D)
 	    # Print the parameters.dat file
 	    print_parameters >&2
@@ -219,19 +274,40 @@ do
 	    DATALIST_FLAG=1
 	    DATALIST=$OPTARG;
 	    ;;
+	J)
+	    # Get the number of tiles gridded concurrently by the pipeline
+	    PIPELINE=$OPTARG;
+	    ;;
 	M)
 	    # Get map kind to generate
 	    MAPKIND=$OPTARG;
 	    ;;
+	P)
+	    # Only plan the run
+	    PLAN_FLAG=1
+	    ;;
+	Q)
+	    # Distribute the tiles through a shared queue directory
+	    QUEUE_FLAG=1
+	    QUEUE=$OPTARG;
+	    ;;
 	R)
 	    # Get the user-specified region of extent
 	    REGION_FLAG=1
 	    REGION=$OPTARG;
 	    ;;
+	T)
+	    # Write the per-tile stage timings
+	    TIMING_FLAG=1
+	    ;;
 	V)
 	    # Enable verbose output mode
 	    _VERBOSE=1
 	    ;;
+	W)
+	    # Update the web tile pyramids
+	    PYRAMID_FLAG=1
+	    ;;
 	\?)
 	    echo "Invalid option: -$OPTARG" >&2
 	    exit 1
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: convert_manifest.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Durable state of the conversion of the Simrad all files into mb59 files
+
+The manifest records, for each Simrad all file, its size, modification time and SHA-1 hash when it was
+converted, the state of its conversion and the files the conversion wrote in the mb59 directory. An update
+converts exactly the files that are new, that changed since their conversion, whose conversion failed or was
+interrupted, or whose mb59 file is missing. A file modified within the settle time is still being written
+by the acquisition software and is left for the next update. The datalists are regenerated from the manifest.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from os import path
+from tile_job import atomic_write
+
+
+MANIFEST = 'mbconvert_manifest.json'
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Block size of the hash of the Simrad all files
+HASH_BLOCK = 1 << 22
+
+
+
+def file_stat(filename):
+    """Size in bytes and modification time of a file"""
+
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime)
+
+
+
+def file_hash(filename):
+    """SHA-1 hash of the content of a file, in hexadecimal"""
+
+    sha1 = hashlib.sha1()
+    f = open(filename, 'rb')
+    block = f.read(HASH_BLOCK)
+    while block:
+        sha1.update(block)
+        block = f.read(HASH_BLOCK)
+    f.close()
+    return sha1.hexdigest()
+
+
+
+class ConvertManifest(object):
+    """State of the conversion of each Simrad all file (running, done or failed) and its outputs"""
+
+
+
+    def __init__(self, dir_all, dir_mb59):
+        """Load the manifest of the mb59 directory, or create a new one
+
+        A new manifest adopts the mb59 files already in the directory, converted before the manifest existed.
+        Their hash is unknown: any change of size or modification time of their Simrad all file converts them again.
+
+        Positional arguments:
+        dir_all -- directory of the Simrad all files
+        dir_mb59 -- directory of the mb59 files, in which the manifest is stored
+        """
+        self.dir_all = dir_all
+        self.dir_mb59 = dir_mb59
+        self.filename = path.join(dir_mb59, MANIFEST)
+        self.state = {'files': {}}
+        # The conversion jobs record their state from several threads
+        self.__lock = threading.RLock()
+
+        if path.isfile(self.filename):
+            f = open(self.filename, 'r')
+            self.state = json.load(f)
+            f.close()
+        elif path.isdir(dir_mb59) and path.isdir(dir_all):
+            names = os.listdir(dir_mb59)
+            for name in [f for f in os.listdir(dir_all) if f.endswith('.all')]:
+                mb59 = path.splitext(name)[0]+'.mb59'
+                if mb59 in names:
+                    (size, mtime) = file_stat(path.join(dir_all, name))
+                    self.state['files'][name] = {'size': size, 'mtime': mtime, 'sha1': None, 'state': DONE, \
+                                                 'outputs': sorted([f for f in names if f.startswith(mb59)]), 'adopted': True}
+
+
+
+    def __changed(self, name, record, size, mtime):
+        """True when a Simrad all file differs from the fingerprint of its record. A file touched only gets its new
+        modification time recorded."""
+
+        if (record['size'], record['mtime']) == (size, mtime):
+            return False
+        # Touched only, or modified: the hash tells
+        if record['sha1'] is None or record['size'] != size or file_hash(path.join(self.dir_all, name)) != record['sha1']:
+            return True
+        record['mtime'] = mtime
+        return False
+
+
+
+    def plan(self, filenames, settle=60.0):
+        """Simrad all files to convert
+
+        Positional argument:
+        filenames -- names of the Simrad all files of the Simrad all directory
+
+        Keyword argument:
+        settle -- time in seconds since their last modification after which the files are complete. Default: 60
+
+        Returns:
+        (todo, busy) -- list of (file name, reason) tuples of the files to convert, and list of the names of
+                        the files still being written
+        """
+        todo = []
+        busy = []
+        now = time.time()
+        with self.__lock:
+            for name in filenames:
+                (size, mtime) = file_stat(path.join(self.dir_all, name))
+                if now - mtime < settle:
+                    busy.append(name)
+                    continue
+
+                record = self.state['files'].get(name)
+                if record is None:
+                    todo.append((name, 'new'))
+                elif record['state'] == RUNNING:
+                    todo.append((name, 'interrupted'))
+                elif self.__changed(name, record, size, mtime):
+                    # A failed file replaced or corrected since its last conversion is changed too
+                    todo.append((name, 'changed'))
+                elif record['state'] != DONE:
+                    todo.append((name, record['state']))
+                elif [f for f in record['outputs'] if not path.isfile(path.join(self.dir_mb59, f))]:
+                    todo.append((name, 'missing output'))
+
+            self.save()
+        return (todo, busy)
+
+
+
+    def start(self, name):
+        """Record the start of the conversion of a Simrad all file
+
+        Positional argument:
+        name -- name of the Simrad all file
+
+        Returns:
+        (size, mtime, sha1) -- fingerprint of the Simrad all file being converted
+        """
+        filename = path.join(self.dir_all, name)
+        (size, mtime) = file_stat(filename)
+        sha1 = file_hash(filename)
+        with self.__lock:
+            record = self.state['files'].setdefault(name, {'outputs': []})
+            record.update({'size': size, 'mtime': mtime, 'sha1': sha1, 'state': RUNNING, \
+                           'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+            record.pop('adopted', None)
+            self.save()
+        return (size, mtime, sha1)
+
+
+
+    def finish(self, name, fingerprint, result):
+        """Record the result of the conversion of a Simrad all file
+
+        A file modified while it was converted is recorded as failed, to be converted again.
+
+        Positional arguments:
+        name -- name of the Simrad all file
+        fingerprint -- (size, mtime, sha1) fingerprint of the file returned by start()
+        result -- result of the conversion (see mbconvert.Converter.convert())
+
+        Returns:
+        state -- recorded state of the conversion, 'done' or 'failed'
+        """
+        state = result['status']
+        message = None
+        if state == DONE and file_stat(path.join(self.dir_all, name)) != fingerprint[:2]:
+            (state, message) = (FAILED, 'modified during the conversion')
+
+        with self.__lock:
+            record = self.state['files'][name]
+            record['state'] = state
+            record['log'] = result['log']
+            record['seconds'] = round(result['seconds'], 3)
+            record['updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            if result['status'] == DONE:
+                record['outputs'] = result['outputs']
+            if message is not None:
+                record['message'] = message
+            elif 'message' in record:
+                del record['message']
+            self.save()
+        return state
+
+
+
+    def sources(self):
+        """Sorted list of the names of the Simrad all files of the manifest"""
+
+        return sorted(self.state['files'].keys())
+
+
+
+    def outputs(self, names=None, suffix='.mb59'):
+        """Sorted list, without duplicates, of the outputs of the converted Simrad all files
+
+        Keyword arguments:
+        names -- names of the Simrad all files. Default: None (all the files of the manifest)
+        suffix -- suffix of the outputs listed. Default: '.mb59'
+
+        Returns:
+        outputs -- names of the outputs, relative to the mb59 directory
+        """
+        if names is None:
+            names = self.state['files'].keys()
+        outputs = set()
+        for name in names:
+            record = self.state['files'].get(name)
+            if record is not None and record['state'] == DONE:
+                outputs.update([f for f in record['outputs'] if f.endswith(suffix)])
+        return sorted(outputs)
+
+
+
+    def files(self, state):
+        """Sorted list of the names of the Simrad all files in a given state ('running', 'done' or 'failed')"""
+
+        return sorted([name for (name, record) in self.state['files'].items() if record['state'] == state])
+
+
+
+    def save(self):
+        """Atomically write the manifest"""
+        with self.__lock:
+            atomic_write(self.filename, json.dumps(self.state, indent=1, sort_keys=True))
+
+
+
+    def __str__(self):
+        """print the number of files in each state"""
+
+        return "Manifest %s: %d converted, %d failed and %d interrupted Simrad all file(s)" \
+            % (self.filename, len(self.files(DONE)), len(self.files(FAILED)), len(self.files(RUNNING)))
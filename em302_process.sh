@@ -37,61 +37,27 @@ _VERBOSE=0
 # merge_edits() $DATALIST $MERGE_OPTION - Merge bathymetry data from .gsf files produced from CARIS HIPS & SIPS with .all files
 #
 merge_edits() {
-    # Create the gsf datalist produced from CARIS HIPS & SIPS
-    [ $_VERBOSE -eq 1 ] && printf "Creating the gsf datalist...\n"
-    ls -1 $DIR_DATA_GSF | grep '.gsf$' | awk '{print $1 " 121 1.000000"}' > $DIR_DATA_GSF/$DATALIST_GSF
-
-    # Compare the listing of .mb59 files and .gsf files
-    [ $_VERBOSE -eq 1 ] && printf "Comparing the .mb59 and .gsf file listing...\n"
-    cat $DIR_DATA_MB59/$1 | awk -F '.' '{print $1}' > mb59_filenames
-    cat $DIR_DATA_GSF/$DATALIST_GSF | awk -F '.' '{print $1}' > gsf_filenames
-    
-    # Identify the common .mb59 and .gsf files and make a filename listing (with no extension)
-    comm -12 mb59_filenames gsf_filenames > mb59_gsf_common 
-    
-    # Identify the missing .gsf files
-    comm -23 mb59_filenames gsf_filenames > gsf_missing
-    if [ -s "gsf_missing" ]
-    then
-	printf "Missing .gsf file(s)! Consider editing in CARIS HIPS & SIPS and exporting a .gsf for the following files:\n"
-	cat gsf_missing | awk '{print $1 ".gsf"}'
-    fi
+    # Merge the .gsf files of the .mb59 files of the datalist in parallel jobs and report the missing .gsf files
+    [ $_VERBOSE -eq 1 ] && printf "Merging the .gsf files in parallel jobs...\n"
+    python $DIR_ROOT/mbmerge.py $DIR_DATA_MB59 $1 $DIR_DATA_GSF $2 -g $DATALIST_GSF $(jobs_option) \
+	|| printf "Warning! The edits of some .gsf files could not be merged. See the logs in %s/mbmerge_logs\n" $DIR_DATA_MB59
+}
 
-    if [ $2 -eq $_MERGE_FULL  ]; then
-	# Create the merge gsf script
-	[ $_VERBOSE -eq 1 ] && printf "Creating the mbcopy script file...\n"
-	touch $MERGE_GSF_SCRIPT | printf "#!/bin/bash\n\n" > $MERGE_GSF_SCRIPT
-	cat mb59_gsf_common | awk -v dir_mb59=$DIR_DATA_MB59 -v dir_gsf=$DIR_DATA_GSF \
-				  '{print "mbcopy -F59/59/121 -I " dir_mb59 "/" $1 ".mb59 -M " dir_gsf "/" $1 ".gsf -O " dir_mb59 "/" $1 "f.mb59\n" \
-                                      "rm " dir_mb59 "/" $1 ".mb59\n" \
-                                      "mv " dir_mb59 "/" $1 "f.mb59 " dir_mb59 "/" $1 ".mb59"}' >> $MERGE_GSF_SCRIPT
-
-	# run the merge gsf script
-	[ $_VERBOSE -eq 1 ] && printf "Running the mbcopy script file...\n"
-	chmod +x $MERGE_GSF_SCRIPT
-	source $MERGE_GSF_SCRIPT
-
-	# Remove the merge gsf script
-	rm $MERGE_GSF_SCRIPT
-	
-    elif [ $2 -eq $_MERGE_PART  ]; then
-	# Create the make esf script
-	[ $_VERBOSE -eq 1 ] && printf "Creating the script to make esf files...\n"
-	touch $MAKE_ESF_SCRIPT | printf "#!/bin/bash\n\n" > $MAKE_ESF_SCRIPT
-	cat mb59_gsf_common | awk -v dir_mb59=$DIR_DATA_MB59 -v dir_gsf=$DIR_DATA_GSF \
-				  '{print "mbgetesf -F121 -I " dir_gsf "/" $1 ".gsf -O " dir_mb59 "/" $1 ".mb59.esf"}' >> $MAKE_ESF_SCRIPT
-
-	# run the make esf script
-	[ $_VERBOSE -eq 1 ] && printf "Running the script to make esf files...\n"
-	chmod +x $MAKE_ESF_SCRIPT
-	source $MAKE_ESF_SCRIPT
-
-	# Remove the make esf script
-	rm $MAKE_ESF_SCRIPT
-    fi
 
-    # Clean up the temporary listings
-    rm mb59_filenames gsf_filenames gsf_missing mb59_gsf_common
+#
+# jobs_option() - Maximum number of parallel jobs set by the parameters
+#
+jobs_option() {
+    [ ! -z "$CONVERT_JOBS" ] && printf -- "--jobs %s " $CONVERT_JOBS
+}
+
+
+#
+# convert_options() - Options of mbconvert.py set by the parameters and the command line
+#
+convert_options() {
+    jobs_option
+    [ $_VERBOSE -eq 1 ] && printf -- "--verbose "
 }
 
 
@@ -107,10 +73,6 @@ convert_all() {
 	exit 1
     fi
     
-    # Create the .all datalist
-    printf "Creating the Simrad all datalist...\n"
-    ls -1 $DIR_DATA_ALL | grep '.all$' | grep -v '9999' | awk '{print $1 " 058 1.000000"}' > $DIR_DATA_ALL/$DATALIST_ALL
-
     # Make sure the .mb59 destination directory exists. If not, create it.
     if [ ! -d $DIR_DATA_MB59 ]; then
 	printf "No directory %s found. Creating it...\n" $DIR_DATA_MB59
@@ -119,17 +81,14 @@ convert_all() {
 	# Check that the directory is empty. If not, clean it.
 	if [[ ! -z $(ls $DIR_DATA_MB59) ]]; then
 	    printf "Cleaning the directory %s to start fresh...\n" $DIR_DATA_MB59
-	    rm $DIR_DATA_MB59/*
+	    rm -r $DIR_DATA_MB59/*
 	fi
     fi
 
-    # Preprocess the Simrad all files and create unprocessed .mb59 files
+    # Preprocess the Simrad all files in parallel jobs, create unprocessed .mb59 files and their datalist
     printf "Running mbkongsbergpreprocess...\n"
-    [ $_VERBOSE -eq 1  ] && mbkongsbergpreprocess -C -F-1 -I $DIR_DATA_ALL/$DATALIST_ALL -D $DIR_DATA_MB59 -V || mbkongsbergpreprocess -C -F-1 -I $DIR_DATA_ALL/$DATALIST_ALL -D $DIR_DATA_MB59
-
-    # Create the datalist for unprocessed mb59 files
-    printf "Creating the mb59 datalist...\n"
-    ls -1 $DIR_DATA_MB59 | grep '.mb59$' | awk '{print $1 " 59 1.000000"}' > $DIR_DATA_MB59/$DATALIST_MB59
+    python $DIR_ROOT/mbconvert.py $DIR_DATA_ALL $DIR_DATA_MB59 -a $DATALIST_ALL -d $DATALIST_MB59 $(convert_options) \
+	|| printf "Warning! Some Simrad all files could not be converted. See the logs in %s/mbconvert_logs\n" $DIR_DATA_MB59
 
     # Merge edits from CARIS HIPS & SIPS if requested
     if [ ! $1 -eq $_MERGE_NONE ]; then
@@ -148,52 +107,22 @@ convert_all() {
 update_all() {
     printf "\n\n%sUTC: Converting new Simrad all files in directory %s\n\n" $(date --utc +%Y%m%d-%H%M%S) $DIR_DATA_ALL
 
-    # Create the .all datalist
-    printf "Creating the Simrad all datalist...\n"
-    ls -1 $DIR_DATA_ALL | grep '.all$' | grep -v '9999' | awk '{print $1 " 058 1.000000"}' > $DIR_DATA_ALL/$DATALIST_ALL
-
-    # Make sure the .mb59 destination directory exists. If not, abort. If yes, create the .mb59 datalist
+    # Make sure the .mb59 destination directory exists. If not, abort.
     if [ ! -d $DIR_DATA_MB59 ]; then
 	printf "No directory %s found! Consider running the -C option instead. Aborting...\n" $DIR_DATA_MB59
     else
-	# Compare the listing of Simrad all files and mb59 files
-	[ $_VERBOSE -eq 1 ] && printf "Comparing the Simrad all and mb59 file listing...\n"
-	cat $DIR_DATA_ALL/$DATALIST_ALL | awk -F '.' '{print $1}' > all_filenames
-	cat $DIR_DATA_MB59/$DATALIST_MB59 | awk -F '.' '{print $1}' > mb59_filenames
-
-	# Identify the missing .mb59 files
-	comm -23 --nocheck-order all_filenames mb59_filenames > mb59_missing
-	printf "The following Simrad all files have not been converted:\n"
-	cat mb59_missing | awk '{print $1 ".all"}'
-	printf "They will now be processed.\n"
-	
-	# Create a temporary .all update datalist
-	printf "Creating the temporary update .all datalist...\n"
-	cat mb59_missing | awk '{print $1 ".all 58 1.000000"}' > $DIR_DATA_ALL/$DATALIST_UPDATE_ALL
-
-	# Preprocess the .all files and create unprocessed .mb59 files
-	printf "Running mbkongsbergpreprocess..."
-	mbkongsbergpreprocess -C -F-1 -I $DIR_DATA_ALL/$DATALIST_UPDATE_ALL -D $DIR_DATA_MB59
-
-	# Create a temporary datalist for unprocessed .mb59
-	printf "Creating the temporary update .mb59 datalist...\n"
-	cat mb59_missing | awk '{print $1 ".mb59 59 1.000000"}' > $DIR_DATA_MB59/$DATALIST_UPDATE_MB59
-
-	# Clean up
-	rm all_filenames mb59_filenames mb59_missing
+	# Preprocess the new, changed and failed Simrad all files of the conversion manifest in parallel jobs
+	# and regenerate the .mb59 datalists from the manifest
+	printf "Running mbkongsbergpreprocess...\n"
+	python $DIR_ROOT/mbconvert.py $DIR_DATA_ALL $DIR_DATA_MB59 --update -a $DATALIST_ALL -d $DATALIST_MB59 -n $DATALIST_UPDATE_MB59 $(convert_options) \
+	    || printf "Warning! Some Simrad all files could not be converted. See the logs in %s/mbconvert_logs\n" $DIR_DATA_MB59
 
 	# Merge edits from CARIS HIPS & SIPS
 	merge_edits $DATALIST_UPDATE_MB59 $1
 
-	# Update the unprocessed .mb59 datalist
-	ls -1 $DIR_DATA_MB59/$DATALIST_MB59 $DIR_DATA_MB59/$DATALIST_UPDATE_MB59 | xargs cat >> $DIR_DATA_MB59/$DATALIST_MB59
-
-	# Remove the update .all and .mb59 datalists
-	rm $DIR_DATA_ALL/$DATALIST_UPDATE_ALL
+	# Remove the update .mb59 datalist
 	rm $DIR_DATA_MB59/$DATALIST_UPDATE_MB59
     fi
-
-    
 }
 
 
@@ -202,35 +131,43 @@ update_all() {
 #
 process_mb59() {
     printf "\n\n%s UTC: Processing the mb59 files in the %s MB-System datalist.\n\n" $(date --utc +%Y%m%d-%H%M%S) $DIR_DATA_MB59/$DATALIST_MB59
-    
-    # Apply the bathymetric edits
-    [ $_VERBOSE -eq 1 ] && printf "Applying bathymetric edits...\n"
-    cat $DIR_DATA_MB59/$DATALIST_MB59 | awk -F '.' '{print $1}' > mb59_filenames
-    touch mbset.sh | printf "#!/bin/bash\n\n" > mbset.sh
-    cat mb59_filenames | awk -v dir_mb59=$DIR_DATA_MB59 '{print "mbset -PEDITSAVEMODE:1 -PEDITSAVEFILE:" dir_mb59 "/" $1 ".mb59.esf -I " dir_mb59 "/" $1 ".mb59"}' >> mbset.sh
-    chmod +x mbset.sh
-    source mbset.sh
-    
-    # Apply the tide
-    # TO BE COMPLETED
-    
-    # Process the mb59 files and create processed mb59 files
+
+    # Apply the bathymetric edits and create processed mb59 files in parallel jobs, for the out of date files only.
+    # The processed mb59 datalist is only written once all the files are processed.
     [ $_VERBOSE -eq 1 ] && printf "Creating processed mb59 files...\n"
-    mbprocess -I $DIR_DATA_MB59/$DATALIST_MB59
-   
-    # Create the mb59 datalist of processed mb59 files
-    [ $_VERBOSE -eq 1 ] && printf "Creating the processed mb59 datalist...\n"
-    printf "\$PROCESSED\n%s\n" $DATALIST_MB59 > $DIR_DATA_MB59/$DATALISTP_MB59
-
-    # Cleanup
-    rm mbset.sh
-    rm mb59_filenames
+    python $DIR_ROOT/process_mb59.py $DIR_DATA_MB59 $DATALIST_MB59 -p $DATALISTP_MB59 $(jobs_option) \
+	|| printf "Warning! Some mb59 files could not be processed. See the logs in %s/mbprocess_logs\n" $DIR_DATA_MB59
 }
 
 
 
 
 
+#
+# ingest_daemon() $MERGE_OPTION $REGION - Watch for new .all files and bring them into the basemap tiles of the region
+#
+ingest_daemon() {
+    printf "\n\n%s UTC: Watching the Simrad all files in directory %s\n\n" $(date --utc +%Y%m%d-%H%M%S) $DIR_DATA_ALL
+
+    # Make sure the .mb59 destination directory exists. If not, create it.
+    if [ ! -d $DIR_DATA_MB59 ]; then
+	printf "No directory %s found. Creating it...\n" $DIR_DATA_MB59
+	mkdir $DIR_DATA_MB59
+    fi
+
+    merge_opt=""
+    if [ ! $1 -eq $_MERGE_NONE ]; then
+	merge_opt="--gsf $DIR_DATA_GSF --merge $1"
+    fi
+    tile_opt="--catalog $DIR_SURFACES/basetile_catalog.sqlite"
+    if [ -n "$DIR_SCRATCH" ]; then
+	tile_opt="$tile_opt --scratch $DIR_SCRATCH"
+    fi
+    python $DIR_ROOT/ingest_daemon.py -d $DATALIST_MB59 -p $DATALISTP_MB59 $merge_opt $(jobs_option) --tile-options="$tile_opt" \
+	   -- $DIR_DATA_ALL $DIR_DATA_MB59 $DIR_SURFACES $2 $CELLSIZE
+}
+
+
 #
 # em302_process_help() - Display some basic help about em302_process
 #
@@ -249,7 +186,7 @@ collected by the Canadian ice-breaker CCGS Amundsen. em302_process is a front-en
 When run, em302_process will create processed mb59 files containing both bathymetry and backscatter
 data. The bathymetry data can be merged from an external gsf file produced by a third-party software.
 
-Usage: ./${0##*/} [-C -D -H -M${bU}mode${eU} -P -U -V]
+Usage: ./${0##*/} [-C -D -H -M${bU}mode${eU} -P -U -V -W${bU}region${eU}]
 
      -C          Convert all Simrad all files
      -D          Print the content of the parameters file
@@ -258,6 +195,7 @@ Usage: ./${0##*/} [-C -D -H -M${bU}mode${eU} -P -U -V]
      -P          Process bathymetry
      -U          Update all unconverted Simrad all files
      -V          Apply verbose mode for increased verbosity
+     -W          Watch for new Simrad all files and update the basemap tiles of the region
 
 For a detailed description, type: ${bB}man ./em302_process.1${eB}
 EOF
@@ -304,9 +242,10 @@ merge_arg=0
 convert_all_flag=0
 process_mb59_flag=0
 update_flag=0
+watch_flag=0
 
 # Parse the command line
-while getopts  ":CDHM:PUV" opt
+while getopts  ":CDHM:PUVW:" opt
 do
     case $opt in
 	C)
@@ -338,6 +277,11 @@ do
 	    # Enable verbose output mode
 	    _VERBOSE=1
 	    ;;
+	W)
+	    # Watch for new Simrad all files and update the basemap tiles of the region
+	    watch_flag=1;
+	    watch_region=$OPTARG;
+	    ;;
 	\?)
 	    echo "Invalid option: -$OPTARG" >&2
 	    exit 1
@@ -366,4 +310,9 @@ else
 	# Process all modified mb59 files
 	process_mb59
     fi    
+
+    if [ $watch_flag -eq 1 ]; then
+	# Run the ingest daemon until interrupted
+	ingest_daemon $merge_arg $watch_region
+    fi
 fi
@@ -77,3 +77,74 @@ def decdeg2dms_hem(dd, coord):
 
     return (degrees_abs, minutes, seconds, hem)
     
+
+
+
+def round_bounds(x, base=0.5, direction='up'):
+    """Round a floating point value up or down according to base
+
+    Keyword arguments:
+    x -- number to round
+    base -- base to which to round. Default 0.5.
+    direction -- round up or down depending on value. Default up.
+    """
+    import math as m
+
+    if direction == 'up':
+        return base * m.ceil(float(x) / base)
+    elif direction == 'down':
+        return base * m.floor(float(x) / base)
+
+
+
+def basemap_tilename(x, y):
+    """Name of the basemap tile with the given upper-left corner
+
+    Keyword arguments:
+    x -- longitude of the upper-left corner in decimal degrees
+    y -- latitude of the upper-left corner in decimal degrees
+
+    Returns:
+    tilename -- name of the tile in the DD_MM_H_DDD_MM_H format
+    """
+    yd, ym, ys, yh = decdeg2dms_hem(y, 'lat')
+    xd, xm, xs, xh = decdeg2dms_hem(x, 'lon')
+    return "%.2d_%.2d_%c_%.2d_%.2d_%c" % (yd, ym, yh, xd, xm, xh)
+
+
+
+def basemap_lattice(region, lon_step=0.5, lat_step=0.25):
+    """List the basemap tiles covering a region, from the top-left corner
+
+    Keyword arguments:
+    region -- region in the west/east/south/north format
+    lon_step -- longitude extent of a tile in decimal degrees. Default 0.5.
+    lat_step -- latitude extent of a tile in decimal degrees. Default 0.25.
+
+    Returns:
+    tiles -- list of (tilename, tile region) tuples, the tile region being in the west/east/south/north format
+    """
+    import numpy as np
+
+    (xmin_true, xmax_true, ymin_true, ymax_true) = region.split('/')[0:4]
+
+    # Compute the bounds for the basemap tiles
+    xmin_tile = round_bounds(xmin_true, lon_step, 'down')
+    xmax_tile = round_bounds(xmax_true, lon_step, 'up')
+    ymin_tile = round_bounds(ymin_true, lat_step, 'down')
+    ymax_tile = round_bounds(ymax_true, lat_step, 'up')
+
+    # Create the loop lists
+    xsteps = int(round((xmax_tile - xmin_tile) / lon_step))
+    ysteps = int(round((ymax_tile - ymin_tile) / lat_step))
+    lon = np.linspace(xmin_tile, xmax_tile, num=xsteps, endpoint=False)
+    lat = np.linspace(ymax_tile, ymin_tile, num=ysteps, endpoint=False)
+
+    tiles = []
+    for y in lat:
+        for x in lon:
+            tilename = basemap_tilename(x, y)
+            tile_region = "%.1f/%.1f/%.2f/%.2f" % (x, x+lon_step, y-lat_step, y)
+            tiles.append((tilename, tile_region))
+
+    return tiles
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: gridder.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+In-process gridding engine of projected soundings, an alternative to mbgrid and mbmosaic
+
+The soundings are binned to the nearest node of the grid and each node gets the weighted mean or the weighted
+median of its soundings. Backscatter samples are mosaicked instead: each node gets the priority weighted mean
+of its samples whose priority is within a range of the highest one, the priority following from the grazing
+angle of the samples. The small gaps of the grid are then filled with the inverse distance weighted mean
+of the nodes around them, as mbgrid -C<clip>/<mode> does without its spline interpolation.
+"""
+
+import numpy as np
+
+
+METHODS = ['mean', 'median', 'mosaic']
+
+# Priority of the backscatter samples as a function of their flat bottom grazing angle in degrees: the specular
+# samples near nadir and the samples of the far outer swath are the least reliable
+GRAZING_ANGLES = [0.0, 10.0, 20.0, 60.0, 75.0, 90.0]
+GRAZING_PRIORITIES = [0.0, 0.2, 1.0, 1.0, 0.5, 0.1]
+
+# Range of the priorities averaged in a node below the highest one (mbmosaic -F)
+PRIORITY_RANGE = 0.05
+
+
+
+def grid_lattice(polygon, cellsize):
+    """Nodes of the grid covering a polygon, on the lattice of the multiples of the cellsize
+
+    Keyword arguments:
+    polygon -- list of the (x, y) corners of the polygon in projected coordinates
+    cellsize -- the spatial resolution of the grid
+
+    Returns:
+    (xmin, ymin, nx, ny) -- coordinates of the lower left node and number of nodes along x and y
+    """
+    x = [corner[0] for corner in polygon]
+    y = [corner[1] for corner in polygon]
+    (i0, i1) = (int(np.floor(min(x) / cellsize)), int(np.ceil(max(x) / cellsize)))
+    (j0, j1) = (int(np.floor(min(y) / cellsize)), int(np.ceil(max(y) / cellsize)))
+    return (i0 * cellsize, j0 * cellsize, i1 - i0 + 1, j1 - j0 + 1)
+
+
+
+class GridAccumulator(object):
+    """Soundings binned to the nodes of a grid, added chunk by chunk"""
+
+
+
+    def __init__(self, xmin, ymin, nx, ny, cellsize, method='mean'):
+        """Create a new, empty, grid accumulator
+
+        Positional arguments:
+        xmin -- x coordinate of the lower left node
+        ymin -- y coordinate of the lower left node
+        nx -- number of nodes along x
+        ny -- number of nodes along y
+        cellsize -- the spatial resolution of the grid
+
+        Keyword argument:
+        method -- 'mean' for the weighted mean of the soundings of each node, 'median' for their weighted median. Default: 'mean'
+        """
+        if method not in ['mean', 'median']:
+            raise ValueError("unknown gridding method %s" % (method))
+
+        self.xmin = xmin
+        self.ymin = ymin
+        self.nx = nx
+        self.ny = ny
+        self.cellsize = float(cellsize)
+        self.method = method
+        self.soundings = 0
+
+        if method == 'mean':
+            self.__sum = np.zeros(nx * ny)
+            self.__weight = np.zeros(nx * ny)
+        else:
+            # The median needs all the soundings of the nodes
+            self.__chunks = []
+
+
+
+    def x(self):
+        """Node x coordinates of the grid"""
+
+        return self.xmin + np.arange(self.nx) * self.cellsize
+
+
+
+    def y(self):
+        """Node y coordinates of the grid"""
+
+        return self.ymin + np.arange(self.ny) * self.cellsize
+
+
+
+    def add(self, x, y, z, weight=None):
+        """Add soundings to the grid. Soundings outside of the grid or without value are ignored.
+
+        Positional arguments:
+        x -- array of the projected x coordinates of the soundings
+        y -- array of the projected y coordinates of the soundings
+        z -- array of the values of the soundings
+
+        Keyword argument:
+        weight -- array of the weights of the soundings. Default: 1 for all
+        """
+        column = np.floor((np.asarray(x) - self.xmin) / self.cellsize + 0.5)
+        row = np.floor((np.asarray(y) - self.ymin) / self.cellsize + 0.5)
+        z = np.asarray(z, dtype=np.float64)
+        keep = (column >= 0) & (column < self.nx) & (row >= 0) & (row < self.ny) & np.isfinite(z)
+        if weight is None:
+            weight = np.ones(z.shape)
+        else:
+            weight = np.asarray(weight, dtype=np.float64)
+            keep &= np.isfinite(weight) & (weight > 0)
+
+        node = (row[keep] * self.nx + column[keep]).astype(np.int64)
+        (z, weight) = (z[keep], weight[keep])
+        self.soundings += node.size
+        if self.method == 'mean':
+            self.__sum += np.bincount(node, weight * z, self.nx * self.ny)
+            self.__weight += np.bincount(node, weight, self.nx * self.ny)
+        else:
+            self.__chunks.append((node, z.astype(np.float32), weight.astype(np.float32)))
+
+
+
+    def result(self):
+        """Value of the nodes of the grid
+
+        Returns:
+        z -- grid array (ny, nx) in rows of increasing y, with NaN for the nodes without soundings
+        """
+        z = np.empty(self.nx * self.ny, dtype=np.float32)
+        z[:] = np.nan
+        if self.method == 'mean':
+            valid = self.__weight > 0
+            z[valid] = self.__sum[valid] / self.__weight[valid]
+        elif self.__chunks:
+            node = np.concatenate([chunk[0] for chunk in self.__chunks])
+            values = np.concatenate([chunk[1] for chunk in self.__chunks])
+            weight = np.concatenate([chunk[2] for chunk in self.__chunks]).astype(np.float64)
+
+            # Weighted median: the first sounding of each node, sorted by value, reaching half of the node's weight
+            order = np.lexsort((values, node))
+            (node, values, cumulative) = (node[order], values[order], np.cumsum(weight[order]))
+            nodes = np.unique(node)
+            first = np.searchsorted(node, nodes)
+            total = np.bincount(node, weight[order])[nodes]
+            before = np.where(first > 0, cumulative[np.maximum(first - 1, 0)], 0.0)
+            median = np.searchsorted(cumulative, before + 0.5 * total)
+            z[nodes] = values[np.minimum(median, first + np.bincount(node)[nodes] - 1)]
+
+        return z.reshape(self.ny, self.nx)
+
+
+
+def grazing_priority(grazing):
+    """Priority of backscatter samples from their grazing angle (see GRAZING_ANGLES and GRAZING_PRIORITIES)
+
+    Keyword argument:
+    grazing -- array of the flat bottom grazing angles in degrees
+
+    Returns:
+    priority -- array of the priorities between 0 and 1
+    """
+    return np.interp(np.abs(grazing), GRAZING_ANGLES, GRAZING_PRIORITIES)
+
+
+
+class MosaicAccumulator(object):
+    """Backscatter samples binned to the nodes of a grid, mosaicked like mbmosaic -F<priority range>"""
+
+
+
+    def __init__(self, xmin, ymin, nx, ny, cellsize, priority_range=PRIORITY_RANGE):
+        """Create a new, empty, mosaic accumulator
+
+        Positional arguments:
+        xmin -- x coordinate of the lower left node
+        ymin -- y coordinate of the lower left node
+        nx -- number of nodes along x
+        ny -- number of nodes along y
+        cellsize -- the spatial resolution of the grid
+
+        Keyword argument:
+        priority_range -- samples whose priority is within this range of the highest priority of their node are averaged. Default: PRIORITY_RANGE
+        """
+        self.xmin = xmin
+        self.ymin = ymin
+        self.nx = nx
+        self.ny = ny
+        self.cellsize = float(cellsize)
+        self.method = 'mosaic'
+        self.priority_range = priority_range
+        self.soundings = 0
+        # The highest priority of a node is only known once all its samples are added
+        self.__chunks = []
+
+
+
+    def x(self):
+        """Node x coordinates of the grid"""
+
+        return self.xmin + np.arange(self.nx) * self.cellsize
+
+
+
+    def y(self):
+        """Node y coordinates of the grid"""
+
+        return self.ymin + np.arange(self.ny) * self.cellsize
+
+
+
+    def add(self, x, y, z, grazing=None, priority=None):
+        """Add backscatter samples to the grid. Samples outside of the grid, without value or without priority are ignored.
+
+        Positional arguments:
+        x -- array of the projected x coordinates of the samples
+        y -- array of the projected y coordinates of the samples
+        z -- array of the backscatter values of the samples
+
+        Keyword arguments:
+        grazing -- array of the grazing angles of the samples in degrees, giving their priority (see grazing_priority())
+        priority -- array of the priorities of the samples, overriding the grazing angles. Default: 1 for all when neither is given
+        """
+        column = np.floor((np.asarray(x) - self.xmin) / self.cellsize + 0.5)
+        row = np.floor((np.asarray(y) - self.ymin) / self.cellsize + 0.5)
+        z = np.asarray(z, dtype=np.float64)
+        if priority is None:
+            if grazing is None:
+                priority = np.ones(z.shape)
+            else:
+                priority = grazing_priority(np.asarray(grazing, dtype=np.float64))
+        priority = np.asarray(priority, dtype=np.float64)
+        keep = (column >= 0) & (column < self.nx) & (row >= 0) & (row < self.ny) & np.isfinite(z) & (priority > 0)
+
+        node = (row[keep] * self.nx + column[keep]).astype(np.int64)
+        self.soundings += node.size
+        self.__chunks.append((node, z[keep].astype(np.float32), priority[keep].astype(np.float32)))
+
+
+
+    def result(self):
+        """Value of the nodes of the mosaic
+
+        Returns:
+        z -- grid array (ny, nx) in rows of increasing y, with NaN for the nodes without samples
+        """
+        z = np.empty(self.nx * self.ny, dtype=np.float32)
+        z[:] = np.nan
+        if not self.__chunks:
+            return z.reshape(self.ny, self.nx)
+
+        node = np.concatenate([chunk[0] for chunk in self.__chunks])
+        values = np.concatenate([chunk[1] for chunk in self.__chunks]).astype(np.float64)
+        priority = np.concatenate([chunk[2] for chunk in self.__chunks]).astype(np.float64)
+
+        # Highest priority of each node: the last sample of the node once sorted by priority
+        order = np.lexsort((priority, node))
+        (nodes, first) = np.unique(node[order], return_index=True)
+        last = np.append(first[1:], node.size) - 1
+        highest = np.zeros(self.nx * self.ny)
+        highest[nodes] = priority[order][last]
+
+        # Priority weighted mean of the samples within the priority range
+        keep = priority >= highest[node] - self.priority_range
+        total = np.bincount(node[keep], priority[keep] * values[keep], self.nx * self.ny)
+        weight = np.bincount(node[keep], priority[keep], self.nx * self.ny)
+        z[nodes] = total[nodes] / weight[nodes]
+
+        return z.reshape(self.ny, self.nx)
+
+
+
+def fill_gaps(z, clip=2, mode=2):
+    """Fill the small gaps of a grid with the inverse distance weighted mean of the nodes around them
+
+    Keyword arguments:
+    z -- grid array with NaN for the nodes without data
+    clip -- largest distance, in nodes, between a filled node and the data used. 0 fills nothing. Default: 2
+    mode -- 1 fills the nodes with data within the clip distance in any direction. 2 only fills the gaps
+            bounded by data: the nodes with data within the clip distance on both sides along a row, a column or
+            a diagonal. Default: 2
+
+    Returns:
+    z -- grid array with the gaps filled
+    """
+    if clip <= 0:
+        return z
+
+    (ny, nx) = z.shape
+    padded = np.empty((ny + 2 * clip, nx + 2 * clip), dtype=np.float64)
+    padded[:] = np.nan
+    padded[clip:clip+ny, clip:clip+nx] = z
+    valid = np.isfinite(padded)
+    values = np.where(valid, padded, 0.0)
+
+    def shifted(array, dx, dy):
+        return array[clip+dy:clip+dy+ny, clip+dx:clip+dx+nx]
+
+    total = np.zeros((ny, nx))
+    weights = np.zeros((ny, nx))
+    for dy in range(-clip, clip + 1):
+        for dx in range(-clip, clip + 1):
+            if dx == 0 and dy == 0:
+                continue
+            weight = 1.0 / (dx * dx + dy * dy)
+            total += weight * shifted(values, dx, dy)
+            weights += weight * shifted(valid, dx, dy)
+
+    gaps = ~np.isfinite(z) & (weights > 0)
+    if mode == 2:
+        bounded = np.zeros((ny, nx), dtype=bool)
+        for (dx, dy) in [(1, 0), (0, 1), (1, 1), (1, -1)]:
+            ahead = np.zeros((ny, nx), dtype=bool)
+            behind = np.zeros((ny, nx), dtype=bool)
+            for k in range(1, clip + 1):
+                ahead |= shifted(valid, k * dx, k * dy)
+                behind |= shifted(valid, -k * dx, -k * dy)
+            bounded |= ahead & behind
+        gaps &= bounded
+
+    filled = np.array(z, dtype=np.float32)
+    filled[gaps] = total[gaps] / weights[gaps]
+    return filled
+
+
+
+def grid_soundings(x, y, z, xmin, ymin, nx, ny, cellsize, weight=None, method='mean', clip=2, mode=2):
+    """Grid soundings in a single call
+
+    Keyword arguments:
+    x, y, z -- arrays of the projected coordinates and values of the soundings
+    xmin, ymin -- coordinates of the lower left node
+    nx, ny -- number of nodes along x and y
+    cellsize -- the spatial resolution of the grid
+    weight -- array of the weights of the soundings, or of the priorities of the samples of a mosaic. Default: 1 for all
+    method -- 'mean' or 'median' (see GridAccumulator), or 'mosaic' (see MosaicAccumulator). Default: 'mean'
+    clip -- clip distance of the gap filling in nodes (see fill_gaps()). Default: 2
+    mode -- gap filling mode (see fill_gaps()). Default: 2
+
+    Returns:
+    z -- grid array (ny, nx) in rows of increasing y, with NaN for the nodes without data
+    """
+    if method == 'mosaic':
+        accumulator = MosaicAccumulator(xmin, ymin, nx, ny, cellsize)
+        accumulator.add(x, y, z, priority=weight)
+    else:
+        accumulator = GridAccumulator(xmin, ymin, nx, ny, cellsize, method)
+        accumulator.add(x, y, z, weight)
+    return fill_gaps(accumulator.result(), clip, mode)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: gridio.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Read GMT NetCDF grids (as produced by mbgrid, mbmosaic and grdmath) into numpy arrays
+"""
+
+import numpy as np
+
+
+def read_grid(filename):
+    """Read a GMT NetCDF grid
+
+    Both the COARDS compliant layout (x, y and z variables) and the old GMT layout (x_range, y_range,
+    spacing, dimension and flattened z variables) are supported.
+
+    Keyword arguments:
+    filename -- path to the GMT NetCDF grid
+
+    Returns:
+    grid -- dict with the 'x' and 'y' node coordinates, the 'z' array (ny, nx) with NaN for empty
+            cells, in rows of increasing y, and the 'node_offset' (0 = gridline, 1 = pixel registration)
+    """
+    import netCDF4
+
+    grid = dict()
+    nc = netCDF4.Dataset(filename, 'r')
+    try:
+        nc.set_auto_mask(False)
+        if 'x_range' in nc.variables:
+            # Old GMT layout: z is flattened and stored from the top row down
+            (nx, ny) = [int(n) for n in nc.variables['dimension'][:]]
+            (dx, dy) = [float(d) for d in nc.variables['spacing'][:]]
+            x_range = nc.variables['x_range'][:]
+            y_range = nc.variables['y_range'][:]
+            grid['node_offset'] = int(getattr(nc.variables['z'], 'node_offset', 0))
+            shift = 0.5 * grid['node_offset']
+            grid['x'] = x_range[0] + (np.arange(nx) + shift) * dx
+            grid['y'] = y_range[0] + (np.arange(ny) + shift) * dy
+            z = nc.variables['z'][:].reshape(ny, nx)[::-1]
+        else:
+            # COARDS layout: z(y, x) with increasing y
+            grid['x'] = np.asarray(nc.variables['x'][:], dtype=np.float64)
+            grid['y'] = np.asarray(nc.variables['y'][:], dtype=np.float64)
+            grid['node_offset'] = int(getattr(nc, 'node_offset', 0))
+            z = nc.variables['z'][:]
+            if (grid['y'].size > 1) and (grid['y'][0] > grid['y'][-1]):
+                grid['y'] = grid['y'][::-1]
+                z = z[::-1]
+
+        z = np.array(z, dtype=np.float32)
+        fill = getattr(nc.variables['z'], '_FillValue', None)
+        if fill is not None and not np.isnan(fill):
+            z[z == fill] = np.nan
+        grid['z'] = z
+    finally:
+        nc.close()
+
+    return grid
+
+
+
+def read_window(filename, xmin, xmax, ymin, ymax):
+    """Read the nodes of a GMT NetCDF grid inside a window, without reading the rest of the grid
+
+    Keyword arguments:
+    filename -- path to the GMT NetCDF grid
+    xmin, xmax, ymin, ymax -- limits of the window in the grid coordinates
+
+    Returns:
+    grid -- dict like read_grid() with the nodes inside the window. None when no node is inside the window.
+    """
+    import netCDF4
+
+    grid = dict()
+    nc = netCDF4.Dataset(filename, 'r')
+    try:
+        nc.set_auto_mask(False)
+        if 'x_range' in nc.variables:
+            (nx, ny) = [int(n) for n in nc.variables['dimension'][:]]
+            (dx, dy) = [float(d) for d in nc.variables['spacing'][:]]
+            grid['node_offset'] = int(getattr(nc.variables['z'], 'node_offset', 0))
+            shift = 0.5 * grid['node_offset']
+            x = nc.variables['x_range'][0] + (np.arange(nx) + shift) * dx
+            y = nc.variables['y_range'][0] + (np.arange(ny) + shift) * dy
+        else:
+            x = np.asarray(nc.variables['x'][:], dtype=np.float64)
+            y = np.asarray(nc.variables['y'][:], dtype=np.float64)
+            grid['node_offset'] = int(getattr(nc, 'node_offset', 0))
+
+        columns = np.nonzero((x >= xmin) & (x <= xmax))[0]
+        rows = np.nonzero((y >= ymin) & (y <= ymax))[0]
+        if columns.size == 0 or rows.size == 0:
+            return None
+        (i0, i1, j0, j1) = (columns[0], columns[-1] + 1, rows[0], rows[-1] + 1)
+        grid['x'] = x[i0:i1]
+        grid['y'] = y[j0:j1]
+
+        if 'x_range' in nc.variables:
+            # Old GMT layout: the rows of the window are contiguous in the flattened z, from the top row down
+            (top, bottom) = (ny - j1, ny - j0)
+            z = nc.variables['z'][top*nx:bottom*nx].reshape(bottom - top, nx)[::-1, i0:i1]
+        else:
+            z = nc.variables['z'][j0:j1, i0:i1]
+            if grid['y'].size > 1 and grid['y'][0] > grid['y'][-1]:
+                grid['y'] = grid['y'][::-1]
+                z = z[::-1]
+
+        z = np.array(z, dtype=np.float32)
+        fill = getattr(nc.variables['z'], '_FillValue', None)
+        if fill is not None and not np.isnan(fill):
+            z[z == fill] = np.nan
+        grid['z'] = z
+    finally:
+        nc.close()
+
+    return grid
+
+
+
+def grid_header(filename):
+    """Read the extent and size of a GMT NetCDF grid without reading its data
+
+    Keyword arguments:
+    filename -- path to the GMT NetCDF grid
+
+    Returns:
+    header -- (xmin, xmax, ymin, ymax, nx, ny) tuple of the node coordinates
+    """
+    import netCDF4
+
+    nc = netCDF4.Dataset(filename, 'r')
+    try:
+        if 'x_range' in nc.variables:
+            (nx, ny) = [int(n) for n in nc.variables['dimension'][:]]
+            (xmin, xmax) = [float(v) for v in nc.variables['x_range'][:]]
+            (ymin, ymax) = [float(v) for v in nc.variables['y_range'][:]]
+        else:
+            x = nc.variables['x'][:]
+            y = nc.variables['y'][:]
+            (nx, ny) = (len(x), len(y))
+            (xmin, xmax) = (float(min(x[0], x[-1])), float(max(x[0], x[-1])))
+            (ymin, ymax) = (float(min(y[0], y[-1])), float(max(y[0], y[-1])))
+    finally:
+        nc.close()
+
+    return (xmin, xmax, ymin, ymax, nx, ny)
+
+
+
+def grid_stats(z):
+    """Compute the summary statistics of a grid array
+
+    Keyword arguments:
+    z -- grid array with NaN for empty cells
+
+    Returns:
+    stats -- dict with the number of 'cells', the number of 'valid_cells' and the 'zmin', 'zmax' and 'zmean' of the valid cells
+    """
+    valid = np.isfinite(z)
+    stats = dict()
+    stats['cells'] = int(z.size)
+    stats['valid_cells'] = int(np.count_nonzero(valid))
+    if stats['valid_cells'] > 0:
+        values = z[valid]
+        stats['zmin'] = float(values.min())
+        stats['zmax'] = float(values.max())
+        stats['zmean'] = float(values.mean(dtype=np.float64))
+    else:
+        stats['zmin'] = None
+        stats['zmax'] = None
+        stats['zmean'] = None
+
+    return stats
+
+
+
+def polygon_mask(x, y, polygon):
+    """Rasterize a polygon on the nodes of a grid (even-odd rule)
+
+    The crossings of the polygon edges are computed once per grid row, so that the memory and time
+    needed are those of a single pass over the grid.
+
+    Keyword arguments:
+    x -- node x coordinates of the grid (nx)
+    y -- node y coordinates of the grid (ny)
+    polygon -- list of (x, y) vertices of the polygon
+
+    Returns:
+    inside -- boolean array (ny, nx), True for the nodes within the polygon
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = np.zeros((y.size, x.size), dtype=bool)
+
+    vertices = list(polygon)
+    for i in range(len(vertices)):
+        (x1, y1) = vertices[i]
+        (x2, y2) = vertices[(i + 1) % len(vertices)]
+        if y1 == y2:
+            # Horizontal edges never cross a row
+            continue
+
+        # Rows crossed by the edge and x coordinate of the crossing
+        rows = (y >= min(y1, y2)) & (y < max(y1, y2))
+        xcross = x1 + (y[rows] - y1) * (x2 - x1) / (y2 - y1)
+        inside[rows] ^= (x[np.newaxis, :] < xcross[:, np.newaxis])
+
+    return inside
+
+
+
+def write_grid(filename, template, z):
+    """Write a grid array with the layout, coordinates and attributes of an existing GMT NetCDF grid
+
+    Keyword arguments:
+    filename -- path to the GMT NetCDF grid to write
+    template -- path to the GMT NetCDF grid from which the dimensions, variables and attributes are copied
+    z -- grid array (ny, nx) with NaN for empty cells, in rows of increasing y (as returned by read_grid)
+    """
+    import netCDF4
+
+    src = netCDF4.Dataset(template, 'r')
+    dst = netCDF4.Dataset(filename, 'w', format=src.data_model)
+    try:
+        src.set_auto_mask(False)
+        dst.set_auto_mask(False)
+        dst.setncatts(dict([(key, src.getncattr(key)) for key in src.ncattrs()]))
+        for (name, dimension) in src.dimensions.items():
+            dst.createDimension(name, None if dimension.isunlimited() else len(dimension))
+
+        valid = np.isfinite(z)
+        zrange = [np.nan, np.nan]
+        if valid.any():
+            zrange = [float(z[valid].min()), float(z[valid].max())]
+
+        for (name, variable) in src.variables.items():
+            fill = getattr(variable, '_FillValue', None)
+            options = dict()
+            if src.data_model.startswith('NETCDF4'):
+                filters = variable.filters() or dict()
+                options['zlib'] = filters.get('zlib', False)
+                options['complevel'] = filters.get('complevel', 4)
+                options['shuffle'] = filters.get('shuffle', False)
+                if variable.chunking() != 'contiguous':
+                    options['chunksizes'] = variable.chunking()
+            out = dst.createVariable(name, variable.dtype, variable.dimensions, fill_value=fill, **options)
+            out.setncatts(dict([(key, variable.getncattr(key)) for key in variable.ncattrs() if key != '_FillValue']))
+
+            if name == 'z':
+                data = np.array(z, dtype=variable.dtype)
+                if fill is not None and not np.isnan(fill):
+                    data[~valid] = fill
+                if 'x_range' in src.variables:
+                    # Old GMT layout: z is flattened and stored from the top row down
+                    out[:] = data[::-1].ravel()
+                else:
+                    y = src.variables['y'][:]
+                    if (y.size > 1) and (y[0] > y[-1]):
+                        data = data[::-1]
+                    out[:] = data
+                if 'actual_range' in variable.ncattrs():
+                    out.setncattr('actual_range', np.array(zrange, dtype=variable.dtype))
+            elif name == 'z_range':
+                out[:] = zrange
+            else:
+                out[:] = variable[:]
+    finally:
+        dst.close()
+        src.close()
+
+
+
+def create_grid(filename, x, y, z, title='', zname='z', history=''):
+    """Write a grid array as a new COARDS compliant GMT NetCDF grid, as mbgrid and mbmosaic do
+
+    Keyword arguments:
+    filename -- path to the GMT NetCDF grid
+    x -- node x coordinates of the grid (nx)
+    y -- node y coordinates of the grid (ny), increasing
+    z -- grid array (ny, nx) with NaN for empty cells, in rows of increasing y
+    title -- title of the grid. Default: ''
+    zname -- long name of the z variable. Default: 'z'
+    history -- command that made the grid. Default: ''
+    """
+    import netCDF4
+
+    nc = netCDF4.Dataset(filename, 'w', format='NETCDF3_CLASSIC')
+    try:
+        nc.createDimension('x', len(x))
+        nc.createDimension('y', len(y))
+        nc.Conventions = 'COARDS/CF-1.0'
+        nc.title = title
+        nc.history = history
+        nc.GMT_version = '4.5.x'
+        nc.node_offset = np.int32(0)
+
+        z = np.asarray(z, dtype=np.float32)
+        valid = np.isfinite(z)
+        for (name, values) in [('x', x), ('y', y)]:
+            variable = nc.createVariable(name, 'f8', (name,))
+            variable.long_name = name
+            variable.actual_range = np.array([values[0], values[-1]], dtype=np.float64)
+            variable[:] = values
+        variable = nc.createVariable('z', 'f4', ('y', 'x'), fill_value=np.float32(np.nan))
+        variable.long_name = zname
+        if valid.any():
+            variable.actual_range = np.array([z[valid].min(), z[valid].max()], dtype=np.float64)
+        else:
+            variable.actual_range = np.array([np.nan, np.nan])
+        variable[:] = z
+    finally:
+        nc.close()
+
+
+
+def write_ehdr(filename, hdrfile, prjfile, z, x, y, wkt, nodata=-99999):
+    """Write a grid array as an ESRI EHdr raster (.flt, .hdr and .prj), as gdal_translate -of EHdr does
+
+    Keyword arguments:
+    filename -- path to the .flt file of little-endian float32 samples
+    hdrfile -- path to the .hdr header file
+    prjfile -- path to the .prj projection file
+    z -- grid array (ny, nx) with NaN for empty cells, in rows of increasing y (as returned by read_grid)
+    x -- node x coordinates of the grid (nx)
+    y -- node y coordinates of the grid (ny)
+    wkt -- ESRI WKT definition of the grid's projection
+    nodata -- value of the empty cells. Default: -99999
+    """
+    (ny, nx) = z.shape
+    xdim = 1.0
+    ydim = 1.0
+    if nx > 1:
+        xdim = (x[-1] - x[0]) / (nx - 1)
+    if ny > 1:
+        ydim = (y[-1] - y[0]) / (ny - 1)
+    write_ehdr_header(hdrfile, prjfile, nx, ny, x[0], y[-1], xdim, ydim, wkt, nodata)
+
+    # Rows from the top down, written in a single pass
+    samples = np.where(np.isfinite(z), z, nodata).astype('<f4')[::-1]
+    samples.tofile(filename)
+
+
+
+def write_ehdr_header(hdrfile, prjfile, nx, ny, ulx, uly, xdim, ydim, wkt, nodata=-99999):
+    """Write the header (.hdr) and projection (.prj) files of an ESRI EHdr raster of little-endian float32 samples
+
+    Keyword arguments:
+    hdrfile -- path to the .hdr header file
+    prjfile -- path to the .prj projection file
+    nx -- number of columns
+    ny -- number of rows
+    ulx -- x coordinate of the upper left node
+    uly -- y coordinate of the upper left node
+    xdim -- node spacing along x
+    ydim -- node spacing along y
+    wkt -- ESRI WKT definition of the raster's projection
+    nodata -- value of the empty cells. Default: -99999
+    """
+    # Same keys, order and number formats as GDAL's EHdr driver. The nodes are the centers of the cells.
+    header = [('BYTEORDER', 'I'),
+              ('LAYOUT', 'BIL'),
+              ('NROWS', "%d" % (ny)),
+              ('NCOLS', "%d" % (nx)),
+              ('NBANDS', '1'),
+              ('NBITS', '32'),
+              ('BANDROWBYTES', "%d" % (4 * nx)),
+              ('TOTALROWBYTES', "%d" % (4 * nx)),
+              ('PIXELTYPE', 'FLOAT'),
+              ('ULXMAP', "%.15g" % (ulx)),
+              ('ULYMAP', "%.15g" % (uly)),
+              ('XDIM', "%.15g" % (xdim)),
+              ('YDIM', "%.15g" % (ydim)),
+              ('NODATA', "%.8g" % (nodata))]
+    out = open(hdrfile, 'w')
+    for (key, value) in header:
+        out.write("%-15s%s\n" % (key, value))
+    out.close()
+
+    out = open(prjfile, 'w')
+    out.write(wkt)
+    out.close()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: gridstore.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Chunked and compressed grid store (.zgd) with overviews, for windowed reads and previews of the basemap tile grids
+
+A store is a single file holding the float32 grid cut in square chunks, each byte-shuffled and compressed
+with zlib, followed by the 2x, 4x and 8x block averaged overviews of the grid in the same form. The JSON
+index of the chunks ends the file:
+
+    chunks | index (JSON) | index length (8 bytes, little endian) | 'ZGRD'
+
+Chunks without data are not stored. A window read or a preview only reads the index and the chunks it needs.
+"""
+
+import json
+import struct
+import zlib
+import numpy as np
+
+
+MAGIC = 'ZGRD'
+VERSION = 1
+EXTENSION = '.zgd'
+
+# Side of the chunks in nodes
+CHUNK_SIZE = 256
+
+# Reduction factors of the overviews
+OVERVIEWS = [2, 4, 8]
+
+
+
+def block_mean(z, factor=2):
+    """Average the valid nodes of the factor x factor blocks of a grid
+
+    Keyword arguments:
+    z -- grid array with NaN for empty cells
+    factor -- side of the blocks. The grid is padded with empty cells to a multiple of it. Default: 2
+
+    Returns:
+    z -- grid array (ceil(ny / factor), ceil(nx / factor)) with NaN for the blocks without data
+    """
+    (ny, nx) = z.shape
+    (my, mx) = (-(-ny // factor), -(-nx // factor))
+    padded = np.empty((my * factor, mx * factor), dtype=np.float32)
+    padded[:] = np.nan
+    padded[:ny, :nx] = z
+
+    blocks = padded.reshape(my, factor, mx, factor)
+    valid = np.isfinite(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    return np.where(count > 0, total / np.maximum(count, 1), np.nan).astype(np.float32)
+
+
+
+def encode_chunk(z, compression=1):
+    """Compress a chunk: the bytes of the float32 values are grouped by significance before zlib"""
+
+    return zlib.compress(np.ascontiguousarray(z, dtype='<f4').view(np.uint8).reshape(-1, 4).T.tostring(), compression)
+
+
+
+def decode_chunk(data, shape):
+    """Decompress a chunk written by encode_chunk()"""
+
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(4, -1)
+    return np.ascontiguousarray(shuffled.T).view('<f4').reshape(shape)
+
+
+
+def write_store(filename, grid, chunk=CHUNK_SIZE, overviews=OVERVIEWS, compression=1):
+    """Write a grid to a chunked grid store
+
+    Keyword arguments:
+    filename -- path to the store
+    grid -- grid dict returned by gridio.read_grid() (regularly spaced 'x' and 'y', 'z' in rows of increasing y).
+            'z' may be a memory-mapped array: it is read one block of chunk x max(overviews) nodes at a time.
+    chunk -- side of the chunks in nodes. Default: CHUNK_SIZE
+    overviews -- list of the reduction factors of the overviews, divisors of the largest one. Default: OVERVIEWS
+    compression -- zlib compression level. Most of the gain on grids comes from the byte shuffling. Default: 1
+
+    Returns:
+    index -- the index written at the end of the store
+    """
+    z = grid['z']
+    (ny, nx) = z.shape
+    dx = float(grid['x'][1] - grid['x'][0]) if nx > 1 else 1.0
+    dy = float(grid['y'][1] - grid['y'][0]) if ny > 1 else 1.0
+
+    index = {'version': VERSION, 'chunk': chunk, 'node_offset': grid.get('node_offset', 0), 'levels': [],
+             'valid_cells': 0, 'zmin': None, 'zmax': None}
+    for factor in [1] + sorted(overviews):
+        # The node of an overview block is at the center of the nodes it averages
+        (my, mx) = (-(-ny // factor), -(-nx // factor))
+        index['levels'].append({'factor': factor, 'nx': mx, 'ny': my, 'dx': dx * factor, 'dy': dy * factor,
+                                'x0': float(grid['x'][0]) + 0.5 * (factor - 1) * dx, 'y0': float(grid['y'][0]) + 0.5 * (factor - 1) * dy,
+                                'chunks': [[None] * (-(-mx // chunk)) for row in range(-(-my // chunk))]})
+
+    # Blocks of whole chunks of all the levels
+    side = chunk * index['levels'][-1]['factor']
+    out = open(filename, 'wb')
+    offset = 0
+    for row in range(0, ny, side):
+        for column in range(0, nx, side):
+            block = np.array(z[row:row+side, column:column+side], dtype=np.float32)
+            valid = np.isfinite(block)
+            if not valid.any():
+                continue
+            index['valid_cells'] += int(np.count_nonzero(valid))
+            (zmin, zmax) = (float(block[valid].min()), float(block[valid].max()))
+            if index['zmin'] is None or zmin < index['zmin']:
+                index['zmin'] = zmin
+            if index['zmax'] is None or zmax > index['zmax']:
+                index['zmax'] = zmax
+
+            for level in index['levels']:
+                factor = level['factor']
+                reduced = block
+                if factor > 1:
+                    reduced = block_mean(block, factor)
+                for r in range(0, reduced.shape[0], chunk):
+                    for c in range(0, reduced.shape[1], chunk):
+                        piece = reduced[r:r+chunk, c:c+chunk]
+                        if not np.isfinite(piece).any():
+                            continue
+                        data = encode_chunk(piece, compression)
+                        out.write(data)
+                        level['chunks'][(row // factor + r) // chunk][(column // factor + c) // chunk] = [offset, len(data)]
+                        offset = offset + len(data)
+
+    text = json.dumps(index, separators=(',', ':'))
+    out.write(text)
+    out.write(struct.pack('<Q', len(text)))
+    out.write(MAGIC)
+    out.close()
+
+    return index
+
+
+
+def read_index(filename):
+    """Read the index of a chunked grid store
+
+    Keyword arguments:
+    filename -- path to the store
+
+    Returns:
+    index -- dict with the 'levels' (full resolution first, then the overviews) and their 'chunks'
+    """
+    f = open(filename, 'rb')
+    try:
+        f.seek(-12, 2)
+        footer = f.read(12)
+        if footer[8:] != MAGIC:
+            raise IOError("%s is not a chunked grid store" % (filename))
+        (length,) = struct.unpack('<Q', footer[:8])
+        f.seek(-12 - length, 2)
+        index = json.loads(f.read(length))
+    finally:
+        f.close()
+
+    return index
+
+
+
+def store_header(filename):
+    """Read the extent and size of a chunked grid store, like gridio.grid_header()
+
+    Keyword arguments:
+    filename -- path to the store
+
+    Returns:
+    header -- (xmin, xmax, ymin, ymax, nx, ny) tuple of the node coordinates
+    """
+    level = read_index(filename)['levels'][0]
+    return (level['x0'], level['x0'] + (level['nx'] - 1) * level['dx'],
+            level['y0'], level['y0'] + (level['ny'] - 1) * level['dy'], level['nx'], level['ny'])
+
+
+
+def read_store(filename, window=None, overview=1, index=None):
+    """Read a grid, or a window of it, from a chunked grid store
+
+    Only the chunks intersecting the window are read.
+
+    Keyword arguments:
+    filename -- path to the store
+    window -- (xmin, xmax, ymin, ymax) limits of the window in the grid coordinates. Default: the whole grid
+    overview -- reduction factor of the level to read (1 = full resolution). The closest finer
+                level is read when the store has no such overview. Default: 1
+    index -- index returned by read_index(), to avoid reading it again. Default: read from the store
+
+    Returns:
+    grid -- dict like gridio.read_grid() with an additional 'factor' of the level read. None when no node is inside the window.
+    """
+    if index is None:
+        index = read_index(filename)
+    level = [l for l in index['levels'] if l['factor'] <= overview][-1]
+    chunk = index['chunk']
+
+    x = level['x0'] + np.arange(level['nx']) * level['dx']
+    y = level['y0'] + np.arange(level['ny']) * level['dy']
+    (i0, i1, j0, j1) = (0, level['nx'], 0, level['ny'])
+    if window is not None:
+        (xmin, xmax, ymin, ymax) = window
+        columns = np.nonzero((x >= xmin) & (x <= xmax))[0]
+        rows = np.nonzero((y >= ymin) & (y <= ymax))[0]
+        if columns.size == 0 or rows.size == 0:
+            return None
+        (i0, i1, j0, j1) = (columns[0], columns[-1] + 1, rows[0], rows[-1] + 1)
+
+    z = np.empty((j1 - j0, i1 - i0), dtype=np.float32)
+    z[:] = np.nan
+    f = open(filename, 'rb')
+    try:
+        for cj in range(j0 // chunk, (j1 - 1) // chunk + 1):
+            for ci in range(i0 // chunk, (i1 - 1) // chunk + 1):
+                entry = level['chunks'][cj][ci]
+                if entry is None:
+                    continue
+                f.seek(entry[0])
+                (r0, c0) = (cj * chunk, ci * chunk)
+                shape = (min(chunk, level['ny'] - r0), min(chunk, level['nx'] - c0))
+                block = decode_chunk(f.read(entry[1]), shape)
+                # Overlap of the chunk and the window
+                (a0, a1) = (max(r0, j0), min(r0 + shape[0], j1))
+                (b0, b1) = (max(c0, i0), min(c0 + shape[1], i1))
+                z[a0-j0:a1-j0, b0-i0:b1-i0] = block[a0-r0:a1-r0, b0-c0:b1-c0]
+    finally:
+        f.close()
+
+    return {'x': x[i0:i1], 'y': y[j0:j1], 'z': z, 'node_offset': index['node_offset'], 'factor': level['factor']}
+
+
+
+def read_preview(filename, size):
+    """Read the finest level of a chunked grid store that is at most size nodes wide and high
+
+    Keyword arguments:
+    filename -- path to the store
+    size -- maximum number of nodes along x and y
+
+    Returns:
+    grid -- dict like read_store(). The coarsest overview when none is small enough.
+    """
+    index = read_index(filename)
+    factor = index['levels'][-1]['factor']
+    for level in index['levels']:
+        if max(level['nx'], level['ny']) <= size:
+            factor = level['factor']
+            break
+
+    return read_store(filename, overview=factor, index=index)
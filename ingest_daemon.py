@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: ingest_daemon.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Watch-folder ingest of the Simrad all files, from the end of a survey line to the updated basemap tiles
+
+The directory of the Simrad all files is watched with inotify (pyinotify) when available, by polling
+otherwise. A Simrad all file is ready once it has not been modified for the settle time: the acquisition
+software closed it. The ready files found by the conversion manifest (see convert_manifest.py) are queued
+in a bounded queue: when the queue is full, the watcher waits for the worker to catch up. The worker takes
+the queued files in batches and runs them through the conversion (mbconvert.py), the merge of the gsf edits
+(mbmerge.py) and the processing (process_mb59.py), then makes again the basemap tiles (anbasemap.py) overlapped
+by the bounding boxes of the processed files only. An interrupted daemon resumes from the manifest.
+"""
+
+import argparse
+import os
+import Queue
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from os import path
+from sys import exit, stdout
+import mbconvert
+import mbmerge
+import process_mb59
+import convert_manifest
+import geospatial as geo
+import tile_plan
+from anbasemap import subdatalist_name, LON_STEP, LAT_STEP
+from tile_job import atomic_write
+
+
+
+def log(message):
+    """Print a time stamped message of the daemon"""
+
+    print "%s UTC: %s" % (time.strftime('%Y%m%d-%H%M%S', time.gmtime()), message)
+    stdout.flush()
+
+
+
+def start_inotify(directory, event):
+    """Watch the files closed or moved into a directory with inotify
+
+    Keyword arguments:
+    directory -- directory to watch
+    event -- threading.Event set on each closed or moved file
+
+    Returns:
+    notifier -- running pyinotify notifier, None when pyinotify is not installed
+    """
+    try:
+        import pyinotify
+    except ImportError:
+        return None
+
+    class Handler(pyinotify.ProcessEvent):
+        def process_default(self, e):
+            event.set()
+
+    manager = pyinotify.WatchManager()
+    notifier = pyinotify.ThreadedNotifier(manager, Handler())
+    notifier.daemon = True
+    notifier.start()
+    manager.add_watch(directory, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+    return notifier
+
+
+
+def swath_bounds(filename):
+    """Geographic bounding box of a swath file, from its .inf file made by mbinfo when missing
+
+    Keyword argument:
+    filename -- path to the swath file
+
+    Returns:
+    bounds -- (west, east, south, north) tuple. None when unknown.
+    """
+    bounds = tile_plan.read_inf_bounds(filename)
+    if bounds is None and path.isfile(filename):
+        devnull = open(os.devnull, 'w')
+        try:
+            subprocess.call(['mbinfo', '-I', filename, '-O'], stdout=devnull, stderr=devnull)
+        except OSError:
+            pass
+        devnull.close()
+        bounds = tile_plan.read_inf_bounds(filename)
+    return bounds
+
+
+
+class IngestDaemon(object):
+    """Watcher and worker threads bringing the new Simrad all files into the basemap tiles"""
+
+
+
+    def __init__(self, args):
+        """Set up the stages of the ingest
+
+        Keyword argument:
+        args -- parsed command line (see main())
+        """
+        self.args = args
+        self.converter = mbconvert.Converter(args.dir_all, args.dir_mb59, args.preprocess)
+        self.manifest = convert_manifest.ConvertManifest(self.converter.dir_all, self.converter.dir_mb59)
+        self.converter.manifest = self.manifest
+        self.merger = None
+        if args.merge != mbmerge.MERGE_NONE and args.gsf:
+            self.merger = mbmerge.Merger(args.dir_mb59, args.gsf, args.merge)
+        self.processor = process_mb59.Processor(args.dir_mb59)
+        self.workers = mbconvert.pool_size(args.dir_all, args.jobs)
+
+        # Tiles of the region of the basemap
+        self.tiles = dict(geo.basemap_lattice(args.region, LON_STEP, LAT_STEP))
+        self.workdir = path.join(path.abspath(args.outdir), 'ingest')
+        if not path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+
+        self.queue = Queue.Queue(args.queue_size)
+        self.pending = set()
+        self.attempts = {}
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.__lock = threading.Lock()
+        self.stats = {'files': 0, 'failed': 0, 'tiles': 0, 'latency': []}
+
+
+
+    def scan(self, block=True):
+        """Queue the ready Simrad all files that are new, changed or whose conversion failed
+
+        Keyword argument:
+        block -- wait while the queue is full. Otherwise the files left are queued by the next scan. Default: True
+
+        Returns:
+        queued -- number of files queued
+        """
+        (todo, busy) = self.manifest.plan(mbconvert.list_all_files(self.args.dir_all), self.args.settle)
+        queued = 0
+        for (name, reason) in todo:
+            with self.__lock:
+                if name in self.pending:
+                    continue
+                # A file failing again and again waits for a change
+                if reason == 'changed':
+                    self.attempts.pop(name, None)
+                elif reason == 'failed' and self.attempts.get(name, 0) >= self.args.retries:
+                    continue
+                self.pending.add(name)
+
+            if self.queue.full() and not block:
+                with self.__lock:
+                    self.pending.discard(name)
+                return queued
+            if self.queue.full():
+                log("Ingest queue full (%d files): waiting for the worker" % (self.args.queue_size))
+            while not self.stopping.is_set():
+                try:
+                    self.queue.put(name, timeout=1)
+                    break
+                except Queue.Full:
+                    continue
+            else:
+                return queued
+            log("Queued %s (%s)" % (name, reason))
+            queued += 1
+        return queued
+
+
+
+    def watch(self):
+        """Watcher thread: scan the Simrad all directory on each inotify event or polling period"""
+
+        notifier = start_inotify(self.converter.dir_all, self.wakeup)
+        if notifier is None:
+            log("Polling %s every %.0f s (pyinotify not installed)" % (self.args.dir_all, self.args.poll))
+        else:
+            log("Watching %s with inotify" % (self.args.dir_all))
+
+        # The settle time of the files closed since the last scan expires between two events
+        period = min(self.args.poll, max(1.0, self.args.settle / 2)) if notifier is not None else self.args.poll
+        try:
+            while not self.stopping.is_set():
+                self.scan()
+                self.wakeup.wait(period)
+                self.wakeup.clear()
+        finally:
+            if notifier is not None:
+                notifier.stop()
+
+
+
+    def work(self):
+        """Worker thread: ingest the queued files in batches"""
+
+        while not self.stopping.is_set():
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except Queue.Empty:
+                continue
+            while len(batch) < self.args.queue_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                self.ingest(batch)
+            except Exception as e:
+                log("Error: ingest of %s failed: %s" % (', '.join(batch), e))
+            finally:
+                with self.__lock:
+                    self.pending.difference_update(batch)
+
+
+
+    def ingest(self, batch):
+        """Convert, merge and process a batch of Simrad all files and make again the tiles they overlap
+
+        Keyword argument:
+        batch -- names of the Simrad all files
+
+        Returns:
+        tiles -- names of the basemap tiles made again
+        """
+        start = time.time()
+        ends = dict([(name, path.getmtime(path.join(self.converter.dir_all, name))) for name in batch])
+        log("Ingesting %d Simrad all file(s) with %d worker(s)" % (len(batch), self.workers))
+
+        # Conversion
+        results = self.converter.run(batch, self.workers)
+        with self.__lock:
+            for r in results:
+                if r['status'] != 'done':
+                    self.attempts[r['file']] = self.attempts.get(r['file'], 0) + 1
+                    self.stats['failed'] += 1
+                else:
+                    self.attempts.pop(r['file'], None)
+        names = self.manifest.outputs([r['file'] for r in results if r['status'] == 'done'])
+        mbconvert.write_datalist(path.join(self.converter.dir_mb59, self.args.datalist), \
+                                 [f for f in self.manifest.outputs() if path.isfile(path.join(self.converter.dir_mb59, f))], '59')
+        if not names:
+            return []
+
+        # Merge of the gsf edits, when the gsf files are already there
+        if self.merger is not None:
+            self.merger.run(self.merger.pair(names)[0], self.workers)
+
+        # Processing
+        processed = self.processor.run(names, self.workers)
+        if [r for r in processed if r['status'] != 'done']:
+            log("Warning! Some mb59 files could not be processed. See the logs in %s" % (self.processor.logdir))
+        elif not path.isfile(path.join(self.converter.dir_mb59, self.args.processed_datalist)):
+            atomic_write(path.join(self.converter.dir_mb59, self.args.processed_datalist), "$PROCESSED\n%s\n" % (self.args.datalist))
+
+        # Tiles overlapped by the processed files
+        tiles = set()
+        for r in processed:
+            (inputs, output) = self.processor.inputs(r['file'])
+            bounds = swath_bounds(output if r['status'] == 'done' else path.join(self.converter.dir_mb59, r['file']))
+            tiles.update(self.overlapped(bounds))
+        tiles = sorted(tiles)
+        self.retile(tiles)
+
+        now = time.time()
+        self.stats['files'] += len([r for r in results if r['status'] == 'done'])
+        self.stats['tiles'] += len(tiles)
+        for r in results:
+            if r['status'] == 'done':
+                self.stats['latency'].append(now - ends[r['file']])
+        log("Ingested %d file(s) into %d basemap tile(s) in %.1f s" % (len(names), len(tiles), now - start))
+        return tiles
+
+
+
+    def overlapped(self, bounds):
+        """Names of the basemap tiles of the region overlapped by a bounding box
+
+        Keyword argument:
+        bounds -- (west, east, south, north) tuple. None for an unknown bounding box: all the tiles of the region
+        """
+        if bounds is None:
+            return self.tiles.keys()
+        # The gap filling reaches a little beyond the soundings
+        margin = self.args.margin
+        region = "%.8f/%.8f/%.8f/%.8f" % (bounds[0] - margin, bounds[1] + margin, bounds[2] - margin, bounds[3] + margin)
+        return [tilename for (tilename, tile_region) in geo.basemap_lattice(region, LON_STEP, LAT_STEP) if tilename in self.tiles]
+
+
+
+    def retile(self, tilenames):
+        """Make again basemap tiles with anbasemap.py, one tile at a time
+
+        Keyword argument:
+        tilenames -- names of the basemap tiles
+
+        Returns:
+        failed -- names of the tiles that failed
+        """
+        datalist = path.join(self.converter.dir_mb59, self.args.processed_datalist)
+        if not path.isfile(datalist):
+            datalist = path.join(self.converter.dir_mb59, self.args.datalist)
+        script = path.join(path.dirname(path.realpath(__file__)), 'anbasemap.py')
+
+        failed = []
+        for tilename in tilenames:
+            region = self.tiles[tilename]
+            # A new sub-datalist of the tile, the previous one being out of date
+            subdatalist = path.join(self.workdir, subdatalist_name(region))
+            if path.isfile(subdatalist):
+                os.remove(subdatalist)
+
+            command = ['python', script, datalist, '-D', path.abspath(self.args.outdir), '-l', path.abspath(self.args.logo)] + \
+                      shlex.split(self.args.tile_options)
+            if ',' in self.args.datatype:
+                command += ['--products', self.args.datatype]
+            command += ['--', self.args.datatype.split(',')[0], str(self.args.gridkind), str(self.args.mapkind), region, \
+                        str(self.args.cellsize), self.args.psviewer, 'False']
+
+            logname = path.join(self.workdir, tilename+'.log')
+            out = open(logname, 'w')
+            status = mbconvert.run_logged(command, out, cwd=self.workdir)
+            out.close()
+            if status == 0:
+                log("Updated basemap tile %s" % (tilename))
+            else:
+                failed.append(tilename)
+                log("Error: basemap tile %s failed, see %s" % (tilename, logname))
+        return failed
+
+
+
+    def run(self):
+        """Run the watcher and the worker until stopped by SIGINT or SIGTERM"""
+
+        def stop(signum, frame):
+            log("Stopping after the current batch...")
+            self.stopping.set()
+            self.wakeup.set()
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        threads = [threading.Thread(target=self.watch), threading.Thread(target=self.work)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Signals are only delivered to the main thread while it is not blocked in join()
+        while not self.stopping.is_set():
+            time.sleep(0.5)
+        for thread in threads:
+            thread.join()
+        log(str(self))
+
+
+
+    def once(self):
+        """Ingest the files ready now and return"""
+
+        while True:
+            self.scan(block=False)
+            if self.queue.empty():
+                break
+            batch = []
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                self.ingest(batch)
+            finally:
+                self.pending.difference_update(batch)
+        log(str(self))
+
+
+
+    def __str__(self):
+        """Summary of the ingest"""
+
+        latency = self.stats['latency']
+        text = "Ingested %d Simrad all file(s), %d failed conversion(s), %d basemap tile update(s)" \
+               % (self.stats['files'], self.stats['failed'], self.stats['tiles'])
+        if latency:
+            text += "; end of line to updated tiles: mean %.0f s, max %.0f s" % (sum(latency) / len(latency), max(latency))
+        return text
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch the directory of the Simrad all files and bring each new file into the basemap tiles it overlaps.")
+    parser.add_argument('dir_all', type=str, help='directory of the Simrad all files to watch')
+    parser.add_argument('dir_mb59', type=str, help='directory of the mb59 files')
+    parser.add_argument('outdir', type=str, help='output directory of the basemap tiles')
+    parser.add_argument('region', type=str, help='region of the basemap in west/east/south/north format')
+    parser.add_argument('cellsize', type=float, help='cellsize of the basemap tiles')
+    parser.add_argument('-A', '--datatype', default='2', help='datatype of the tiles, or comma separated datatypes (e.g. 2,3,4). Default: 2')
+    parser.add_argument('-G', '--gridkind', type=int, default=1, help='gridkind of the tiles (see anbasemap.py). Default: 1')
+    parser.add_argument('-M', '--mapkind', type=int, default=1, help='mapkind of the tiles (see anbasemap.py). Default: 1')
+    parser.add_argument('-d', '--datalist', default='datalist_mb59.mb-1', help='name of the mb59 datalist, in DIR_MB59. Default: datalist_mb59.mb-1')
+    parser.add_argument('-p', '--processed-datalist', default='datalistp_mb59.mb-1', help='name of the processed mb59 datalist, in DIR_MB59. Default: datalistp_mb59.mb-1')
+    parser.add_argument('-g', '--gsf', help='directory of the gsf files whose edits are merged')
+    parser.add_argument('-m', '--merge', type=int, default=mbmerge.MERGE_NONE, choices=[mbmerge.MERGE_NONE, mbmerge.MERGE_FULL, mbmerge.MERGE_PART], \
+                        help='merge mode of the gsf edits (see mbmerge.py). Default: 0')
+    parser.add_argument('-s', '--settle', type=float, default=60.0, help='time in seconds without modification after which a Simrad all file is complete. Default: 60')
+    parser.add_argument('--poll', type=float, default=10.0, help='polling period in seconds of the directory, without inotify. Default: 10')
+    parser.add_argument('-q', '--queue-size', type=int, default=8, help='maximum number of Simrad all files queued, and ingested in one batch. Default: 8')
+    parser.add_argument('-r', '--retries', type=int, default=3, help='number of attempts to convert a failing file before waiting for it to change. Default: 3')
+    parser.add_argument('-j', '--jobs', type=int, help='maximum number of concurrent conversion, merge and processing jobs. Default: number of cores')
+    parser.add_argument('--margin', type=float, default=0.005, help='margin in decimal degrees around the swath files of the tiles made again. Default: 0.005')
+    parser.add_argument('-l', '--logo', default=path.join(path.dirname(path.realpath(__file__)), 'logos.sun'), help='logo to display in legend. Default: logos.sun')
+    parser.add_argument('--psviewer', default='gv', help='Name of the ps viewer. Default: gv')
+    parser.add_argument('--tile-options', default='', help='additional options of anbasemap.py, e.g. "--gridder python --scratch /dev/shm"')
+    parser.add_argument('--preprocess', default=os.environ.get('MBKONGSBERGPREPROCESS', 'mbkongsbergpreprocess'), \
+                        help='preprocessing command, e.g. a stand-in for tests. Default: $MBKONGSBERGPREPROCESS or mbkongsbergpreprocess')
+    parser.add_argument('--once', action='store_true', help='ingest the files ready now and exit instead of watching the directory')
+    args = parser.parse_args()
+
+    for directory in [args.dir_all, args.dir_mb59]:
+        if not path.isdir(directory):
+            print "\nError: no directory %s found.\n" % (directory)
+            exit(-1)
+
+    daemon = IngestDaemon(args)
+    if args.once:
+        daemon.once()
+    else:
+        daemon.run()
+    exit(0)
+
+if __name__ == '__main__':
+    main()
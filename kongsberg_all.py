@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: kongsberg_all.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Datagram index of the Kongsberg Simrad all files
+
+A Simrad all file is a sequence of datagrams, each one prefixed by its length in bytes and starting with the
+STX byte, the datagram type, the EM model, the date, the time, the ping (or datagram) counter and the
+serial number of the system, and ending with the ETX byte and a checksum. The file is memory-mapped and its
+length prefixes are walked to build a compact index of its datagrams (type, time, counter, byte offset and
+length), without decoding their content. A datagram that does not end with ETX is skipped by searching for
+the next valid datagram, and a truncated last datagram (file still being written) is left out.
+
+The index is cached next to the file, in a .idx.npz file that is rebuilt when the size or the modification
+time of the Simrad all file changed. Queries such as the time range, the ping count, the datagram counts or
+the offsets of the position datagrams then read the index only; the position extent reads the latitude and
+longitude of the position datagrams at their offsets.
+"""
+
+import argparse
+import calendar
+import mmap
+import os
+import struct
+import time
+from os import path
+from sys import exit
+import numpy as np
+
+
+# Version of the index format, stored in the cache files
+INDEX_VERSION = 1
+
+# Suffix of the cache files of the index
+CACHE_SUFFIX = '.idx.npz'
+
+STX = 0x02
+ETX = 0x03
+
+# Datagram types of the EM multibeam systems
+DATAGRAM_TYPES = {0x30: 'PU id outputs', 0x31: 'PU status output', 0x33: 'Extra parameters', 0x41: 'Attitude', \
+                  0x43: 'Clock', 0x44: 'Depth', 0x45: 'Single beam echo sounder depth', 0x46: 'Raw range and beam angle (F)', \
+                  0x47: 'Surface sound speed', 0x48: 'Heading', 0x49: 'Installation parameters (start)', \
+                  0x4A: 'Transducer tilt', 0x4B: 'Central beams echogram', 0x4E: 'Raw range and beam angle 78', \
+                  0x4F: 'Quality factor', 0x50: 'Position', 0x52: 'Runtime parameters', 0x53: 'Seabed image', \
+                  0x54: 'Tide', 0x55: 'Sound speed profile', 0x57: 'SSP output', 0x58: 'XYZ 88', \
+                  0x59: 'Seabed image data 89', 0x66: 'Raw range and beam angle (f)', 0x68: 'Height', \
+                  0x69: 'Installation parameters (stop)', 0x6B: 'Water column', 0x6E: 'Network attitude velocity', \
+                  0x70: 'Installation parameters (remote)', 0x72: 'Installation parameters (remote reply)'}
+
+POSITION = 0x50
+
+# Datagram types of the pings, one per ping and counted by their ping counter
+PING_TYPES = [0x58, 0x44]
+
+# Bytes of the datagram header after the length: STX, type, model, date, time, counter, serial number
+HEADER = struct.Struct('BBHIIHH')
+
+# Smallest datagram: header, ETX and checksum
+MIN_LENGTH = HEADER.size + 3
+
+INDEX_DTYPE = np.dtype([('type', 'u1'), ('time', 'f8'), ('counter', 'u2'), ('offset', 'i8'), ('length', 'u4')])
+
+
+
+def byte_order(data):
+    """Byte order of the datagrams of a Simrad all file: '<' (little-endian, the usual one) or '>'
+
+    Keyword argument:
+    data -- content of the file (e.g. a memory map)
+
+    Returns:
+    order -- struct byte order character. None when the file does not start with a datagram.
+    """
+    if len(data) < 4 + MIN_LENGTH:
+        return None
+    for order in ['<', '>']:
+        length = struct.unpack_from(order+'I', data, 0)[0]
+        if MIN_LENGTH <= length <= len(data) - 4 and ord(data[4]) == STX and ord(data[4+length-3]) == ETX:
+            return order
+    return None
+
+
+
+def date_time(dates, times):
+    """Seconds since the epoch (UTC) of the datagram dates and times
+
+    Keyword arguments:
+    dates -- array of the dates in YYYYMMDD format
+    times -- array of the times in milliseconds since midnight
+
+    Returns:
+    seconds -- array of the times in seconds since 1970-01-01 00:00:00 UTC. NaN for an invalid date.
+    """
+    seconds = np.full(dates.shape, np.nan)
+    for date in np.unique(dates):
+        (year, month, day) = (int(date) // 10000, int(date) // 100 % 100, int(date) % 100)
+        if year < 1970 or not 1 <= month <= 12 or not 1 <= day <= 31:
+            continue
+        midnight = calendar.timegm((year, month, day, 0, 0, 0))
+        select = dates == date
+        seconds[select] = midnight + times[select] / 1000.0
+    return seconds
+
+
+
+def walk(data, order='<'):
+    """Walk the length prefixes of the datagrams of a Simrad all file
+
+    Keyword arguments:
+    data -- content of the file (e.g. a memory map)
+    order -- byte order of the datagrams (see byte_order()). Default: '<'
+
+    Returns:
+    (index, skipped, truncated) -- structured array of the datagrams (see INDEX_DTYPE), number of bytes skipped
+                                   between invalid datagrams, and number of bytes of the truncated last datagram
+    """
+    size = len(data)
+    prefix = struct.Struct(order+'I')
+    header = struct.Struct(order+HEADER.format)
+    (types, dates, times, counters, offsets, lengths) = ([], [], [], [], [], [])
+    skipped = 0
+    truncated = 0
+
+    position = 0
+    while position + 4 <= size:
+        length = prefix.unpack_from(data, position)[0]
+        end = position + 4 + length
+        if length >= MIN_LENGTH and end <= size and ord(data[position+4]) == STX and ord(data[end-3]) == ETX:
+            (stx, dtype, model, date, msec, counter, serial) = header.unpack_from(data, position+4)
+            types.append(dtype)
+            dates.append(date)
+            times.append(msec)
+            counters.append(counter)
+            offsets.append(position)
+            lengths.append(length)
+            position = end
+            continue
+
+        # Corrupted datagram: search for the next STX that starts a valid datagram
+        following = data.find(chr(STX), position + 5)
+        while following != -1:
+            start = following - 4
+            next_length = prefix.unpack_from(data, start)[0]
+            if next_length >= MIN_LENGTH and start + 4 + next_length <= size and ord(data[start+4+next_length-3]) == ETX:
+                break
+            following = data.find(chr(STX), following + 1)
+        if following == -1:
+            if length >= MIN_LENGTH and end > size and position + 4 < size and ord(data[position+4]) == STX:
+                # Last datagram not completely written yet
+                truncated = size - position
+            else:
+                skipped += size - position
+            break
+        skipped += following - 4 - position
+        position = following - 4
+
+    index = np.zeros(len(types), dtype=INDEX_DTYPE)
+    index['type'] = types
+    index['time'] = date_time(np.array(dates, dtype=np.int64), np.array(times, dtype=np.float64))
+    index['counter'] = counters
+    index['offset'] = offsets
+    index['length'] = lengths
+    return (index, skipped, truncated)
+
+
+
+class AllIndex(object):
+    """Datagram index of a Simrad all file, cached next to the file"""
+
+
+
+    def __init__(self, filename, cache=True):
+        """Load the cached index of a Simrad all file, or build it
+
+        Positional argument:
+        filename -- path to the Simrad all file
+
+        Keyword argument:
+        cache -- read and write the index cache file. Default: True
+        """
+        self.filename = filename
+        self.cachename = filename+CACHE_SUFFIX
+        st = os.stat(filename)
+        (self.size, self.mtime) = (st.st_size, st.st_mtime)
+        self.cached = False
+
+        if cache and self.__load():
+            self.cached = True
+            return
+
+        self.build()
+        if cache:
+            self.save()
+
+
+
+    def __load(self):
+        """Load the cache file when it is up to date with the Simrad all file"""
+
+        if not path.isfile(self.cachename):
+            return False
+        try:
+            cache = np.load(self.cachename)
+            meta = cache['meta']
+            if int(meta[0]) != INDEX_VERSION or int(meta[1]) != self.size or float(meta[2]) != self.mtime:
+                return False
+            self.index = cache['index']
+            (self.order, self.skipped, self.truncated) = ('<' if int(meta[3]) == 0 else '>', int(meta[4]), int(meta[5]))
+        except (IOError, KeyError, ValueError, IndexError):
+            return False
+        return True
+
+
+
+    def build(self):
+        """Build the index by walking the datagrams of the memory-mapped file"""
+
+        self.order = '<'
+        (self.skipped, self.truncated) = (0, 0)
+        self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        if self.size == 0:
+            return
+
+        f = open(self.filename, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            order = byte_order(data)
+            if order is None:
+                print "\nWarning: %s does not start with a Kongsberg datagram.\n" % (self.filename)
+                order = '<'
+            self.order = order
+            (self.index, self.skipped, self.truncated) = walk(data, order)
+        finally:
+            data.close()
+            f.close()
+
+
+
+    def save(self):
+        """Atomically write the cache file of the index"""
+
+        meta = np.array([INDEX_VERSION, self.size, self.mtime, 0 if self.order == '<' else 1, self.skipped, self.truncated], dtype=np.float64)
+        tmpname = self.cachename+'.tmp'
+        try:
+            out = open(tmpname, 'wb')
+            np.savez(out, index=self.index, meta=meta)
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+            os.rename(tmpname, self.cachename)
+        except (IOError, OSError) as e:
+            # A read-only directory: the index is simply not cached
+            print "Warning: could not write the index cache %s: %s" % (self.cachename, e)
+
+
+
+    def __len__(self):
+        """Number of datagrams"""
+
+        return len(self.index)
+
+
+
+    def time_range(self):
+        """(first, last) times of the datagrams in seconds since the epoch (UTC). None when there is none."""
+
+        times = self.index['time'][np.isfinite(self.index['time'])]
+        if times.size == 0:
+            return None
+        return (float(times.min()), float(times.max()))
+
+
+
+    def counts(self):
+        """Dict of the number of datagrams of each type"""
+
+        (types, counts) = np.unique(self.index['type'], return_counts=True)
+        return dict([(int(t), int(c)) for (t, c) in zip(types, counts)])
+
+
+
+    def ping_count(self):
+        """Number of pings: distinct ping counters of the depth datagrams (XYZ 88, or Depth for the older systems)"""
+
+        for dtype in PING_TYPES:
+            counters = self.index['counter'][self.index['type'] == dtype]
+            if counters.size:
+                # The 16-bit counter wraps around: count the distinct counters within each run
+                wraps = np.concatenate([[0], np.cumsum(np.diff(counters.astype(np.int64)) < -32768)])
+                return len(np.unique(wraps * 65536 + counters))
+        return 0
+
+
+
+    def offsets(self, dtype):
+        """Byte offsets of the datagrams of a type, length prefix included
+
+        Keyword argument:
+        dtype -- datagram type, e.g. 0x50 or 'P' for the position datagrams
+
+        Returns:
+        offsets -- array of the offsets
+        """
+        if isinstance(dtype, str):
+            dtype = ord(dtype)
+        return self.index['offset'][self.index['type'] == dtype]
+
+
+
+    def positions(self):
+        """Latitudes and longitudes of the position datagrams
+
+        Returns:
+        (lat, lon) -- arrays of the latitudes and longitudes in decimal degrees
+        """
+        offsets = self.offsets(POSITION)
+        if offsets.size == 0:
+            return (np.zeros(0), np.zeros(0))
+
+        f = open(self.filename, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Latitude in units of 1/20,000,000 and longitude of 1/10,000,000 degree, after the header
+            position = struct.Struct(self.order+'ii')
+            coordinates = np.array([position.unpack_from(data, offset + 4 + HEADER.size) for offset in offsets], dtype=np.float64)
+        finally:
+            data.close()
+            f.close()
+        return (coordinates[:, 0] / 2e7, coordinates[:, 1] / 1e7)
+
+
+
+    def position_extent(self):
+        """Geographic (west, east, south, north) extent of the position datagrams. None when there is none."""
+
+        (lat, lon) = self.positions()
+        valid = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+        if not valid.any():
+            return None
+        return (float(lon[valid].min()), float(lon[valid].max()), float(lat[valid].min()), float(lat[valid].max()))
+
+
+
+    def __str__(self):
+        """Summary of the content of the Simrad all file"""
+
+        lines = ["%s: %d datagram(s), %d byte(s)%s" % (self.filename, len(self), self.size, ' (cached index)' if self.cached else '')]
+        time_range = self.time_range()
+        if time_range is not None:
+            lines.append("Time range: %s to %s UTC (%.1f s)" % (format_time(time_range[0]), format_time(time_range[1]), \
+                                                                time_range[1] - time_range[0]))
+        lines.append("Pings: %d" % (self.ping_count()))
+        extent = self.position_extent()
+        if extent is not None:
+            lines.append("Position extent: %.6f/%.6f/%.6f/%.6f" % extent)
+        for (dtype, count) in sorted(self.counts().items()):
+            lines.append("    0x%02X %-34s %8d" % (dtype, DATAGRAM_TYPES.get(dtype, 'Unknown'), count))
+        if self.skipped:
+            lines.append("Skipped %d byte(s) of corrupted datagrams" % (self.skipped))
+        if self.truncated:
+            lines.append("Truncated last datagram of %d byte(s)" % (self.truncated))
+        return '\n'.join(lines)
+
+
+
+def format_time(seconds):
+    """UTC date and time of seconds since the epoch, to the millisecond"""
+
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds)) + (".%03d" % (int(round(seconds * 1000)) % 1000))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the datagrams of Kongsberg Simrad all files and summarize their content.")
+    parser.add_argument('files', type=str, nargs='+', help='Simrad all files')
+    parser.add_argument('-n', '--no-cache', action='store_true', help='neither read nor write the index cache files')
+    parser.add_argument('-r', '--rebuild', action='store_true', help='rebuild the index cache files')
+    args = parser.parse_args()
+
+    for filename in args.files:
+        if not path.isfile(filename):
+            print "\nError: no Simrad all file %s found.\n" % (filename)
+            exit(-1)
+        if args.rebuild and path.isfile(filename+CACHE_SUFFIX):
+            os.remove(filename+CACHE_SUFFIX)
+        print AllIndex(filename, cache=not args.no_cache)
+        print
+
+    exit(0)
+
+if __name__ == '__main__':
+    main()
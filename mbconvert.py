@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: mbconvert.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Parallel conversion of Simrad all files into unprocessed mb59 files
+
+Each Simrad all file is preprocessed by its own mbkongsbergpreprocess job, the jobs running in a pool of
+workers sized to the number of cores and to the disk holding the Simrad all files. A job writes in a partial
+directory whose files are moved to the mb59 directory only when the job succeeds, so that a failed or
+interrupted conversion never leaves a truncated mb59 file behind. The output of each job is kept in a log
+file. The state, fingerprint and outputs of every conversion are recorded in a manifest (see
+convert_manifest.py), from which the files to update and the MB-System datalists are derived.
+"""
+
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from os import path
+from sys import exit
+import convert_manifest
+
+
+# Directory of the logs of the preprocessing jobs, in the mb59 directory
+LOG_DIR = 'mbconvert_logs'
+
+# Concurrent reads of a spinning disk before they slow each other down
+ROTATIONAL_SLOTS = 2
+
+
+
+def list_all_files(dir_all):
+    """Simrad all files of a directory, the 9999 files excepted
+
+    Keyword argument:
+    dir_all -- directory of the Simrad all files
+
+    Returns:
+    filenames -- sorted list of the Simrad all file names
+    """
+    return sorted([f for f in os.listdir(dir_all) if f.endswith('.all') and '9999' not in f])
+
+
+
+def write_datalist(filename, names, mbformat):
+    """Write an MB-System datalist
+
+    Keyword arguments:
+    filename -- path to the datalist
+    names -- list of the swath file names, relative to the datalist
+    mbformat -- MB-System format of the swath files (e.g. '59')
+    """
+    out = open(filename, 'w')
+    for name in names:
+        out.write("%s %s 1.000000\n" % (name, mbformat))
+    out.close()
+
+
+
+def read_datalist(filename):
+    """Swath file names of an MB-System datalist, comments and $ directives skipped
+
+    Keyword argument:
+    filename -- path to the datalist
+
+    Returns:
+    names -- list of the swath file names, as written in the datalist
+    """
+    names = []
+    f = open(filename, 'r')
+    for line in f:
+        fields = line.split()
+        if fields and not fields[0].startswith('#') and not fields[0].startswith('$'):
+            names.append(fields[0])
+    f.close()
+    return names
+
+
+
+def split_command(command):
+    """Program and arguments of a command line, for run_logged()
+
+    A program given by a relative path is made absolute: the commands are run in other working directories.
+
+    Keyword argument:
+    command -- command line, e.g. 'mbkongsbergpreprocess' or './fakebin/mbcopy -V'
+
+    Returns:
+    command -- list of the program and its arguments
+    """
+    command = shlex.split(command)
+    if command and os.sep in command[0]:
+        command[0] = path.abspath(command[0])
+    return command
+
+
+
+def run_logged(command, log, cwd=None):
+    """Run a command, its output written to a log file
+
+    Positional arguments:
+    command -- list of the program and its arguments
+    log -- log file, open for writing
+
+    Keyword argument:
+    cwd -- working directory of the command. Default: None (the current directory)
+
+    Returns:
+    status -- exit status of the command, -1 when it could not be run
+    """
+    log.write("%s\n\n" % (' '.join(command)))
+    log.flush()
+    try:
+        return subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=cwd)
+    except OSError as e:
+        log.write("%s\n" % (e))
+        return -1
+
+
+
+def disk_slots(directory):
+    """Number of files that can be read concurrently from the disk of a directory
+
+    Linux tells whether the block device holding the directory is a spinning disk, whose throughput drops
+    when its head seeks between many files. Solid state, network and unknown devices are not limited.
+
+    Keyword argument:
+    directory -- directory path
+
+    Returns:
+    slots -- number of concurrent reads, None when unlimited
+    """
+    device = os.stat(directory).st_dev
+    sysfs = path.realpath("/sys/dev/block/%d:%d" % (os.major(device), os.minor(device)))
+    # A partition has no queue of its own: it is the one of its disk
+    for queue in [path.join(sysfs, 'queue'), path.join(path.dirname(sysfs), 'queue')]:
+        try:
+            f = open(path.join(queue, 'rotational'), 'r')
+            rotational = f.read().strip() == '1'
+            f.close()
+        except IOError:
+            continue
+        return ROTATIONAL_SLOTS if rotational else None
+
+    return None
+
+
+
+def pool_size(dir_all, jobs=None, io=None):
+    """Number of preprocessing jobs run concurrently
+
+    Keyword arguments:
+    dir_all -- directory of the Simrad all files
+    jobs -- maximum number of jobs. Default: None (number of cores)
+    io -- maximum number of Simrad all files read concurrently. Default: None (see disk_slots())
+
+    Returns:
+    workers -- size of the pool of workers
+    """
+    workers = jobs if jobs else cpu_count()
+    if io is None:
+        io = disk_slots(dir_all)
+    if io:
+        workers = min(workers, io)
+    return max(1, workers)
+
+
+
+class Converter(object):
+    """Pool of mbkongsbergpreprocess jobs converting Simrad all files into mb59 files"""
+
+
+
+    def __init__(self, dir_all, dir_mb59, preprocess='mbkongsbergpreprocess', verbose=False, manifest=None):
+        """Set up the conversion of the files of a Simrad all directory
+
+        Positional arguments:
+        dir_all -- directory of the Simrad all files
+        dir_mb59 -- directory in which the mb59 files are written
+
+        Keyword arguments:
+        preprocess -- preprocessing command, called with -I <all file> -D <directory>. Default: mbkongsbergpreprocess
+        verbose -- run the preprocessing in verbose mode (-V). Default: False
+        manifest -- ConvertManifest recording the conversions. Default: None
+        """
+        self.dir_all = path.abspath(dir_all)
+        self.dir_mb59 = path.abspath(dir_mb59)
+        self.preprocess = split_command(preprocess)
+        self.verbose = verbose
+        self.manifest = manifest
+        self.logdir = path.join(self.dir_mb59, LOG_DIR)
+        self.__lock = threading.Lock()
+
+        for directory in [self.dir_mb59, self.logdir]:
+            if not path.isdir(directory):
+                os.makedirs(directory)
+
+
+
+    def convert(self, filename):
+        """Preprocess a Simrad all file
+
+        Keyword argument:
+        filename -- name of the Simrad all file in the Simrad all directory
+
+        Returns:
+        result -- dict of the 'file', 'status' ('done' or 'failed'), 'outputs' (names of the files written in the
+                  mb59 directory), 'size' (bytes read), 'seconds' and 'log' (path to the log file) of the job
+        """
+        stem = path.splitext(filename)[0]
+        source = path.join(self.dir_all, filename)
+        partdir = path.join(self.dir_mb59, '.'+stem+'.part')
+        logname = path.join(self.logdir, stem+'.log')
+        result = {'file': filename, 'status': 'failed', 'outputs': [], 'size': path.getsize(source), 'log': logname}
+
+        if path.isdir(partdir):
+            shutil.rmtree(partdir)
+        os.makedirs(partdir)
+        if self.manifest is not None:
+            fingerprint = self.manifest.start(filename)
+
+        command = self.preprocess + ['-C', '-F58', '-I', source, '-D', partdir]
+        if self.verbose:
+            command.append('-V')
+
+        start = time.time()
+        log = open(logname, 'w')
+        status = run_logged(command, log, cwd=partdir)
+        result['seconds'] = time.time() - start
+
+        outputs = sorted(os.listdir(partdir))
+        if status == 0 and stem+'.mb59' in outputs:
+            for output in outputs:
+                os.rename(path.join(partdir, output), path.join(self.dir_mb59, output))
+            result['status'] = 'done'
+            result['outputs'] = outputs
+        elif status == 0:
+            log.write("\nNo %s.mb59 file was written\n" % (stem))
+        log.write("\nExit status %d in %.1f s\n" % (status, result['seconds']))
+        log.close()
+        shutil.rmtree(partdir, ignore_errors=True)
+        if self.manifest is not None:
+            result['status'] = self.manifest.finish(filename, fingerprint, result)
+
+        with self.__lock:
+            print "%-6s %s (%.1f MB in %.1f s)" % ('OK' if result['status'] == 'done' else 'FAILED', filename, \
+                                                   result['size'] / 1e6, result['seconds'])
+        return result
+
+
+
+    def run(self, filenames, workers):
+        """Preprocess Simrad all files in a pool of workers
+
+        The largest files are started first, so that the last jobs running are short ones.
+
+        Positional arguments:
+        filenames -- names of the Simrad all files
+        workers -- size of the pool
+
+        Returns:
+        results -- list of the results of the jobs (see convert()), in the order of the file names
+        """
+        if not filenames:
+            return []
+
+        order = sorted(filenames, key=lambda f: path.getsize(path.join(self.dir_all, f)), reverse=True)
+        pool = ThreadPool(min(workers, len(filenames)))
+        try:
+            results = pool.map(self.convert, order, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = dict([(result['file'], result) for result in results])
+        return [results[f] for f in filenames]
+
+
+
+
+def summary(results, seconds, workers):
+    """Summary of a conversion run
+
+    Positional arguments:
+    results -- list of the results of the jobs (see Converter.convert())
+    seconds -- duration of the run
+    workers -- size of the pool
+
+    Returns:
+    text -- summary of the run
+    """
+    done = [r for r in results if r['status'] == 'done']
+    failed = [r for r in results if r['status'] != 'done']
+    size = sum([r['size'] for r in done])
+    text = "Converted %d Simrad all file(s) (%.1f MB) in %.1f s with %d worker(s): %.1f MB/s" \
+           % (len(done), size / 1e6, seconds, workers, size / 1e6 / seconds if seconds > 0 else 0.0)
+    if failed:
+        text += "\n%d file(s) failed, see their log:" % (len(failed))
+        for r in failed:
+            text += "\n    %s: %s" % (r['file'], r['log'])
+    return text
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert Simrad all files into unprocessed mb59 files with parallel mbkongsbergpreprocess jobs.")
+    parser.add_argument('dir_all', type=str, help='directory of the Simrad all files')
+    parser.add_argument('dir_mb59', type=str, help='directory in which to write the mb59 files')
+    parser.add_argument('-u', '--update', action='store_true', help='only convert the Simrad all files that are new, changed since their conversion, failed or without their mb59 file')
+    parser.add_argument('-a', '--all-datalist', help='name of the Simrad all datalist written in DIR_ALL')
+    parser.add_argument('-d', '--datalist', help='name of the datalist of all the mb59 files, written in DIR_MB59')
+    parser.add_argument('-n', '--new-datalist', help='name of the datalist of the mb59 files converted by this run, written in DIR_MB59')
+    parser.add_argument('-j', '--jobs', type=int, help='maximum number of concurrent preprocessing jobs. Default: number of cores')
+    parser.add_argument('--io', type=int, help='maximum number of Simrad all files read concurrently. Default: %d on a spinning disk, unlimited otherwise' % (ROTATIONAL_SLOTS))
+    parser.add_argument('--preprocess', default=os.environ.get('MBKONGSBERGPREPROCESS', 'mbkongsbergpreprocess'), \
+                        help='preprocessing command, e.g. a stand-in for tests. Default: $MBKONGSBERGPREPROCESS or mbkongsbergpreprocess')
+    parser.add_argument('-s', '--settle', type=float, default=60.0, help='time in seconds since their last modification after which the Simrad all files are complete. Default: 60')
+    parser.add_argument('-V', '--verbose', action='store_true', help='run mbkongsbergpreprocess in verbose mode')
+    args = parser.parse_args()
+
+    if not path.isdir(args.dir_all):
+        print "\nError: no directory %s of Simrad all files found.\n" % (args.dir_all)
+        exit(-1)
+
+    converter = Converter(args.dir_all, args.dir_mb59, args.preprocess, args.verbose)
+    manifest = convert_manifest.ConvertManifest(converter.dir_all, converter.dir_mb59)
+    converter.manifest = manifest
+
+    filenames = list_all_files(args.dir_all)
+    (todo, busy) = manifest.plan(filenames, args.settle)
+    if busy:
+        print "%d Simrad all file(s) modified in the last %.0f s are still being written and are left for the next update:" % (len(busy), args.settle)
+        for filename in busy:
+            print "    %s" % (filename)
+    if args.update:
+        print "%d Simrad all file(s) to convert:" % (len(todo))
+        for (filename, reason) in todo:
+            print "    %s (%s)" % (filename, reason)
+        filenames = [filename for (filename, reason) in todo]
+    else:
+        filenames = [filename for filename in filenames if filename not in busy]
+
+    workers = pool_size(args.dir_all, args.jobs, args.io)
+    print "Preprocessing %d Simrad all file(s) with %d worker(s)..." % (len(filenames), workers)
+    start = time.time()
+    results = converter.run(filenames, workers)
+    print summary(results, time.time() - start, workers)
+    print manifest
+
+    # Datalists regenerated from the manifest
+    if args.all_datalist:
+        sources = [f for f in manifest.sources() if path.isfile(path.join(converter.dir_all, f))]
+        write_datalist(path.join(args.dir_all, args.all_datalist), sources, '058')
+    if args.datalist:
+        outputs = [f for f in manifest.outputs() if path.isfile(path.join(converter.dir_mb59, f))]
+        write_datalist(path.join(args.dir_mb59, args.datalist), outputs, '59')
+    if args.new_datalist:
+        write_datalist(path.join(args.dir_mb59, args.new_datalist), manifest.outputs(filenames), '59')
+
+    if [r for r in results if r['status'] != 'done']:
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: mbmerge.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Parallel merging of the CARIS HIPS & SIPS edits of the gsf files into the mb59 files
+
+Each mb59 file of a datalist with a gsf file of the same name is merged by its own job, the jobs running in a
+pool of workers as the conversion jobs do (see mbconvert.py). With the full merge (mode 1), mbcopy -M writes
+the merged mb59 file next to the mb59 file, which it then replaces by a rename: the mb59 file is never
+missing, and a failed merge leaves it untouched. With the partial merge (mode 2), mbgetesf writes the edit
+save file of the mb59 file, also renamed into place. A failed job is reported with its log file and does
+not stop the other jobs. The mb59 files without a gsf file are reported.
+"""
+
+import argparse
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from os import path
+from sys import exit
+import mbconvert
+
+
+MERGE_NONE = 0
+MERGE_FULL = 1
+MERGE_PART = 2
+
+# Directory of the logs of the merge jobs, in the mb59 directory
+LOG_DIR = 'mbmerge_logs'
+
+
+
+class Merger(object):
+    """Pool of mbcopy -M or mbgetesf jobs merging the gsf edits into the mb59 files"""
+
+
+
+    def __init__(self, dir_mb59, dir_gsf, mode, mbcopy='mbcopy', mbgetesf='mbgetesf'):
+        """Set up the merge of the gsf files of a directory
+
+        Positional arguments:
+        dir_mb59 -- directory of the mb59 files
+        dir_gsf -- directory of the gsf files
+        mode -- merge mode: bathymetry edits and sounding locations (1), or bathymetry edits only (2)
+
+        Keyword arguments:
+        mbcopy -- mbcopy command. Default: mbcopy
+        mbgetesf -- mbgetesf command. Default: mbgetesf
+        """
+        self.dir_mb59 = path.abspath(dir_mb59)
+        self.dir_gsf = path.abspath(dir_gsf)
+        self.mode = mode
+        self.mbcopy = mbconvert.split_command(mbcopy)
+        self.mbgetesf = mbconvert.split_command(mbgetesf)
+        self.logdir = path.join(self.dir_mb59, LOG_DIR)
+        self.__lock = threading.Lock()
+
+        if not path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+
+
+
+    def pair(self, names):
+        """Pair the mb59 files with the gsf files of the same name
+
+        Keyword argument:
+        names -- names of the mb59 files
+
+        Returns:
+        (common, missing) -- lists of the names of the mb59 files with and without a gsf file
+        """
+        gsf = set([path.splitext(f)[0] for f in os.listdir(self.dir_gsf) if f.endswith('.gsf')])
+        common = [name for name in names if path.splitext(name)[0] in gsf]
+        missing = [name for name in names if path.splitext(name)[0] not in gsf]
+        return (common, missing)
+
+
+
+    def merge(self, name):
+        """Merge the edits of the gsf file of an mb59 file
+
+        Keyword argument:
+        name -- name of the mb59 file in the mb59 directory
+
+        Returns:
+        result -- dict of the 'file', 'status' ('done' or 'failed'), 'output' (name of the file replaced in the
+                  mb59 directory), 'seconds' and 'log' (path to the log file) of the job
+        """
+        stem = path.splitext(name)[0]
+        mb59 = path.join(self.dir_mb59, name)
+        gsf = path.join(self.dir_gsf, stem+'.gsf')
+        logname = path.join(self.logdir, stem+'.log')
+
+        if self.mode == MERGE_FULL:
+            output = name
+            partname = path.join(self.dir_mb59, stem+'f.mb59')
+            command = self.mbcopy + ['-F59/59/121', '-I', mb59, '-M', gsf, '-O', partname]
+        else:
+            output = name+'.esf'
+            partname = path.join(self.dir_mb59, output+'.part')
+            command = self.mbgetesf + ['-F121', '-I', gsf, '-O', partname]
+        result = {'file': name, 'status': 'failed', 'output': output, 'log': logname}
+
+        start = time.time()
+        log = open(logname, 'w')
+        status = mbconvert.run_logged(command, log, cwd=self.dir_mb59)
+        result['seconds'] = time.time() - start
+
+        if status == 0 and path.isfile(partname):
+            os.rename(partname, path.join(self.dir_mb59, output))
+            result['status'] = 'done'
+        else:
+            if status == 0:
+                log.write("\nNo %s file was written\n" % (partname))
+            if path.isfile(partname):
+                os.remove(partname)
+        log.write("\nExit status %d in %.1f s\n" % (status, result['seconds']))
+        log.close()
+
+        with self.__lock:
+            print "%-6s %s (%.1f s)" % ('OK' if result['status'] == 'done' else 'FAILED', name, result['seconds'])
+        return result
+
+
+
+    def run(self, names, workers):
+        """Merge the edits of the gsf files of mb59 files in a pool of workers
+
+        Positional arguments:
+        names -- names of the mb59 files with a gsf file
+        workers -- size of the pool
+
+        Returns:
+        results -- list of the results of the jobs (see merge()), in the order of the names
+        """
+        if not names:
+            return []
+
+        pool = ThreadPool(min(workers, len(names)))
+        try:
+            results = pool.map(self.merge, names, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+
+def summary(results, seconds, workers, missing):
+    """Summary of a merge run
+
+    Positional arguments:
+    results -- list of the results of the jobs (see Merger.merge())
+    seconds -- duration of the run
+    workers -- size of the pool
+    missing -- names of the mb59 files without a gsf file
+
+    Returns:
+    text -- summary of the run
+    """
+    done = [r for r in results if r['status'] == 'done']
+    failed = [r for r in results if r['status'] != 'done']
+    text = "Merged the gsf edits of %d mb59 file(s) in %.1f s with %d worker(s)" % (len(done), seconds, workers)
+    if failed:
+        text += "\n%d file(s) failed, see their log:" % (len(failed))
+        for r in failed:
+            text += "\n    %s: %s" % (r['file'], r['log'])
+    if missing:
+        text += "\nMissing .gsf file(s)! Consider editing in CARIS HIPS & SIPS and exporting a .gsf for the following files:"
+        for name in missing:
+            text += "\n    %s.gsf" % (path.splitext(name)[0])
+    return text
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the bathymetry edits of CARIS HIPS & SIPS gsf files into mb59 files with parallel jobs.")
+    parser.add_argument('dir_mb59', type=str, help='directory of the mb59 files')
+    parser.add_argument('datalist', type=str, help='name of the datalist of the mb59 files to merge, in DIR_MB59')
+    parser.add_argument('dir_gsf', type=str, help='directory of the gsf files')
+    parser.add_argument('mode', type=int, choices=[MERGE_NONE, MERGE_FULL, MERGE_PART], \
+                        help='merge mode: none (0), bathymetry edits and sounding locations with mbcopy (1), bathymetry edits only with mbgetesf (2)')
+    parser.add_argument('-g', '--gsf-datalist', help='name of the gsf datalist written in DIR_GSF')
+    parser.add_argument('-j', '--jobs', type=int, help='maximum number of concurrent merge jobs. Default: number of cores')
+    parser.add_argument('--io', type=int, help='maximum number of gsf files read concurrently. Default: %d on a spinning disk, unlimited otherwise' % (mbconvert.ROTATIONAL_SLOTS))
+    parser.add_argument('--mbcopy', default=os.environ.get('MBCOPY', 'mbcopy'), help='mbcopy command, e.g. a stand-in for tests. Default: $MBCOPY or mbcopy')
+    parser.add_argument('--mbgetesf', default=os.environ.get('MBGETESF', 'mbgetesf'), help='mbgetesf command, e.g. a stand-in for tests. Default: $MBGETESF or mbgetesf')
+    args = parser.parse_args()
+
+    for directory in [args.dir_mb59, args.dir_gsf]:
+        if not path.isdir(directory):
+            print "\nError: no directory %s found.\n" % (directory)
+            exit(-1)
+
+    if args.gsf_datalist:
+        gsf = sorted([f for f in os.listdir(args.dir_gsf) if f.endswith('.gsf')])
+        mbconvert.write_datalist(path.join(args.dir_gsf, args.gsf_datalist), gsf, '121')
+
+    merger = Merger(args.dir_mb59, args.dir_gsf, args.mode, args.mbcopy, args.mbgetesf)
+    (common, missing) = merger.pair(mbconvert.read_datalist(path.join(args.dir_mb59, args.datalist)))
+    if args.mode == MERGE_NONE:
+        common = []
+
+    workers = mbconvert.pool_size(args.dir_gsf, args.jobs, args.io)
+    print "Merging the gsf edits of %d mb59 file(s) with %d worker(s)..." % (len(common), workers)
+    start = time.time()
+    results = merger.run(common, workers)
+    print summary(results, time.time() - start, workers, missing)
+
+    if [r for r in results if r['status'] != 'done']:
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: plot_template.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Template of the c-shell script making the Postscript map of a basemap tile
+
+The c-shell script generated by MB-System's mbm_grdplot for the first tile of a datatype is compiled, in a
+single pass, into a template in which the tile specific values are @@NAME@@ placeholders: the geographic
+basemap and the legend replace the projected basemap and the color scale of mbm_grdplot. The script of every
+other tile of the datatype is rendered from the template without calling mbm_grdplot again: the map scale and
+offsets are fitted to the extent of its grid as mbm_grdplot fits them to the page, and the color palette table
+is stretched over the range of its values.
+"""
+
+import re
+import numpy as np
+
+
+# Placeholders of the template
+PLACEHOLDER = re.compile(r'@@(\w+)@@')
+
+
+
+def set_line(name, value):
+    """Shell variable assignment aligned as in the mbm_grdplot scripts"""
+
+    return "set %-16s= %s\n" % (name, value)
+
+
+
+class PlotTemplate(object):
+    """Compiled mbm_grdplot c-shell script of a datatype, rendered for each basemap tile"""
+
+
+
+    def __init__(self, lines, grid, stem, legend):
+        """Compile the c-shell script generated by mbm_grdplot for a tile
+
+        Positional arguments:
+        lines -- lines of the mbm_grdplot c-shell script
+        grid -- path to the grid of the tile given to mbm_grdplot (-I option)
+        stem -- path to the outputs of mbm_grdplot, without extension (-O option)
+        legend -- dict with the 'datatype' (e.g. 'Bathymetry gridded'), 'source_header' (e.g. 'Vertical Datum')
+                  and 'source' (e.g. 'Mean Sea Level') descriptions of the tile in the legend
+        """
+        self.lines = []
+        self.variables = {}
+        self.cpt = []
+        section = ''
+
+        for line in lines:
+            stripped = line.strip()
+            if stripped.startswith('#'):
+                title = stripped.lstrip('#').strip()
+                if title:
+                    section = title
+                if title == 'Make color scale':
+                    # Color scale of mbm_grdplot replaced by the legend
+                    self.lines.extend(self.__legend(legend))
+                else:
+                    self.lines.append(line.replace(grid, '@@GRID@@').replace(stem, '@@STEM@@'))
+
+            elif section == 'Make color scale':
+                continue
+
+            elif stripped.startswith('set ') and '=' in stripped:
+                (key, value) = stripped[4:].split('=', 1)
+                (key, value) = (key.strip(), value.strip())
+                self.variables[key] = value
+                if key in ['PS_FILE', 'CPT_FILE', 'MAP_SCALE', 'MAP_REGION', 'X_OFFSET', 'Y_OFFSET']:
+                    self.lines.append(set_line(key, "@@%s@@" % (key)))
+                else:
+                    self.lines.append(line.replace(grid, '@@GRID@@').replace(stem, '@@STEM@@'))
+                # Lambert conformal conic projection of the geographic basemap
+                if key == 'MAP_PROJECTION':
+                    self.lines.append(set_line('MAP_PROJECTION2', 'L'))
+                elif key in ['MAP_SCALE', 'MAP_REGION']:
+                    self.lines.append(set_line(key+'2', "@@%s2@@" % (key)))
+
+            elif 'PAPER_MEDIA' in stripped:
+                self.lines.append("gmtset PAPER_MEDIA Letter\n")
+
+            elif stripped.startswith('echo') and '$CPT_FILE' in stripped:
+                # Color palette table, stretched over the values of each tile
+                if not self.cpt:
+                    self.lines.append("@@CPT_TABLE@@")
+                self.cpt.append(self.__cpt_entry(stripped))
+
+            elif section == 'Make basemap' and stripped.startswith('psbasemap'):
+                self.lines.append("psbasemap -J$MAP_PROJECTION2$MAP_SCALE2 \\\n")
+            elif section == 'Make basemap' and stripped.startswith('-R'):
+                self.lines.append("        -R$MAP_REGION2 \\\n")
+            elif section == 'Make basemap' and stripped.startswith('-B'):
+                self.lines.append("        -B0.5/0.25 \\\n")
+
+            elif section.startswith('Run ') and stripped and not stripped.startswith('echo'):
+                self.lines.append("@@VIEWER@@\n")
+
+            else:
+                self.lines.append(line.replace(grid, '@@GRID@@').replace(stem, '@@STEM@@'))
+
+        for key in ['MAP_SCALE', 'MAP_REGION', 'X_OFFSET', 'Y_OFFSET']:
+            if key not in self.variables:
+                print "\nError: shell variable %s not found in the mbm_grdplot script.\n" % (key)
+                exit(-1)
+
+        # Layout of the map of the first tile on the page
+        self.scale = float(self.variables['MAP_SCALE'])
+        self.x_offset = float(self.variables['X_OFFSET'])
+        self.y_offset = float(self.variables['Y_OFFSET'])
+        self.region = None
+        self.range = None
+
+
+
+    def __legend(self, legend):
+        """Legend of the map, replacing the color scale of mbm_grdplot"""
+
+        gap = "G 0.1c\n"
+        lines = ["# Make legend\n", \
+                 "pslegend -J -R -Dx@@LEGEND_X@@/@@LEGEND_Y@@/8.4/4c/BL -F -V -K -O<<EOF >> $PS_FILE\n", \
+                 "G -1c\n", \
+                 "B $CPT_FILE 4c 0.5c -A --ANNOT_FONT_PRIMARY=1 --ANNOT_FONT_SIZE=10 -S\n", \
+                 "I @@LOGO@@ 4c RT\n", \
+                 "G -2.6c\n", \
+                 "L 8 1 L @;128/128/128;Title:@;;\n", \
+                 "L 8 1 L Amundsen Basemap Tile @@TILENAME@@\n", gap, \
+                 "L 8 1 L @;128/128/128;Datatype:@;;\n", \
+                 "L 8 1 L %s at @@CELLSIZE@@m planimetric resolution\n" % (legend['datatype']), gap, \
+                 "L 8 1 L @;128/128/128;Projection:@;;\n", \
+                 "L 8 1 L Lambert Conic Conformal\n", gap, \
+                 "L 8 1 L @;128/128/128;Horizontal Datum:@;;\n", \
+                 "L 8 1 L WGS84\n", gap, \
+                 "L 8 1 L @;128/128/128;%s:@;;\n" % (legend['source_header']), \
+                 "L 8 1 L %s\n" % (legend['source']), \
+                 "G -1.5c\n", \
+                 "M - 72 10+u f -J$MAP_PROJECTION2$MAP_SCALE2 -R$MAP_REGION2\n", \
+                 "EOF\n\n"]
+        return lines
+
+
+
+    def __cpt_entry(self, line):
+        """Color slice (z0, r0, g0, b0, z1, r1, g1, b1) of a line of the color palette table, or the line itself"""
+
+        fields = line.split('>')[0].split()[1:]
+        try:
+            values = [float(v) for v in fields]
+        except ValueError:
+            return line
+        if len(values) != 8:
+            return line
+        return values
+
+
+
+    def reference(self, region, zmin, zmax):
+        """Set the extent and the range of the values of the first tile, to which mbm_grdplot fitted the map
+
+        Keyword arguments:
+        region -- (xmin, xmax, ymin, ymax) extent of the projected grid of the first tile
+        zmin, zmax -- range of the values of the first tile
+        """
+        self.region = region
+        self.range = (zmin, zmax)
+
+
+
+    def cpt_table(self, zmin, zmax, z=None):
+        """Lines of the color palette table of a tile
+
+        Keyword arguments:
+        zmin, zmax -- range of the values of the tile
+        z -- array of the values of the tile. When given, the color slices are placed at its quantiles
+             (histogram equalization, mbm_grdplot -S) instead of being stretched linearly. Default: None
+
+        Returns:
+        table -- the echo commands writing the color palette table
+        """
+        slices = [entry for entry in self.cpt if not isinstance(entry, str)]
+        levels = np.array([s[0] for s in slices] + [slices[-1][4]]) if slices else np.array([])
+
+        if self.range is not None and (zmin, zmax) != self.range and levels.size:
+            if z is not None:
+                values = z[np.isfinite(z)]
+                levels = np.percentile(values, np.linspace(0, 100, levels.size))
+            else:
+                (zmin1, zmax1) = self.range
+                ratio = (zmax - zmin) / (zmax1 - zmin1) if zmax1 > zmin1 else 1.0
+                levels = zmin + (levels - zmin1) * ratio
+
+        table = []
+        index = 0
+        for entry in self.cpt:
+            redirect = '>>' if table else '>'
+            if isinstance(entry, str):
+                table.append(re.sub(r'>>?', redirect, entry, count=1)+"\n")
+            else:
+                table.append("echo %.10g %d %d %d %.10g %d %d %d %s $CPT_FILE\n" % \
+                             (levels[index], entry[1], entry[2], entry[3], levels[index+1], entry[5], entry[6], entry[7], redirect))
+                index += 1
+        return ''.join(table)
+
+
+
+    def layout(self, region):
+        """Map scale and page offsets of a tile, fitted to the page as mbm_grdplot fits the first tile
+
+        Keyword argument:
+        region -- (xmin, xmax, ymin, ymax) extent of the projected grid of the tile
+
+        Returns:
+        (scale, x_offset, y_offset) -- map scale in page units per meter and offsets of the map on the page
+        """
+        (width, height) = (region[1] - region[0], region[3] - region[2])
+        (width1, height1) = (self.region[1] - self.region[0], self.region[3] - self.region[2])
+        scale = self.scale * min(width1 / width, height1 / height)
+
+        # The map stays centered on the page
+        x_offset = self.x_offset + (self.scale * width1 - scale * width) / 2
+        y_offset = self.y_offset + (self.scale * height1 - scale * height) / 2
+        return (scale, x_offset, y_offset)
+
+
+
+    def render(self, values):
+        """C-shell script of a tile
+
+        Keyword argument:
+        values -- dict of the strings replacing the placeholders
+
+        Returns:
+        script -- content of the c-shell script
+        """
+        return PLACEHOLDER.sub(lambda match: values[match.group(1)], ''.join(self.lines))
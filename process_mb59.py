@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: process_mb59.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Parallel, change-aware processing of the mb59 files
+
+Each mb59 file of a datalist is processed by its own job, the jobs running in a pool of workers as the
+conversion jobs do (see mbconvert.py): mbset points the parameter file of the mb59 file to its edit save file,
+then mbprocess writes the processed mb59 file. A file is only processed again when its processed mb59 file is
+missing or older than one of its inputs: the mb59 file, its edit save (.esf) file, its parameter (.par) file
+or the files the parameter file refers to, such as the tide file. The $PROCESSED datalist is written only
+once every job succeeded.
+"""
+
+import argparse
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from os import path
+from sys import exit
+import mbconvert
+from tile_job import atomic_write
+
+
+# Directory of the logs of the processing jobs, in the mb59 directory
+LOG_DIR = 'mbprocess_logs'
+
+
+
+def read_par(parfile):
+    """Parameters of an MB-System parameter file
+
+    Keyword argument:
+    parfile -- path to the .par file
+
+    Returns:
+    parameters -- dict of the parameter values by name. Empty when the file does not exist.
+    """
+    parameters = {}
+    if not path.isfile(parfile):
+        return parameters
+
+    f = open(parfile, 'r')
+    for line in f:
+        fields = line.split(None, 1)
+        if len(fields) == 2 and not fields[0].startswith('#'):
+            parameters[fields[0]] = fields[1].strip()
+    f.close()
+    return parameters
+
+
+
+class Processor(object):
+    """Pool of mbset and mbprocess jobs processing the out of date mb59 files"""
+
+
+
+    def __init__(self, dir_mb59, mbset='mbset', mbprocess='mbprocess'):
+        """Set up the processing of the mb59 files of a directory
+
+        Positional argument:
+        dir_mb59 -- directory of the mb59 files
+
+        Keyword arguments:
+        mbset -- mbset command. Default: mbset
+        mbprocess -- mbprocess command. Default: mbprocess
+        """
+        self.dir_mb59 = path.abspath(dir_mb59)
+        self.mbset = mbconvert.split_command(mbset)
+        self.mbprocess = mbconvert.split_command(mbprocess)
+        self.logdir = path.join(self.dir_mb59, LOG_DIR)
+        self.__lock = threading.Lock()
+
+        if not path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+
+
+
+    def inputs(self, name):
+        """Input files of the processing of an mb59 file
+
+        Keyword argument:
+        name -- name of the mb59 file in the mb59 directory
+
+        Returns:
+        (inputs, output) -- list of the paths to the existing input files, and path to the processed mb59 file
+        """
+        mb59 = path.join(self.dir_mb59, name)
+        parameters = read_par(mb59+'.par')
+        inputs = [f for f in [mb59, mb59+'.esf', mb59+'.par'] if path.isfile(f)]
+
+        # Files referred to by the parameter file (tide, sound velocity, navigation, ...)
+        for (key, value) in parameters.items():
+            if key.endswith('FILE') and key != 'OUTFILE':
+                filename = value if path.isabs(value) else path.join(self.dir_mb59, value)
+                if path.isfile(filename) and filename not in inputs:
+                    inputs.append(filename)
+
+        output = parameters.get('OUTFILE', path.splitext(name)[0]+'p.mb59')
+        if not path.isabs(output):
+            output = path.join(self.dir_mb59, output)
+        return (inputs, output)
+
+
+
+    def out_of_date(self, name):
+        """Reason to process an mb59 file, None when its processed mb59 file is up to date
+
+        Keyword argument:
+        name -- name of the mb59 file in the mb59 directory
+        """
+        (inputs, output) = self.inputs(name)
+        if not path.isfile(output):
+            return 'not processed'
+
+        mtime = path.getmtime(output)
+        newer = [path.basename(f) for f in inputs if path.getmtime(f) > mtime]
+        if newer:
+            return 'newer ' + ', '.join(newer)
+        return None
+
+
+
+    def process(self, name):
+        """Set the edit save file of an mb59 file and process it
+
+        Keyword argument:
+        name -- name of the mb59 file in the mb59 directory
+
+        Returns:
+        result -- dict of the 'file', 'status' ('done' or 'failed'), 'seconds' and 'log' (path to the log
+                  file) of the job
+        """
+        stem = path.splitext(name)[0]
+        mb59 = path.join(self.dir_mb59, name)
+        logname = path.join(self.logdir, stem+'.log')
+        result = {'file': name, 'status': 'failed', 'log': logname}
+
+        start = time.time()
+        log = open(logname, 'w')
+        status = 0
+        if path.isfile(mb59+'.esf'):
+            status = mbconvert.run_logged(self.mbset + ['-PEDITSAVEMODE:1', '-PEDITSAVEFILE:'+mb59+'.esf', '-I', mb59], \
+                                          log, cwd=self.dir_mb59)
+        output = self.inputs(name)[1]
+        if status == 0:
+            status = mbconvert.run_logged(self.mbprocess + ['-I', mb59], log, cwd=self.dir_mb59)
+        result['seconds'] = time.time() - start
+
+        if status == 0 and path.isfile(output):
+            result['status'] = 'done'
+        else:
+            if status == 0:
+                log.write("\nNo %s file was written\n" % (output))
+            # A partial processed file would look up to date
+            if path.isfile(output):
+                os.remove(output)
+        log.write("\nExit status %d in %.1f s\n" % (status, result['seconds']))
+        log.close()
+
+        with self.__lock:
+            print "%-6s %s (%.1f s)" % ('OK' if result['status'] == 'done' else 'FAILED', name, result['seconds'])
+        return result
+
+
+
+    def run(self, names, workers):
+        """Process mb59 files in a pool of workers
+
+        Positional arguments:
+        names -- names of the mb59 files
+        workers -- size of the pool
+
+        Returns:
+        results -- list of the results of the jobs (see process()), in the order of the names
+        """
+        if not names:
+            return []
+
+        pool = ThreadPool(min(workers, len(names)))
+        try:
+            results = pool.map(self.process, names, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process the out of date mb59 files of a datalist with parallel mbset and mbprocess jobs.")
+    parser.add_argument('dir_mb59', type=str, help='directory of the mb59 files')
+    parser.add_argument('datalist', type=str, help='name of the datalist of the mb59 files to process, in DIR_MB59')
+    parser.add_argument('-p', '--processed-datalist', help='name of the $PROCESSED datalist written in DIR_MB59 once all the files are processed')
+    parser.add_argument('-a', '--all', action='store_true', help='process all the mb59 files, even when up to date')
+    parser.add_argument('-j', '--jobs', type=int, help='maximum number of concurrent processing jobs. Default: number of cores')
+    parser.add_argument('--io', type=int, help='maximum number of mb59 files read concurrently. Default: %d on a spinning disk, unlimited otherwise' % (mbconvert.ROTATIONAL_SLOTS))
+    parser.add_argument('--mbset', default=os.environ.get('MBSET', 'mbset'), help='mbset command, e.g. a stand-in for tests. Default: $MBSET or mbset')
+    parser.add_argument('--mbprocess', default=os.environ.get('MBPROCESS', 'mbprocess'), help='mbprocess command, e.g. a stand-in for tests. Default: $MBPROCESS or mbprocess')
+    args = parser.parse_args()
+
+    datalist = path.join(args.dir_mb59, args.datalist)
+    if not path.isfile(datalist):
+        print "\nError: no datalist %s found.\n" % (datalist)
+        exit(-1)
+
+    processor = Processor(args.dir_mb59, args.mbset, args.mbprocess)
+    names = mbconvert.read_datalist(datalist)
+    todo = []
+    for name in names:
+        reason = 'all' if args.all else processor.out_of_date(name)
+        if reason is not None:
+            todo.append(name)
+            print "    %s (%s)" % (name, reason)
+
+    workers = mbconvert.pool_size(args.dir_mb59, args.jobs, args.io)
+    print "Processing %d of %d mb59 file(s) with %d worker(s)..." % (len(todo), len(names), workers)
+    start = time.time()
+    results = processor.run(todo, workers)
+    failed = [r for r in results if r['status'] != 'done']
+    print "Processed %d mb59 file(s) in %.1f s, %d up to date" % (len(results) - len(failed), time.time() - start, len(names) - len(todo))
+
+    if failed:
+        print "%d file(s) failed, see their log:" % (len(failed))
+        for r in failed:
+            print "    %s: %s" % (r['file'], r['log'])
+        if args.processed_datalist:
+            print "The processed datalist %s was not written." % (args.processed_datalist)
+        exit(1)
+
+    if args.processed_datalist:
+        atomic_write(path.join(args.dir_mb59, args.processed_datalist), "$PROCESSED\n%s\n" % (args.datalist))
+    exit(0)
+
+if __name__ == '__main__':
+    main()
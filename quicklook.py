@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: quicklook.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Quick-look images of the basemap tile grids rendered with numpy: color palette tables, shaded relief and
+PNG output, without going through mbm_grdplot, GMT and ImageMagick
+"""
+
+import struct
+import zlib
+import numpy as np
+
+
+# Color palettes of mbm_grdplot, from the first to the last color
+PALETTES = {'haxby': [(255, 255, 255), (255, 186, 133), (255, 161, 68), (255, 189, 87), (240, 236, 121), (205, 255, 162), \
+                      (138, 236, 174), (106, 235, 255), (50, 190, 255), (40, 127, 251), (37, 57, 175)], \
+            'grayscale': [(255, 255, 255), (235, 235, 235), (215, 215, 215), (192, 192, 192), (165, 165, 165), (140, 140, 140), \
+                          (115, 115, 115), (90, 90, 90), (65, 65, 65), (40, 40, 40), (0, 0, 0)]}
+
+# GMT default HSV shading limits and color of the empty cells (the paper)
+HSV_MIN_SATURATION = 1.0
+HSV_MAX_SATURATION = 0.1
+HSV_MIN_VALUE = 0.3
+HSV_MAX_VALUE = 1.0
+COLOR_NAN = (255, 255, 255)
+
+# Maximum width and height of the quick-look images in pixels
+QUICKLOOK_SIZE = 1200
+
+# Sun raster file header
+SUN_MAGIC = 0x59a66a95
+SUN_RT_STANDARD = 1
+SUN_RT_BYTE_ENCODED = 2
+SUN_RT_FORMAT_RGB = 3
+
+
+
+def make_cpt(z, palette='haxby', flip=False, equalize=False):
+    """Make a continuous color palette table spanning the values of a grid, as mbm_grdplot does
+
+    Keyword arguments:
+    z -- grid array with NaN for empty cells
+    palette -- name of the color palette (see PALETTES). Default: 'haxby'
+    flip -- reverse the order of the colors. Default: False
+    equalize -- place the colors at the quantiles of the values (histogram equalization) instead of at
+                regular intervals. Default: False
+
+    Returns:
+    cpt -- dict with the 'z0', 'rgb0', 'z1', 'rgb1' arrays of the color slices and the 'N' color
+    """
+    colors = list(PALETTES[palette])
+    if not flip:
+        # The first color of the palettes is used for the highest values
+        colors.reverse()
+
+    values = z[np.isfinite(z)]
+    if values.size == 0:
+        values = np.array([0.0, 1.0])
+    fractions = np.linspace(0.0, 1.0, len(colors))
+    if equalize:
+        bounds = np.percentile(values, 100 * fractions)
+    else:
+        bounds = values.min() + fractions * (values.max() - values.min())
+    bounds = np.maximum.accumulate(bounds)
+
+    colors = np.array(colors, dtype=np.float64)
+    return {'z0': bounds[:-1], 'rgb0': colors[:-1], 'z1': bounds[1:], 'rgb1': colors[1:], 'N': COLOR_NAN}
+
+
+
+def read_cpt(filename):
+    """Read a GMT color palette table in RGB
+
+    Keyword arguments:
+    filename -- path to the .cpt file
+
+    Returns:
+    cpt -- dict with the 'z0', 'rgb0', 'z1', 'rgb1' arrays of the color slices and the 'N' color
+    """
+    slices = []
+    nan = COLOR_NAN
+    f = open(filename, 'r')
+    for line in f:
+        fields = line.replace('/', ' ').split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if fields[0] == 'N':
+            nan = tuple([int(float(v)) for v in fields[1:4]])
+        elif fields[0] not in ['B', 'F']:
+            slices.append([float(v) for v in fields[0:8]])
+    f.close()
+
+    slices = np.array(sorted(slices), dtype=np.float64)
+    return {'z0': slices[:, 0], 'rgb0': slices[:, 1:4], 'z1': slices[:, 4], 'rgb1': slices[:, 5:8], 'N': nan}
+
+
+
+def write_cpt(filename, cpt):
+    """Write a GMT color palette table
+
+    Keyword arguments:
+    filename -- path to the .cpt file
+    cpt -- color palette table returned by make_cpt() or read_cpt()
+    """
+    out = open(filename, 'w')
+    for i in range(len(cpt['z0'])):
+        out.write("%g %d %d %d %g %d %d %d\n" % ((cpt['z0'][i],) + tuple(cpt['rgb0'][i]) + (cpt['z1'][i],) + tuple(cpt['rgb1'][i])))
+    out.write("N %d %d %d\n" % tuple(cpt['N']))
+    out.close()
+
+
+
+def apply_cpt(z, cpt):
+    """Map the values of a grid to colors
+
+    Keyword arguments:
+    z -- grid array with NaN for empty cells
+    cpt -- color palette table returned by make_cpt() or read_cpt()
+
+    Returns:
+    rgb -- float array (ny, nx, 3) of the colors between 0 and 255. Values outside the table get the colors of its ends.
+    """
+    valid = np.isfinite(z)
+    zc = np.clip(np.where(valid, z, cpt['z0'][0]), cpt['z0'][0], cpt['z1'][-1])
+    index = np.clip(np.searchsorted(cpt['z0'], zc, side='right') - 1, 0, len(cpt['z0']) - 1)
+
+    width = cpt['z1'][index] - cpt['z0'][index]
+    t = np.where(width > 0, (zc - cpt['z0'][index]) / np.where(width > 0, width, 1.0), 0.0)
+    rgb = cpt['rgb0'][index] + t[..., np.newaxis] * (cpt['rgb1'][index] - cpt['rgb0'][index])
+    rgb[~valid] = cpt['N']
+
+    return rgb
+
+
+
+def intensity(z, dx, dy, magnitude=0.5, azimuth=270.0):
+    """Illumination intensity of a grid, as grdgradient -A<azimuth> -Nt<magnitude> computes it for mbm_grdplot -A<magnitude>/<azimuth>
+
+    The directional derivative towards the azimuth is normalized with a cumulative Cauchy distribution.
+
+    Keyword arguments:
+    z -- grid array (ny, nx) in rows of increasing y, with NaN for empty cells
+    dx -- cell size along x
+    dy -- cell size along y
+    magnitude -- amplitude of the intensity, between 0 and 1. Default: 0.5
+    azimuth -- direction of the illumination in degrees clockwise from north. Default: 270
+
+    Returns:
+    intensity -- array (ny, nx) of intensities between -magnitude and magnitude, 0 for the empty cells
+    """
+    (dzdy, dzdx) = np.gradient(z.astype(np.float64), dy, dx)
+    a = np.radians(azimuth)
+    gradient = dzdx * np.sin(a) + dzdy * np.cos(a)
+
+    valid = np.isfinite(gradient)
+    shade = np.zeros(z.shape)
+    if valid.any():
+        g = gradient[valid]
+        offset = 0.5 * (g.max() + g.min())
+        sigma = np.sqrt(np.mean((g - offset) ** 2))
+        if sigma > 0:
+            shade[valid] = magnitude * (2.0 / np.pi) * np.arctan((g - offset) / sigma)
+
+    return shade
+
+
+
+def illuminate(rgb, shade):
+    """Shade colors in the HSV space, as GMT does for the illuminated images
+
+    Keyword arguments:
+    rgb -- float array (ny, nx, 3) of the colors between 0 and 255
+    shade -- array (ny, nx) of intensities between -1 and 1
+
+    Returns:
+    rgb -- float array (ny, nx, 3) of the shaded colors
+    """
+    r = rgb[..., 0] / 255.0
+    g = rgb[..., 1] / 255.0
+    b = rgb[..., 2] / 255.0
+
+    # RGB to HSV
+    cmax = np.maximum(np.maximum(r, g), b)
+    cmin = np.minimum(np.minimum(r, g), b)
+    delta = cmax - cmin
+    v = cmax
+    s = np.where(cmax > 0, delta / np.where(cmax > 0, cmax, 1.0), 0.0)
+    safe = np.where(delta > 0, delta, 1.0)
+    h = np.where(cmax == r, (g - b) / safe, np.where(cmax == g, 2.0 + (b - r) / safe, 4.0 + (r - g) / safe))
+    h = np.where(delta > 0, (h * 60.0) % 360.0, 0.0)
+
+    # Move towards white for positive intensities and towards black for negative ones
+    up = shade > 0
+    s = np.where(up, (1.0 - shade) * s + shade * HSV_MAX_SATURATION, (1.0 + shade) * s - shade * HSV_MIN_SATURATION)
+    v = np.where(up, (1.0 - shade) * v + shade * HSV_MAX_VALUE, (1.0 + shade) * v - shade * HSV_MIN_VALUE)
+    s = np.where(delta > 0, np.clip(s, 0.0, 1.0), 0.0)
+    v = np.clip(v, 0.0, 1.0)
+
+    # HSV to RGB
+    sector = np.floor(h / 60.0) % 6
+    f = h / 60.0 - np.floor(h / 60.0)
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    out = np.empty(rgb.shape)
+    for (i, (rr, gg, bb)) in enumerate([(v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q)]):
+        here = (sector == i)
+        out[..., 0][here] = rr[here]
+        out[..., 1][here] = gg[here]
+        out[..., 2][here] = bb[here]
+
+    return 255.0 * out
+
+
+
+def read_sun_raster(filename):
+    """Read a 24-bit Sun raster image (e.g. logos.sun)
+
+    Keyword arguments:
+    filename -- path to the Sun raster file
+
+    Returns:
+    rgb -- uint8 array (height, width, 3)
+    """
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+
+    (magic, width, height, depth, length, rastype, maptype, maplength) = struct.unpack('>8I', data[:32])
+    if magic != SUN_MAGIC or depth != 24 or rastype not in [SUN_RT_STANDARD, SUN_RT_BYTE_ENCODED, SUN_RT_FORMAT_RGB]:
+        raise ValueError("%s is not a 24-bit Sun raster image" % (filename))
+
+    pixels = data[32+maplength:]
+    if rastype == SUN_RT_BYTE_ENCODED:
+        # Run-length encoding: 0x80 <count> <value> repeats value count+1 times; 0x80 0x00 is a single 0x80
+        decoded = []
+        i = 0
+        while i < len(pixels):
+            byte = pixels[i]
+            if ord(byte) == 0x80:
+                count = ord(pixels[i+1])
+                if count == 0:
+                    decoded.append(byte)
+                    i = i + 2
+                else:
+                    decoded.append(pixels[i+2] * (count + 1))
+                    i = i + 3
+            else:
+                decoded.append(byte)
+                i = i + 1
+        pixels = ''.join(decoded)
+
+    # Rows are padded to an even number of bytes
+    rowbytes = 3 * width + (3 * width) % 2
+    image = np.frombuffer(pixels[:rowbytes*height], dtype=np.uint8).reshape(height, rowbytes)[:, :3*width].reshape(height, width, 3)
+    if rastype != SUN_RT_FORMAT_RGB:
+        # Standard Sun rasters store the pixels as BGR
+        image = image[..., ::-1]
+
+    return np.array(image)
+
+
+
+def write_png(filename, rgb):
+    """Write an RGB or RGBA image to a PNG file
+
+    Keyword arguments:
+    filename -- path to the PNG file
+    rgb -- uint8 array (height, width, 3), or (height, width, 4) with an alpha channel
+    """
+    def chunk(kind, payload):
+        return struct.pack('>I', len(payload)) + kind + payload + struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff)
+
+    (height, width, channels) = rgb.shape
+    # PNG color type 2 is RGB, 6 is RGBA
+    colortype = {3: 2, 4: 6}[channels]
+    # Each row starts with its filter type (0, none)
+    raw = np.zeros((height, channels * width + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(height, channels * width)
+
+    out = open(filename, 'wb')
+    out.write('\x89PNG\r\n\x1a\n')
+    out.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, colortype, 0, 0, 0)))
+    out.write(chunk('IDAT', zlib.compress(raw.tostring(), 6)))
+    out.write(chunk('IEND', ''))
+    out.close()
+
+
+
+def decimate(grid, size=QUICKLOOK_SIZE):
+    """Keep every n-th node of a grid so that the quick-look is at most size pixels wide and high
+
+    Keyword arguments:
+    grid -- grid dict returned by gridio.read_grid()
+    size -- maximum number of nodes along x and y. Default: QUICKLOOK_SIZE
+
+    Returns:
+    grid -- grid dict with the kept 'x', 'y' and 'z'
+    """
+    step = int(np.ceil(max(grid['z'].shape) / float(size)))
+    if step <= 1:
+        return grid
+
+    decimated = dict(grid)
+    decimated['x'] = grid['x'][::step]
+    decimated['y'] = grid['y'][::step]
+    decimated['z'] = grid['z'][::step, ::step]
+    return decimated
+
+
+
+def colorize(z, cpt, shade=None, levels=1024):
+    """Map the values of a grid to colors, optionally shaded
+
+    The values and intensities are quantized, and the shaded colors are looked up in a table computed once
+    per image instead of being computed for every cell.
+
+    Keyword arguments:
+    z -- grid array with NaN for empty cells
+    cpt -- color palette table returned by make_cpt() or read_cpt()
+    shade -- optional array of illumination intensities returned by intensity()
+    levels -- number of color levels between the ends of the palette. Default: 1024
+
+    Returns:
+    rgb -- uint8 array (ny, nx, 3) of the colors, in the row order of z
+    """
+    (zlo, zhi) = (cpt['z0'][0], cpt['z1'][-1])
+    valid = np.isfinite(z)
+    index = np.zeros(z.shape, dtype=np.intp)
+    if zhi > zlo:
+        index[valid] = np.clip(np.rint((z[valid] - zlo) * ((levels - 1) / (zhi - zlo))), 0, levels - 1)
+    colors = apply_cpt(np.linspace(zlo, zhi, levels)[np.newaxis, :], cpt)[0]
+
+    if shade is None:
+        table = np.clip(np.rint(colors), 0, 255).astype(np.uint8)
+        image = table[index]
+    else:
+        # 256 intensities between -1 and 1
+        intensities = np.linspace(-1.0, 1.0, 256)
+        table = illuminate(np.repeat(colors[:, np.newaxis, :], 256, axis=1), np.repeat(intensities[np.newaxis, :], levels, axis=0))
+        table = np.clip(np.rint(table), 0, 255).astype(np.uint8)
+        image = table[index, np.clip(np.rint((shade + 1.0) * 127.5), 0, 255).astype(np.intp)]
+    image[~valid] = cpt['N']
+
+    return image
+
+
+
+def render(grid, cpt, shade=None, logo=None, levels=1024):
+    """Render a quick-look image of a grid with a legend band showing the color scale and the logo
+
+    Keyword arguments:
+    grid -- grid dict returned by gridio.read_grid()
+    cpt -- color palette table returned by make_cpt() or read_cpt()
+    shade -- optional array of illumination intensities returned by intensity()
+    logo -- optional uint8 array (height, width, 3) of the logo
+    levels -- number of color levels between the ends of the palette. Default: 1024
+
+    Returns:
+    rgb -- uint8 array (height, width, 3) of the image, north up
+    """
+    shaded = None
+    if shade is not None:
+        shaded = shade[::-1]
+    image = colorize(grid['z'][::-1], cpt, shaded, levels)
+    (height, width) = image.shape[:2]
+    # Legend band: color scale on the left, logo on the right
+    band = max(16, height / 8)
+    legend = np.empty((band, width, 3), dtype=np.uint8)
+    legend[:] = 255
+    scale = np.linspace(cpt['z0'][0], cpt['z1'][-1], max(1, width / 2))
+    legend[band/4:band/2, :scale.size] = np.clip(np.rint(apply_cpt(scale[np.newaxis, :], cpt)), 0, 255).astype(np.uint8)
+    if logo is not None:
+        # Nearest neighbour reduction of the logo to fit the band
+        step = max(1, int(np.ceil(max(logo.shape[0] / float(band), logo.shape[1] / (width / 3.0)))))
+        small = logo[::step, ::step]
+        legend[:small.shape[0], width-small.shape[1]:] = small
+
+    return np.concatenate([image, legend], axis=0)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: scratch.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Scratch workspace of the intermediate files of the basemap tiles
+
+The raw grids, tile datalists, c-shell scripts, illumination (.int) files and Postscript maps of the tiles
+are written to a fast local directory (e.g. /dev/shm or a local SSD) instead of the output directory, which
+may be on a network file system. The final products are copied to a partial file of the output directory and
+renamed, so that they appear there atomically, and the intermediates of a tile are swept when it is done.
+Each worker process has its own subdirectory of the scratch directory, removed when the run ends.
+"""
+
+import errno
+import glob
+import os
+import shutil
+import socket
+import threading
+import time
+from os import path
+
+
+PREFIX = 'anbasemap_'
+
+
+
+def dir_usage(directory):
+    """Number of files and bytes under a directory
+
+    Keyword argument:
+    directory -- directory path
+
+    Returns:
+    (files, size) -- number of files and their total size in bytes
+    """
+    files = 0
+    size = 0
+    for (root, dirnames, filenames) in os.walk(directory):
+        for filename in filenames:
+            try:
+                size += path.getsize(path.join(root, filename))
+                files += 1
+            except OSError:
+                # Removed while walking
+                pass
+
+    return (files, size)
+
+
+
+def format_size(size):
+    """Human readable size in bytes"""
+
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size = size / 1024.0
+    return "%.1f %s" % (size, unit)
+
+
+
+def process_alive(pid):
+    """True when a process of this host has this process id"""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: the process exists but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+
+class Scratch(object):
+    """Scratch workspace of a worker process, with the accounting of its disk usage"""
+
+
+
+    def __init__(self, directory):
+        """Create the workspace of the current process in a scratch directory
+
+        Workspaces left in the scratch directory by the dead processes of this host are removed.
+
+        Keyword argument:
+        directory -- scratch directory, e.g. /dev/shm
+        """
+        host = socket.gethostname()
+        self.directory = path.join(path.abspath(directory), "%s%s_%d" % (PREFIX, host, os.getpid()))+'/'
+        self.__lock = threading.Lock()
+        self.published = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+        self.cleaned = {'files': 0, 'bytes': 0}
+        self.peak = 0
+        self.stale = 0
+
+        for stale in glob.glob(path.join(path.abspath(directory), "%s%s_*" % (PREFIX, host))):
+            try:
+                pid = int(stale.rsplit('_', 1)[1])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not process_alive(pid):
+                (files, size) = dir_usage(stale)
+                shutil.rmtree(stale, ignore_errors=True)
+                self.cleaned['files'] += files
+                self.cleaned['bytes'] += size
+                self.stale += 1
+
+        if not path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+
+
+    def __str__(self):
+        """Summary of the disk usage of the workspace"""
+
+        return "Scratch workspace %s: %d product file(s) published (%s in %.1f s), %d intermediate file(s) cleaned up (%s), " \
+               "peak usage %s, %d stale workspace(s) removed" \
+               % (self.directory, self.published['files'], format_size(self.published['bytes']), self.published['seconds'], \
+                  self.cleaned['files'], format_size(self.cleaned['bytes']), format_size(self.peak), self.stale)
+
+
+
+    def usage(self):
+        """Current size in bytes of the workspace, recorded in the peak usage"""
+
+        size = dir_usage(self.directory)[1]
+        with self.__lock:
+            self.peak = max(self.peak, size)
+        return size
+
+
+
+    def publish(self, filename, destination, partname, keep=False):
+        """Move a product of the workspace to the output directory
+
+        The product is copied to a partial file next to its destination, which is then renamed: the
+        destination never holds an incomplete product, even on another file system.
+
+        Keyword arguments:
+        filename -- path to the product in the workspace
+        destination -- path to the product in the output directory
+        partname -- path to the partial file of the destination
+        keep -- leave the product in the workspace, for the following stages of the tile. Default: False
+        """
+        start = time.time()
+        size = path.getsize(filename)
+        shutil.copyfile(filename, partname)
+        os.rename(partname, destination)
+        if not keep:
+            self.usage()
+            os.remove(filename)
+
+        with self.__lock:
+            self.published['files'] += 1
+            self.published['bytes'] += size
+            self.published['seconds'] += time.time() - start
+
+
+
+    def sweep(self, name):
+        """Remove the files of a basemap tile left in the workspace
+
+        Keyword argument:
+        name -- name of the basemap tile, prefix of all its files
+
+        Returns:
+        removed -- number of files removed
+        """
+        self.usage()
+        removed = 0
+        for filename in glob.glob(self.directory+name+'*'):
+            try:
+                size = path.getsize(filename)
+                if path.isdir(filename):
+                    size = dir_usage(filename)[1]
+                    shutil.rmtree(filename)
+                else:
+                    os.remove(filename)
+            except OSError:
+                continue
+            removed += 1
+            with self.__lock:
+                self.cleaned['files'] += 1
+                self.cleaned['bytes'] += size
+
+        return removed
+
+
+
+    def close(self):
+        """Remove the workspace
+
+        Returns:
+        summary -- summary of the disk usage of the workspace during the run
+        """
+        self.usage()
+        (files, size) = dir_usage(self.directory)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.cleaned['files'] += files
+        self.cleaned['bytes'] += size
+
+        return str(self)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: sounding_store.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Tile-partitioned columnar store of the beam-level soundings of processed swath files
+
+The swath files of a datalist are listed once with mblist and their soundings are appended to the partition of
+the basemap tile they fall in. A partition is a directory named after its tile holding one raw little-endian
+file per column:
+
+    store/store.json                  manifest: columns, swath files extracted, sounding count and extent of each partition
+    store/70_15_N_80_30_W/x.f8        projected x (ArcticNet LCC)
+    store/70_15_N_80_30_W/y.f8        projected y
+    store/70_15_N_80_30_W/z.f4        topography
+    ...
+
+The columns are read back as memory maps. The sounding counts of the manifest are authoritative: the samples
+appended after them by an interrupted extraction are discarded by the next one. Gridding a tile at any cellsize
+then reads its partition and those of its neighbours within the halo, without touching the swath files.
+"""
+
+import argparse
+import json
+import os
+import time
+from os import path
+from sys import exit
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import geospatial as geo
+import soundings
+import tile_plan
+from tile_job import atomic_write
+
+
+VERSION = 1
+MANIFEST = 'store.json'
+
+# Columns of the store: name, numpy dtype and mblist output field (None for the derived columns)
+COLUMNS = [('x', '<f8', 'X'), ('y', '<f8', 'Y'), ('z', '<f4', 'Z'), ('amplitude', '<f4', 'B'), ('sidescan', '<f4', 'b'),
+           ('time', '<f8', 'M'), ('grazing', '<f4', 'G'), ('flags', 'u1', None)]
+
+# Bits of the flags column: no valid value for the datatype. mblist lists null sidescan as 0.
+FLAG_NO_TOPO = 1
+FLAG_NO_AMPLITUDE = 2
+FLAG_NO_SIDESCAN = 4
+
+# Value column and flag of each MB-System datatype
+DATATYPE_COLUMNS = {1: ('z', FLAG_NO_TOPO), 2: ('z', FLAG_NO_TOPO), 3: ('amplitude', FLAG_NO_AMPLITUDE), 4: ('sidescan', FLAG_NO_SIDESCAN)}
+
+
+
+def column_name(directory, tilename, column):
+    """Path to the file of a column of a partition"""
+
+    dtype = dict([(name, np.dtype(dtype)) for (name, dtype, field) in COLUMNS])[column]
+    return path.join(directory, tilename, "%s.%s%d" % (column, dtype.kind, dtype.itemsize))
+
+
+
+def extract_file(swath, proj4, lon_step=0.5, lat_step=0.25):
+    """List the soundings of a swath file and partition them by basemap tile
+
+    Keyword arguments:
+    swath -- entry of tile_plan.file_index() ('file' and 'format')
+    proj4 -- PROJ.4 definition of the projection of x and y
+    lon_step -- longitude extent of a tile in decimal degrees. Default 0.5.
+    lat_step -- latitude extent of a tile in decimal degrees. Default 0.25.
+
+    Returns:
+    partitions -- dict of the tilename to a dict of the column arrays of its soundings
+    """
+    fields = ''.join([field for (name, dtype, field) in COLUMNS if field is not None])
+    partitions = dict()
+    for values in soundings.read_mblist(swath['file'], None, fields, mbformat=swath['format']):
+        (lon, lat) = (values[:, 0], values[:, 1])
+        columns = dict()
+        (columns['x'], columns['y']) = [np.asarray(c) for c in soundings.project(lon, lat, proj4)]
+        for (i, (name, dtype, field)) in enumerate(COLUMNS[2:-1]):
+            columns[name] = values[:, i + 2]
+        columns['flags'] = np.where(np.isfinite(columns['z']), 0, FLAG_NO_TOPO) \
+            | np.where(np.isfinite(columns['amplitude']), 0, FLAG_NO_AMPLITUDE) \
+            | np.where(np.isfinite(columns['sidescan']) & (columns['sidescan'] > 0), 0, FLAG_NO_SIDESCAN)
+
+        # Tile of each sounding, named after its upper-left corner
+        column = np.floor(lon / lon_step).astype(np.int64)
+        row = np.ceil(lat / lat_step).astype(np.int64)
+        (column0, row0) = (column.min(), row.min())
+        rows = row.max() - row0 + 1
+        key = (column - column0) * rows + (row - row0)
+        order = np.argsort(key, kind='mergesort')
+        (keys, starts) = np.unique(key[order], return_index=True)
+        for (k, index) in zip(keys, np.split(order, starts[1:])):
+            tilename = geo.basemap_tilename((column0 + k // rows) * lon_step, (row0 + k % rows) * lat_step)
+            partition = partitions.setdefault(tilename, dict([(name, []) for (name, dtype, field) in COLUMNS]))
+            for (name, dtype, field) in COLUMNS:
+                partition[name].append(np.asarray(columns[name][index], dtype=dtype))
+
+    for partition in partitions.values():
+        for name in partition.keys():
+            partition[name] = np.concatenate(partition[name])
+
+    return partitions
+
+
+
+class SoundingStore(object):
+    """Tile-partitioned columnar store of beam-level soundings"""
+
+
+
+    def __init__(self, directory):
+        """Open a sounding store, or prepare a new one
+
+        Keyword argument:
+        directory -- directory of the store
+        """
+        self.directory = directory
+        self.manifest = {'version': VERSION, 'columns': [[name, dtype] for (name, dtype, field) in COLUMNS],
+                         'proj4': soundings.PROJ4_LCC, 'lon_step': 0.5, 'lat_step': 0.25, 'files': {}, 'partitions': {}}
+        if path.isfile(path.join(directory, MANIFEST)):
+            f = open(path.join(directory, MANIFEST), 'r')
+            self.manifest = json.load(f)
+            f.close()
+
+
+
+    def __str__(self):
+        """Summary of the store"""
+
+        return "Sounding store %s: %d swath file(s), %d sounding(s) in %d partition(s)" \
+            % (self.directory, len(self.manifest['files']), self.count(), len(self.manifest['partitions']))
+
+
+
+    def count(self):
+        """Number of soundings of the store"""
+
+        return sum([partition['count'] for partition in self.manifest['partitions'].values()])
+
+
+
+    def save(self):
+        """Write the manifest atomically"""
+
+        atomic_write(path.join(self.directory, MANIFEST), json.dumps(self.manifest, indent=1, sort_keys=True))
+
+
+
+    def clear(self):
+        """Remove all the partitions of the store"""
+
+        for tilename in self.manifest['partitions'].keys():
+            for (name, dtype, field) in COLUMNS:
+                if path.isfile(column_name(self.directory, tilename, name)):
+                    os.remove(column_name(self.directory, tilename, name))
+            if path.isdir(path.join(self.directory, tilename)) and not os.listdir(path.join(self.directory, tilename)):
+                os.rmdir(path.join(self.directory, tilename))
+        self.manifest['files'] = {}
+        self.manifest['partitions'] = {}
+        self.save()
+
+
+
+    def append(self, partitions):
+        """Append soundings to the partitions of the store
+
+        Keyword argument:
+        partitions -- dict returned by extract_file()
+        """
+        for (tilename, columns) in sorted(partitions.items()):
+            entry = self.manifest['partitions'].setdefault(tilename, {'count': 0, 'bounds': None})
+            if not path.isdir(path.join(self.directory, tilename)):
+                os.makedirs(path.join(self.directory, tilename))
+            for (name, dtype, field) in COLUMNS:
+                filename = column_name(self.directory, tilename, name)
+                out = open(filename, 'ab')
+                # Discard the samples of an interrupted extraction
+                out.truncate(entry['count'] * np.dtype(dtype).itemsize)
+                out.seek(0, 2)
+                columns[name].tofile(out)
+                out.close()
+
+            bounds = [float(columns['x'].min()), float(columns['x'].max()), float(columns['y'].min()), float(columns['y'].max())]
+            if entry['bounds'] is not None:
+                bounds = [min(bounds[0], entry['bounds'][0]), max(bounds[1], entry['bounds'][1]),
+                          min(bounds[2], entry['bounds'][2]), max(bounds[3], entry['bounds'][3])]
+            entry['bounds'] = bounds
+            entry['count'] += int(columns['x'].size)
+
+
+
+    def extract(self, datalist, processes=1):
+        """Extract the soundings of the swath files of a datalist not in the store yet
+
+        The store is rebuilt when a swath file already extracted has changed or is no longer in the datalist.
+
+        Keyword arguments:
+        datalist -- MB-System datalist of processed swath files
+        processes -- number of swath files listed concurrently. Default: 1
+
+        Returns:
+        files -- number of swath files extracted
+        """
+        if not path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        index = tile_plan.file_index(datalist)
+        stamps = dict([(swath['file'], self.stamp(swath['file'])) for swath in index])
+        stale = [filename for (filename, stamp) in self.manifest['files'].items() if stamps.get(filename) != stamp]
+        if stale:
+            print "Rebuilding the sounding store: %d swath file(s) changed or removed since the extraction" % (len(stale))
+            self.clear()
+        todo = [swath for swath in index if swath['file'] not in self.manifest['files'] and path.isfile(swath['file'])]
+
+        pool = ThreadPool(max(1, processes))
+        try:
+            results = pool.imap(lambda swath: extract_file(swath, self.manifest['proj4'], self.manifest['lon_step'], self.manifest['lat_step']), todo)
+            for (swath, partitions) in zip(todo, results):
+                self.append(partitions)
+                self.manifest['files'][swath['file']] = stamps[swath['file']]
+                self.save()
+                print "Extracted %d sounding(s) of %s" % (sum([p['x'].size for p in partitions.values()]), swath['file'])
+        finally:
+            pool.close()
+            pool.join()
+
+        return len(todo)
+
+
+
+    def stamp(self, filename):
+        """Size and modification time of a swath file, to tell when it changed"""
+
+        if not path.isfile(filename):
+            return None
+        return [path.getsize(filename), int(path.getmtime(filename))]
+
+
+
+    def read(self, tilename, columns=None):
+        """Memory map the columns of a partition
+
+        Keyword arguments:
+        tilename -- name of the partition's basemap tile
+        columns -- list of the column names. Default: all
+
+        Returns:
+        partition -- dict of the column name to its read-only memory-mapped array. None for an empty partition.
+        """
+        entry = self.manifest['partitions'].get(tilename)
+        if entry is None or entry['count'] == 0:
+            return None
+        if columns is None:
+            columns = [name for (name, dtype, field) in COLUMNS]
+
+        dtypes = dict([(name, dtype) for (name, dtype, field) in COLUMNS])
+        return dict([(name, np.memmap(column_name(self.directory, tilename, name), dtype=dtypes[name], mode='r', shape=(entry['count'],)))
+                     for name in columns])
+
+
+
+    def partitions(self, bounds=None):
+        """Partitions of the store intersecting projected bounds
+
+        Keyword argument:
+        bounds -- (xmin, xmax, ymin, ymax) tuple in projected coordinates. Default: all the partitions
+
+        Returns:
+        tilenames -- sorted list of the names of the partitions
+        """
+        tilenames = []
+        for (tilename, entry) in self.manifest['partitions'].items():
+            b = entry['bounds']
+            if entry['count'] == 0:
+                continue
+            if bounds is None or (b[0] <= bounds[1] and b[1] >= bounds[0] and b[2] <= bounds[3] and b[3] >= bounds[2]):
+                tilenames.append(tilename)
+
+        return sorted(tilenames)
+
+
+
+    def iter_soundings(self, bounds, datatype, grazing=False):
+        """Stream the soundings of a datatype within projected bounds, one partition at a time
+
+        Keyword arguments:
+        bounds -- (xmin, xmax, ymin, ymax) tuple in projected coordinates
+        datatype -- MB-System datatype of the values (topography = 1 or 2; amplitude = 3; sidescan = 4)
+        grazing -- also yield the grazing angles of the soundings. Default: False
+
+        Returns:
+        chunks -- generator of (x, y, value) or (x, y, value, grazing) tuples of arrays, like soundings.iter_soundings()
+        """
+        (value, flag) = DATATYPE_COLUMNS[datatype]
+        for tilename in self.partitions(bounds):
+            partition = self.read(tilename, ['x', 'y', value, 'grazing', 'flags'])
+            (x, y) = (partition['x'], partition['y'])
+            keep = (x >= bounds[0]) & (x <= bounds[1]) & (y >= bounds[2]) & (y <= bounds[3]) & (partition['flags'] & flag == 0)
+            if grazing:
+                yield (x[keep], y[keep], partition[value][keep], partition['grazing'][keep])
+            else:
+                yield (x[keep], y[keep], partition[value][keep])
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the soundings of processed swath files in a tile-partitioned sounding store")
+    parser.add_argument('datalist', type=str, help='MB-System datalist of the processed swath files')
+    parser.add_argument('store', type=str, help='directory of the sounding store')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='number of swath files listed concurrently. Default: 1')
+    args = parser.parse_args()
+
+    if not path.isfile(args.datalist):
+        print "\nError: no such file %s found.\n" % (args.datalist)
+        exit(-1)
+
+    start = time.time()
+    store = SoundingStore(args.store)
+    files = store.extract(args.datalist, args.processes)
+    print "%s (%d swath file(s) extracted in %.1f s)" % (store, files, time.time() - start)
+
+
+
+if __name__ == '__main__':
+    main()
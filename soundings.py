@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: soundings.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Beam-level soundings of the swath files of a MB-System datalist, listed with mblist and projected in the
+ArcticNet Lambert conformal conic projection, for the in-process gridding engine
+"""
+
+import subprocess
+from sys import exit
+import numpy as np
+
+
+PROJ4_LCC = "+proj=lcc +lat_1=70 +lat_2=73 +lat_0=70 +lon_0=-105 +x_0=2000000 +y_0=2000000 +datum=WGS84 +units=m +no_defs"
+
+# mblist output field of the value gridded for each MB-System datatype
+VALUE_FIELDS = {1: 'Z', 2: 'Z', 3: 'B', 4: 'b'}
+
+# Number of soundings parsed and projected at a time
+CHUNK_SIZE = 1000000
+
+
+
+def project(lon, lat, proj4=PROJ4_LCC):
+    """Project geographic coordinates in the ArcticNet projection
+
+    Keyword arguments:
+    lon -- array of longitudes in decimal degrees
+    lat -- array of latitudes in decimal degrees
+    proj4 -- PROJ.4 definition of the projection. Default: PROJ4_LCC
+
+    Returns:
+    (x, y) -- arrays of the projected coordinates in meters
+    """
+    import pyproj
+
+    return pyproj.Proj(proj4)(lon, lat)
+
+
+
+def halo_bounds(region, margin):
+    """Geographic bounds of a region extended by a distance on all sides
+
+    Keyword arguments:
+    region -- dict with the 'xmin', 'xmax', 'ymin' and 'ymax' geographic bounds of the region
+    margin -- distance in meters
+
+    Returns:
+    bounds -- (west, east, south, north) tuple of the extended region
+    """
+    dlat = margin / 111000.0
+    dlon = dlat / np.cos(np.radians(max(abs(region['ymin']), abs(region['ymax']))))
+    return (region['xmin'] - dlon, region['xmax'] + dlon, region['ymin'] - dlat, region['ymax'] + dlat)
+
+
+
+def halo_region(region, margin):
+    """Geographic region extended by a distance on all sides
+
+    Keyword arguments:
+    region -- dict with the 'xmin', 'xmax', 'ymin' and 'ymax' geographic bounds of the region
+    margin -- distance in meters
+
+    Returns:
+    region -- the extended region in west/east/south/north format
+    """
+    return "%.8f/%.8f/%.8f/%.8f" % halo_bounds(region, margin)
+
+
+
+def parse_chunk(lines, columns):
+    """Parse lines of mblist output in an array (n, columns)"""
+
+    values = np.fromstring(''.join(lines), sep=' ')
+    return values[:(values.size // columns) * columns].reshape(-1, columns)
+
+
+
+def read_mblist(datalist, region, fields, chunk=CHUNK_SIZE, mbformat=None):
+    """Stream the listing of the beams of a datalist within a region
+
+    Flagged beams are not listed.
+
+    Keyword arguments:
+    datalist -- MB-System datalist, or a single swath file with its mbformat
+    region -- region in west/east/south/north format. None for all the beams
+    fields -- mblist output fields (-O option), e.g. 'XYZ'
+    chunk -- maximum number of beams per chunk. Default: CHUNK_SIZE
+    mbformat -- MB-System format of a single swath file. Default: None for a datalist
+
+    Returns:
+    chunks -- generator of arrays (n, len(fields)) of the listed values
+    """
+    try:
+        subprocess.check_call(['which', 'mblist'], stdout=open('/dev/null', 'w'))
+    except subprocess.CalledProcessError:
+        print "\nCould not call mblist! Please make sure MB-Sysem is properly installed\n."
+        exit(-1)
+
+    command = ['mblist', '-I', datalist, '-MA', '-O'+fields]
+    if region is not None:
+        command[3:3] = ['-R'+region]
+    if mbformat:
+        command[3:3] = ['-F%d' % (mbformat)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    lines = []
+    for line in process.stdout:
+        lines.append(line)
+        if len(lines) == chunk:
+            yield parse_chunk(lines, len(fields))
+            lines = []
+    # A failing mblist must not pass for a shorter listing: the last chunk is only yielded once it exited
+    if process.wait() != 0:
+        print "\nError: mblist failed with exit status %d on %s.\n" % (process.returncode, datalist)
+        exit(-1)
+    if lines:
+        yield parse_chunk(lines, len(fields))
+
+
+
+def iter_soundings(datalist, region, datatype, chunk=CHUNK_SIZE, proj4=PROJ4_LCC, mbformat=None, geographic=False, grazing=False):
+    """Stream the projected soundings of a datalist within a region
+
+    Keyword arguments:
+    datalist -- MB-System datalist, or a single swath file with its mbformat
+    region -- region in west/east/south/north format
+    datatype -- MB-System datatype of the values (topography = 1 or 2; amplitude = 3; sidescan = 4)
+    chunk -- maximum number of soundings per chunk. Default: CHUNK_SIZE
+    proj4 -- PROJ.4 definition of the projection. Default: PROJ4_LCC
+    mbformat -- MB-System format of a single swath file. Default: None for a datalist
+    geographic -- also yield the longitudes and latitudes of the soundings. Default: False
+    grazing -- also yield the flat bottom grazing angles of the soundings in degrees. Default: False
+
+    Returns:
+    chunks -- generator of (x, y, value) tuples of arrays in the ArcticNet projection, followed by the
+              grazing angles when grazing is True, then by the longitudes and latitudes when geographic is True
+    """
+    fields = 'XY'+VALUE_FIELDS[datatype]
+    if grazing:
+        fields = fields+'G'
+    for values in read_mblist(datalist, region, fields, chunk, mbformat):
+        (x, y) = project(values[:, 0], values[:, 1], proj4)
+        columns = [np.asarray(x), np.asarray(y), values[:, 2]]
+        if grazing:
+            columns.append(values[:, 3])
+        if geographic:
+            columns.extend([values[:, 0], values[:, 1]])
+        yield tuple(columns)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: test_kongsberg_all.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Tests of the datagram index of the Simrad all files on synthetic datagrams
+
+Run with: python -m unittest test_kongsberg_all
+"""
+
+import calendar
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import kongsberg_all as kall
+
+
+XYZ88 = 0x58
+DATE = 20160815
+MIDNIGHT = calendar.timegm((2016, 8, 15, 0, 0, 0))
+
+
+
+def datagram(dtype, msec, counter, payload='', order='<'):
+    """Synthetic datagram: length prefix, header, payload, ETX and checksum
+
+    Keyword arguments:
+    dtype -- datagram type
+    msec -- time in milliseconds since midnight
+    counter -- ping or datagram counter
+    payload -- content of the datagram following the header. Default: ''
+    order -- byte order. Default: '<'
+
+    Returns:
+    data -- bytes of the datagram
+    """
+    body = struct.pack(order+kall.HEADER.format, kall.STX, dtype, 302, DATE, msec, counter, 101) + payload \
+        + struct.pack(order+'BH', kall.ETX, 0)
+    return struct.pack(order+'I', len(body)) + body
+
+
+
+def position(msec, counter, lat, lon, order='<'):
+    """Synthetic position datagram at a latitude and longitude in decimal degrees"""
+
+    return datagram(kall.POSITION, msec, counter, struct.pack(order+'ii', int(round(lat * 2e7)), int(round(lon * 1e7))) + 'x' * 20, order)
+
+
+
+class TestAllIndex(unittest.TestCase):
+
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+
+    def index(self, data, cache=False):
+        """AllIndex of a Simrad all file of the given content"""
+
+        filename = os.path.join(self.directory, '0001_20160815_000000_Amundsen.all')
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+        return kall.AllIndex(filename, cache)
+
+
+
+    def test_byte_order(self):
+        for order in ['<', '>']:
+            data = ''.join([datagram(XYZ88, 1000 * i, i, 'x' * 40, order) for i in range(5)])
+            self.assertEqual(kall.byte_order(data), order)
+            index = self.index(data)
+            self.assertEqual(index.order, order)
+            self.assertEqual(len(index), 5)
+            self.assertEqual(list(index.index['counter']), range(5))
+            self.assertEqual(index.time_range(), (MIDNIGHT, MIDNIGHT + 4.0))
+        self.assertEqual(kall.byte_order('x' * 100), None)
+
+
+
+    def test_resync(self):
+        corrupted = datagram(XYZ88, 2000, 2, 'x' * 40)
+        corrupted = corrupted[:-3] + 'x' + corrupted[-2:]
+        garbage = 'garbage\x02\x00\x00'
+        data = datagram(XYZ88, 1000, 1, 'x' * 40) + garbage + corrupted + datagram(XYZ88, 3000, 3, 'x' * 40)
+        index = self.index(data)
+        self.assertEqual(list(index.index['counter']), [1, 3])
+        self.assertEqual(index.skipped, len(garbage) + len(corrupted))
+        self.assertEqual(index.truncated, 0)
+        self.assertEqual(index.offsets(XYZ88)[1], len(data) - len(datagram(XYZ88, 3000, 3, 'x' * 40)))
+
+
+
+    def test_truncated(self):
+        last = datagram(XYZ88, 2000, 2, 'x' * 40)
+        index = self.index(datagram(XYZ88, 1000, 1, 'x' * 40) + last[:30])
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.truncated, 30)
+        self.assertEqual(index.skipped, 0)
+
+
+
+    def test_ping_count_wrap(self):
+        counters = range(65530, 65536) + range(0, 6)
+        data = ''.join([datagram(XYZ88, 1000 * i, counter, 'x' * 40) + datagram(0x41, 1000 * i, i, 'x' * 10) \
+                        for (i, counter) in enumerate(counters)])
+        # A ping repeated by the 0x58 datagram of a second head
+        data += datagram(XYZ88, 12000, 5, 'x' * 40)
+        index = self.index(data)
+        self.assertEqual(index.counts(), {XYZ88: 13, 0x41: 12})
+        self.assertEqual(index.ping_count(), 12)
+
+
+
+    def test_position_extent(self):
+        data = position(0, 0, 70.25, -81.0) + datagram(XYZ88, 500, 1, 'x' * 40) + position(1000, 1, 70.5, -80.25) \
+            + position(2000, 2, 70.125, -80.5)
+        index = self.index(data)
+        (west, east, south, north) = index.position_extent()
+        self.assertAlmostEqual(west, -81.0)
+        self.assertAlmostEqual(east, -80.25)
+        self.assertAlmostEqual(south, 70.125)
+        self.assertAlmostEqual(north, 70.5)
+        self.assertEqual(self.index('').position_extent(), None)
+
+
+
+    def test_cache(self):
+        data = ''.join([datagram(XYZ88, 1000 * i, i, 'x' * 40) for i in range(3)])
+        index = self.index(data, cache=True)
+        self.assertFalse(index.cached)
+        cached = kall.AllIndex(index.filename)
+        self.assertTrue(cached.cached)
+        self.assertEqual(cached.index.tolist(), index.index.tolist())
+
+
+
+if __name__ == '__main__':
+    unittest.main()
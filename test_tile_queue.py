@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: test_tile_queue.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Tests of the shared work queue of the basemap tiles
+
+Run with: python -m unittest test_tile_queue
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import tile_queue
+
+
+SETTINGS = {'datalist': '/data/mbdatalist.mb-1', 'region': '-81/-80/70/70.5', 'datatypes': [2], 'gridkind': 1, \
+            'mapkind': 3, 'cellsize': 10.0, 'outdir': '/data/surf', 'gridder': 'python', 'soundings': None}
+
+TILES = [('70_15_N_81_00_W', '-81.0/-80.5/70.00/70.25'), ('70_15_N_80_30_W', '-80.5/-80.0/70.00/70.25')]
+
+
+
+class TestTileQueue(unittest.TestCase):
+
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = tile_queue.TileQueue(self.directory, lease=60)
+        self.queue.create(dict(SETTINGS), TILES)
+
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+
+    def test_reuse_same_settings(self):
+        item = self.queue.claim()
+        self.assertTrue(self.queue.complete(item, True))
+        self.queue.create(dict(SETTINGS), TILES)
+        counts = self.queue.counts()
+        self.assertEqual((counts[tile_queue.PENDING], counts[tile_queue.DONE]), (1, 1))
+
+
+
+    def test_reuse_changed_settings(self):
+        item = self.queue.claim()
+        self.queue.complete(item, True)
+        for (key, value) in [('cellsize', 25.0), ('datatypes', [3]), ('gridder', 'mbgrid')]:
+            settings = dict(SETTINGS)
+            settings[key] = value
+            self.assertRaises(SystemExit, self.queue.create, settings, TILES)
+            # The workers keep reading the settings the done tiles were made with
+            self.assertEqual(self.queue.settings()[key], SETTINGS[key])
+
+
+
+    def test_expired_claim(self):
+        item = self.queue.claim()
+        self.assertEqual(item['attempts'], 1)
+        # The claim is not expired right after being made
+        self.assertEqual(self.queue.requeue_expired(), [])
+
+        claimed = os.path.join(self.directory, tile_queue.CLAIMED, item['tilename']+'.json')
+        os.utime(claimed, (0, 0))
+        self.assertEqual(self.queue.requeue_expired(), [item['tilename']])
+        again = self.queue.claim()
+        self.assertEqual((again['tilename'], again['attempts']), (item['tilename'], 2))
+
+        # The late worker whose lease expired leaves the tile to its new claim
+        self.assertFalse(self.queue.complete(item, True))
+        self.assertTrue(os.path.isfile(claimed))
+        self.assertTrue(self.queue.complete(again, True))
+        self.assertEqual(self.queue.counts()[tile_queue.DONE], 1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_catalog.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+SQLite catalog of the ArcticNet basemap tiles: extents, grid statistics and product paths of every tile made
+"""
+
+import argparse
+import sqlite3
+import threading
+import time
+from os import path
+
+
+# Columns of the tiles table, in order
+COLUMNS = [('tilename', 'TEXT NOT NULL'),
+           ('datatype', 'INTEGER NOT NULL'),
+           ('cellsize', 'REAL NOT NULL'),
+           ('region', 'TEXT'),
+           ('west', 'REAL'),
+           ('east', 'REAL'),
+           ('south', 'REAL'),
+           ('north', 'REAL'),
+           ('ul_x', 'REAL'),
+           ('ul_y', 'REAL'),
+           ('ur_x', 'REAL'),
+           ('ur_y', 'REAL'),
+           ('lr_x', 'REAL'),
+           ('lr_y', 'REAL'),
+           ('ll_x', 'REAL'),
+           ('ll_y', 'REAL'),
+           ('nx', 'INTEGER'),
+           ('ny', 'INTEGER'),
+           ('cells', 'INTEGER'),
+           ('valid_cells', 'INTEGER'),
+           ('coverage', 'REAL'),
+           ('zmin', 'REAL'),
+           ('zmax', 'REAL'),
+           ('zmean', 'REAL'),
+           ('grid', 'TEXT'),
+           ('esri_grid', 'TEXT'),
+           ('chunked_grid', 'TEXT'),
+           ('ps_map', 'TEXT'),
+           ('gif_map', 'TEXT'),
+           ('png_map', 'TEXT'),
+           ('generated', 'TEXT')]
+
+
+
+def catalog_row(tile, datatype, outdir, info=None):
+    """Catalog entry of a basemap tile
+
+    Keyword arguments:
+    tile -- the Basetile made
+    datatype -- MB-System datatype of the tile
+    outdir -- directory path in which the tile products are stored
+    info -- grid information returned by tile.grid_info(). Default: read from the tile
+
+    Returns:
+    row -- dict of the catalog columns. The paths of the products not made are None.
+    """
+    outdir = path.abspath(outdir)
+    region = tile.metadata['region']
+    if info is None:
+        info = tile.grid_info(outdir)
+
+    row = dict.fromkeys([name for (name, sqltype) in COLUMNS])
+    row['tilename'] = tile.metadata['name']
+    row['datatype'] = datatype
+    row['cellsize'] = tile.metadata['cellsize']
+    row['region'] = region['geo']
+    (row['west'], row['east'], row['south'], row['north']) = (region['xmin'], region['xmax'], region['ymin'], region['ymax'])
+    for corner in ['ul', 'ur', 'lr', 'll']:
+        (row[corner+'_x'], row[corner+'_y']) = region[corner]
+    for key in ['nx', 'ny', 'cells', 'valid_cells', 'zmin', 'zmax', 'zmean']:
+        row[key] = info.get(key)
+    if info.get('tile_cells'):
+        # Fraction of the tile's region covered by data
+        row['coverage'] = float(info['valid_cells']) / info['tile_cells']
+
+    for (key, filename) in [('grid', tile.nc_grid['tile']), ('esri_grid', tile.esri_grid['grid']), ('chunked_grid', tile.chunked_grid['grid']), \
+                            ('ps_map', tile.ps_map['lcc_map']), ('gif_map', tile.gif_map['lcc_map']), \
+                            ('png_map', tile.png_map['lcc_map'])]:
+        if path.isfile(path.join(outdir, filename)):
+            row[key] = path.join(outdir, filename)
+    row['generated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    return row
+
+
+
+class TileCatalog(object):
+    """SQLite catalog of the basemap tiles, one row per tile, datatype and cellsize"""
+
+
+
+    def __init__(self, filename):
+        """Open a tile catalog, creating it if necessary
+
+        Positional arguments:
+        filename -- path to the SQLite database. Keep it on a local disk: SQLite locking is not reliable over NFS.
+        """
+        self.filename = filename
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        with self.__db:
+            self.__db.execute("CREATE TABLE IF NOT EXISTS tiles (%s, PRIMARY KEY (tilename, datatype, cellsize))" \
+                              % (', '.join(["%s %s" % (name, sqltype) for (name, sqltype) in COLUMNS])))
+            # Columns added since the catalog was created
+            existing = [row[1] for row in self.__db.execute("PRAGMA table_info(tiles)")]
+            for (name, sqltype) in COLUMNS:
+                if name not in existing:
+                    self.__db.execute("ALTER TABLE tiles ADD COLUMN %s %s" % (name, sqltype))
+            self.__db.execute("CREATE INDEX IF NOT EXISTS tiles_extent ON tiles (west, east, south, north)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS tiles_zrange ON tiles (datatype, zmin, zmax)")
+
+
+
+    def upsert(self, row):
+        """Insert or replace the entry of a tile
+
+        Positional arguments:
+        row -- dict of the catalog columns (see catalog_row())
+        """
+        names = [name for (name, sqltype) in COLUMNS]
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("INSERT OR REPLACE INTO tiles (%s) VALUES (%s)" % (', '.join(names), ', '.join(['?'] * len(names))), \
+                                  [row.get(name) for name in names])
+
+
+
+    def remove(self, tilename, datatype, cellsize):
+        """Remove the entry of a tile
+
+        Positional arguments:
+        tilename -- name of the basemap tile
+        datatype -- MB-System datatype of the tile
+        cellsize -- the spatial resolution of the tile
+        """
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("DELETE FROM tiles WHERE tilename = ? AND datatype = ? AND cellsize = ?", (tilename, datatype, cellsize))
+
+
+
+    def get(self, tilename, datatype, cellsize):
+        """Get the entry of a tile
+
+        Positional arguments:
+        tilename -- name of the basemap tile
+        datatype -- MB-System datatype of the tile
+        cellsize -- the spatial resolution of the tile
+
+        Returns:
+        row -- dict of the catalog columns. None when the tile is not in the catalog.
+        """
+        rows = self.query(datatype=datatype, cellsize=cellsize, tilename=tilename, with_data=False)
+        if rows:
+            return rows[0]
+        return None
+
+
+
+    def query(self, region=None, datatype=None, cellsize=None, zmin=None, zmax=None, tilename=None, with_data=True):
+        """Find the tiles matching the given criteria
+
+        Keyword arguments:
+        region -- only the tiles intersecting this region in west/east/south/north format. Default: all
+        datatype -- only the tiles of this MB-System datatype. Default: all
+        cellsize -- only the tiles of this spatial resolution. Default: all
+        zmin -- only the tiles with data above this value. Default: no limit
+        zmax -- only the tiles with data below this value. Default: no limit
+        tilename -- only the tiles of this name. Default: all
+        with_data -- only the tiles with valid cells. Default: True
+
+        Returns:
+        rows -- list of dicts of the catalog columns, sorted by tile name, datatype and cellsize
+        """
+        conditions = []
+        values = []
+        if region is not None:
+            (west, east, south, north) = [float(v) for v in region.split('/')]
+            conditions.append("west < ? AND east > ? AND south < ? AND north > ?")
+            values.extend([east, west, north, south])
+        for (name, value) in [('datatype', datatype), ('cellsize', cellsize), ('tilename', tilename)]:
+            if value is not None:
+                conditions.append("%s = ?" % (name))
+                values.append(value)
+        if zmin is not None:
+            conditions.append("zmax >= ?")
+            values.append(zmin)
+        if zmax is not None:
+            conditions.append("zmin <= ?")
+            values.append(zmax)
+        if with_data:
+            conditions.append("valid_cells > 0")
+
+        sql = "SELECT * FROM tiles"
+        if conditions:
+            sql = sql+" WHERE "+" AND ".join(conditions)
+        sql = sql+" ORDER BY tilename, datatype, cellsize"
+
+        with self.__lock:
+            return [dict(zip(row.keys(), row)) for row in self.__db.execute(sql, values)]
+
+
+
+    def close(self):
+        """Close the catalog"""
+
+        self.__db.close()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the catalog of the ArcticNet basemap tiles")
+    parser.add_argument('catalog', type=str, help='SQLite tile catalog written by anbasemap --catalog')
+    parser.add_argument('-R', '--region', help='only the tiles intersecting this region in west/east/south/north format')
+    parser.add_argument('-A', '--datatype', type=int, help='only the tiles of this MB-System datatype')
+    parser.add_argument('-E', '--cellsize', type=float, help='only the tiles of this spatial resolution')
+    parser.add_argument('--zmin', type=float, help='only the tiles with data above this value')
+    parser.add_argument('--zmax', type=float, help='only the tiles with data below this value')
+    args = parser.parse_args()
+
+    if not path.isfile(args.catalog):
+        print "\nError: no such file %s found.\n" % (args.catalog)
+        exit(-1)
+
+    catalog = TileCatalog(args.catalog)
+    rows = catalog.query(args.region, args.datatype, args.cellsize, args.zmin, args.zmax)
+    print "%-18s %4s %8s %10s %10s %10s %9s  %s" % ('tilename', 'type', 'cellsize', 'zmin', 'zmax', 'cells', 'coverage', 'grid')
+    for row in rows:
+        coverage = '-'
+        if row['coverage'] is not None:
+            coverage = "%.1f%%" % (100 * row['coverage'])
+        print "%-18s %4d %8g %10.2f %10.2f %10d %9s  %s" \
+            % (row['tilename'], row['datatype'], row['cellsize'], row['zmin'], row['zmax'], row['valid_cells'], coverage, row['grid'])
+    print "%d tile(s)" % (len(rows))
+    catalog.close()
+
+
+
+if __name__ == '__main__':
+    main()
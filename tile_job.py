@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_job.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Durable job state of a regional basemap tile run, used to resume interrupted runs
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from os import path
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+
+def atomic_write(filename, text):
+    """Write a text file atomically: write a temporary file, flush it to disk and rename it
+
+    Keyword arguments:
+    filename -- path to the file to write
+    text -- content of the file
+    """
+    tmpname = filename+'.tmp'
+    out = open(tmpname, 'w')
+    out.write(text)
+    out.flush()
+    os.fsync(out.fileno())
+    out.close()
+    os.rename(tmpname, filename)
+
+
+
+class TileJob(object):
+    """State of each basemap tile of a regional run (pending, running, done or failed)"""
+
+
+
+    def __init__(self, filename, settings, resume=False):
+        """Create a new job state or load an existing one
+
+        Positional arguments:
+        filename -- path to the job state file
+        settings -- dict of the run settings (datalist, datatype, cellsize, ...) that must not change on resume
+
+        Keyword argument:
+        resume -- load the existing job state file instead of starting a new job. Default: False
+        """
+        self.filename = filename
+        self.state = {'settings': settings, 'tiles': {}}
+        # The tiles of a pipelined run change state from several threads
+        self.__lock = threading.RLock()
+
+        if resume and path.isfile(filename):
+            f = open(filename, 'r')
+            state = json.load(f)
+            f.close()
+
+            if state['settings'] != settings:
+                print "\nError: the job %s was run with different settings:" % (filename)
+                print "    %s\nCannot resume it with:\n    %s\n" % (state['settings'], settings)
+                exit(-1)
+            self.state = state
+
+
+
+    def add(self, tilename, region):
+        """Add a tile to the job as pending unless it is already known
+
+        Positional arguments:
+        tilename -- name of the basemap tile
+        region -- geographic extent of the tile
+        """
+        if tilename not in self.state['tiles']:
+            self.state['tiles'][tilename] = {'region': region, 'state': PENDING, 'attempts': 0}
+
+
+
+    def get_state(self, tilename):
+        """Current state of a tile
+
+        Positional arguments:
+        tilename -- name of the basemap tile
+
+        Returns:
+        state -- one of 'pending', 'running', 'done' or 'failed'
+        """
+        return self.state['tiles'][tilename]['state']
+
+
+
+    def set_state(self, tilename, state, message=None):
+        """Change the state of a tile and save the job state file
+
+        Positional arguments:
+        tilename -- name of the basemap tile
+        state -- one of 'pending', 'running', 'done' or 'failed'
+
+        Keyword argument:
+        message -- optional message (e.g. the error of a failed tile)
+        """
+        with self.__lock:
+            tile = self.state['tiles'][tilename]
+            tile['state'] = state
+            tile['updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            tile['worker'] = "%s:%d" % (socket.gethostname(), os.getpid())
+            if state == RUNNING:
+                tile['attempts'] = tile['attempts'] + 1
+            if message is not None:
+                tile['message'] = message
+            elif 'message' in tile:
+                del tile['message']
+            self.save()
+
+
+
+    def tiles(self, state):
+        """List the tiles in a given state
+
+        Positional arguments:
+        state -- one of 'pending', 'running', 'done' or 'failed'
+
+        Returns:
+        tilenames -- sorted list of tile names
+        """
+        return sorted([name for (name, tile) in self.state['tiles'].items() if tile['state'] == state])
+
+
+
+    def save(self):
+        """Atomically write the job state file"""
+        with self.__lock:
+            atomic_write(self.filename, json.dumps(self.state, indent=1, sort_keys=True))
+
+
+
+    def __str__(self):
+        """print the number of tiles in each state"""
+
+        return "Job %s: %d pending, %d running, %d done and %d failed tile(s)" \
+            % (self.filename, len(self.tiles(PENDING)), len(self.tiles(RUNNING)), len(self.tiles(DONE)), len(self.tiles(FAILED)))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_mosaic.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Regional mosaic of the basemap tile grids, assembled out of core
+
+The mosaic is a memory-mapped raster on the lattice of the nodes multiple of the cellsize, in the ArcticNet
+projection, the tile grids offset from it being resampled bilinearly. The tile grids are streamed one at a time into their window of the raster, the nodes shared by
+neighbouring tiles being averaged, so that the memory used stays about the size of one tile whatever the size
+of the region. The mosaic is written as an ESRI EHdr raster (.flt, .hdr and .prj) or as a chunked grid store (.zgd).
+"""
+
+import argparse
+import os
+import time
+from os import path
+from sys import exit
+import numpy as np
+import gridio
+import gridstore
+from tile_pyramid import read_source, source_header
+
+
+# Number of rows of the raster processed at a time when it is filled or converted
+BAND_ROWS = 512
+
+FORMATS = ['ehdr', 'zgd']
+
+# Tolerance, in cells, of the position of a node on the mosaic lattice
+LATTICE_TOLERANCE = 1e-3
+
+
+
+def mosaic_tiles(datatype, cellsize, region=None, catalog=None, tiledir=None, lon_step=0.5, lat_step=0.25):
+    """Basemap tiles making a regional mosaic, from the tile catalog or from the tile lattice of the region
+
+    Keyword arguments:
+    datatype -- MB-System datatype of the tiles
+    cellsize -- the spatial resolution of the tiles. May be None with a catalog: all the cellsizes.
+    region -- region in west/east/south/north format. Default: all the tiles of the catalog
+    catalog -- path to the SQLite tile catalog. Default: use the lattice of the region
+    tiledir -- directory of the tile grids of the lattice
+    lon_step -- longitude extent of a tile in decimal degrees. Default 0.5.
+    lat_step -- latitude extent of a tile in decimal degrees. Default 0.25.
+
+    Returns:
+    sources -- list of (tile, grid file) tuples, the chunked grid being preferred to the NetCDF grid
+    """
+    import anbasemap
+    import geospatial as geo
+
+    if catalog is not None:
+        import tile_catalog
+        db = tile_catalog.TileCatalog(catalog)
+        rows = db.query(region, datatype, cellsize)
+        db.close()
+        tiles = [(row['tilename'], row['region'], row['cellsize'], row['chunked_grid'] or row['grid']) for row in rows]
+    else:
+        tiles = [(tilename, tile_region, cellsize, None) for (tilename, tile_region) in geo.basemap_lattice(region, lon_step, lat_step)]
+
+    sources = []
+    for (tilename, tile_region, tile_cellsize, filename) in tiles:
+        (tile, make_grid, make_ps_plot) = anbasemap.new_tile(tilename, tile_region, datatype, tile_cellsize)
+        if filename is None:
+            for name in [tile.chunked_grid['grid'], tile.nc_grid['tile']]:
+                if path.isfile(path.join(tiledir, name)):
+                    filename = path.join(tiledir, name)
+                    break
+        if filename is not None and path.isfile(filename):
+            sources.append((tile, filename))
+
+    return sources
+
+
+
+def lattice_nodes(first, last, cellsize):
+    """Nodes of the mosaic lattice between two coordinates
+
+    Keyword arguments:
+    first, last -- coordinates of the first and last nodes of a grid along an axis
+    cellsize -- the spatial resolution of the grid
+
+    Returns:
+    (index, n, t) -- index of the first lattice node, number of lattice nodes, and fraction of a cell
+                     from the first node of the grid to the first lattice node
+    """
+    index = int(np.ceil(first / cellsize - LATTICE_TOLERANCE))
+    t = index - first / cellsize
+    if abs(t) < LATTICE_TOLERANCE:
+        t = 0.0
+    n = int(np.floor((last - first) / cellsize - t + LATTICE_TOLERANCE)) + 1
+    return (index, n, t)
+
+
+
+def interpolate(z, n, t, axis):
+    """Linear interpolation of the nodes of a grid along an axis, a fraction of a cell away"""
+
+    a = np.take(z, np.arange(n), axis=axis)
+    if t == 0.0:
+        return a
+    b = np.take(z, np.arange(1, n + 1), axis=axis)
+    return a * (1 - t) + b * t
+
+
+
+def resample(grid, cellsize):
+    """Resample bilinearly a grid on the mosaic lattice
+
+    The grids of mbgrid and mbmosaic have their nodes offset from the multiples of the cellsize. The nodes next
+    to a node without data get no data.
+
+    Keyword arguments:
+    grid -- dict of the 'x', 'y' and 'z' of the grid (see gridio.read_grid())
+    cellsize -- the spatial resolution of the grid
+
+    Returns:
+    grid -- dict of the 'x', 'y' and 'z' of the grid on the lattice. The same grid when it is already on the lattice.
+    """
+    (column, nx, tx) = lattice_nodes(grid['x'][0], grid['x'][-1], cellsize)
+    (row, ny, ty) = lattice_nodes(grid['y'][0], grid['y'][-1], cellsize)
+    if tx == 0.0 and ty == 0.0:
+        return grid
+
+    z = interpolate(interpolate(grid['z'], ny, ty, 0), nx, tx, 1)
+    return {'x': (column + np.arange(nx)) * cellsize, 'y': (row + np.arange(ny)) * cellsize, 'z': z}
+
+
+
+def make_mosaic(output, grids, cellsize, wkt, kind='ehdr'):
+    """Assemble the tile grids in a single raster
+
+    Keyword arguments:
+    output -- path to the mosaic, without extension
+    grids -- list of the paths to the tile grids (.grd or .zgd)
+    cellsize -- the spatial resolution of the grids
+    wkt -- ESRI WKT definition of the projection of the grids
+    kind -- 'ehdr' for an ESRI EHdr raster or 'zgd' for a chunked grid store. Default: 'ehdr'
+
+    Returns:
+    info -- dict with the 'nx', 'ny', 'valid_cells' and output 'files' of the mosaic
+    """
+    # Nodes of the mosaic lattice covered by the grids
+    headers = [source_header(filename) for filename in grids]
+    column0 = min([int(np.ceil(h[0] / cellsize - LATTICE_TOLERANCE)) for h in headers])
+    column1 = max([int(np.floor(h[1] / cellsize + LATTICE_TOLERANCE)) for h in headers])
+    row0 = min([int(np.ceil(h[2] / cellsize - LATTICE_TOLERANCE)) for h in headers])
+    row1 = max([int(np.floor(h[3] / cellsize + LATTICE_TOLERANCE)) for h in headers])
+    (nx, ny) = (column1 - column0 + 1, row1 - row0 + 1)
+
+    # The raster rows go from the top down, as in the EHdr .flt file
+    rastername = output+'.part.flt'
+    countname = output+'.count.tmp'
+    raster = np.memmap(rastername, dtype='<f4', mode='w+', shape=(ny, nx))
+    count = np.memmap(countname, dtype=np.uint8, mode='w+', shape=(ny, nx))
+    for row in range(0, ny, BAND_ROWS):
+        raster[row:row+BAND_ROWS] = np.nan
+
+    for filename in grids:
+        grid = read_source(filename)
+        for (name, coordinates) in [('x', grid['x']), ('y', grid['y'])]:
+            if coordinates.size > 1 and abs(coordinates[1] - coordinates[0] - cellsize) > 1e-6 * cellsize:
+                print "\nError: the grid %s has a %s spacing of %g, not the cellsize %g.\n" % (filename, name, coordinates[1] - coordinates[0], cellsize)
+                exit(-1)
+        grid = resample(grid, cellsize)
+        (tny, tnx) = grid['z'].shape
+
+        # Window of the tile in the raster
+        left = int(round(grid['x'][0] / cellsize)) - column0
+        top = row1 - int(round(grid['y'][-1] / cellsize))
+        z = grid['z'][::-1]
+        valid = np.isfinite(z)
+        window = raster[top:top+tny, left:left+tnx]
+        counts = count[top:top+tny, left:left+tnx]
+
+        # Running mean of the nodes shared by several tiles
+        old = np.array(window)
+        n = np.array(counts, dtype=np.float32)
+        window[:] = np.where(valid, np.where(n > 0, old + (z - old) / (n + 1), z), old)
+        counts[:] = np.minimum(n + valid, 255)
+        del grid, z, valid, window, counts, old, n
+
+    valid_cells = 0
+    for row in range(0, ny, BAND_ROWS):
+        valid_cells += int(np.count_nonzero(count[row:row+BAND_ROWS]))
+    del count
+    os.remove(countname)
+
+    x = (column0 + np.arange(nx)) * cellsize
+    y = (row0 + np.arange(ny)) * cellsize
+    if kind == 'ehdr':
+        nodata = -99999
+        for row in range(0, ny, BAND_ROWS):
+            band = raster[row:row+BAND_ROWS]
+            band[np.isnan(band)] = nodata
+        raster.flush()
+        del raster
+
+        files = [output+'.hdr', output+'.prj', output+'.flt']
+        gridio.write_ehdr_header(output+'.part.hdr', output+'.part.prj', nx, ny, x[0], y[-1], cellsize, cellsize, wkt, nodata)
+        # Rename the header files first so that a .flt file is never left without its header
+        for filename in files:
+            os.rename(filename[:-4]+'.part'+filename[-4:], filename)
+    else:
+        raster.flush()
+        files = [output+gridstore.EXTENSION]
+        partname = output+'.part'+gridstore.EXTENSION
+        gridstore.write_store(partname, {'x': x, 'y': y, 'z': raster[::-1], 'node_offset': 0})
+        del raster
+        os.remove(rastername)
+        os.rename(partname, files[0])
+
+    return {'nx': nx, 'ny': ny, 'valid_cells': valid_cells, 'files': files}
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assemble the ArcticNet basemap tiles of a region in a single grid")
+    parser.add_argument('output', type=str, help='path to the mosaic, without extension')
+    parser.add_argument('-c', '--catalog', help='take the tiles from this SQLite tile catalog')
+    parser.add_argument('-D', '--tiledir', help='take the tiles of the lattice of the region from this directory')
+    parser.add_argument('-R', '--region', help='region in west/east/south/north format. Default with a catalog: all the tiles')
+    parser.add_argument('-A', '--datatype', type=int, default=2, choices=[1, 2, 3, 4], help='MB-System datatype of the tiles. Default: 2')
+    parser.add_argument('-E', '--cellsize', type=float, help='spatial resolution of the tiles')
+    parser.add_argument('-F', '--format', default='ehdr', choices=FORMATS, help='ESRI EHdr raster (ehdr) or chunked grid store (zgd). Default: ehdr')
+    args = parser.parse_args()
+
+    if args.catalog is None and (args.tiledir is None or args.region is None or args.cellsize is None):
+        print "\nError: give either a tile catalog (-c) or a tile directory, region and cellsize (-D, -R and -E).\n"
+        exit(-1)
+    if args.catalog is not None and not path.isfile(args.catalog):
+        print "\nError: no such file %s found.\n" % (args.catalog)
+        exit(-1)
+
+    sources = mosaic_tiles(args.datatype, args.cellsize, args.region, args.catalog, args.tiledir)
+    if not sources:
+        print "\nError: no basemap tile grid found for the mosaic.\n"
+        exit(-1)
+
+    cellsizes = sorted(set([tile.metadata['cellsize'] for (tile, filename) in sources]))
+    if len(cellsizes) > 1:
+        print "\nError: the tiles have several cellsizes (%s). Select one with -E.\n" % (', '.join(["%g" % (c) for c in cellsizes]))
+        exit(-1)
+
+    start = time.time()
+    info = make_mosaic(args.output, [filename for (tile, filename) in sources], float(cellsizes[0]), \
+                       sources[0][0].metadata['esri_wkt_lcc'], args.format)
+    print "Mosaic of %d basemap tile(s): %d x %d nodes, %d with data, in %.1f s" \
+        % (len(sources), info['nx'], info['ny'], info['valid_cells'], time.time() - start)
+    for filename in info['files']:
+        print "    %s" % (filename)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_pipeline.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Pipelined processing of the basemap tiles: each stage has its own worker threads and bounded input queue, so
+that e.g. the gridding of the next tiles overlaps with the map making of the previous ones
+"""
+
+import threading
+import time
+import Queue
+
+
+# End of the items of a stage
+STOP = None
+
+
+
+class Pipeline(object):
+    """Chain of processing stages connected by bounded queues"""
+
+
+
+    def __init__(self, stages, depth=1):
+        """Create a new pipeline
+
+        Positional arguments:
+        stages -- list of (name, function, workers) tuples run in order on each item. function is called with
+                  the item and may modify it; workers is the maximum number of items processed concurrently by the stage.
+
+        Keyword argument:
+        depth -- number of items waiting in front of each stage worker. A stage blocks when the queue of the
+                 next stage is full (backpressure), which bounds the number of tiles in flight. Default: 1
+        """
+        self.stages = stages
+        self.depth = depth
+        self.busy = dict([(name, 0.0) for (name, function, workers) in stages])
+        self.wall = 0.0
+        self.__lock = threading.Lock()
+
+
+
+    def __worker(self, index, queues, results, running):
+        """Worker thread of a stage: process the items of its queue and pass them to the next stage"""
+
+        (name, function, workers) = self.stages[index]
+        while True:
+            entry = queues[index].get()
+            if entry is STOP:
+                break
+
+            # A failed item skips the following stages
+            if entry['error'] is None:
+                start = time.time()
+                try:
+                    function(entry['item'])
+                except (Exception, SystemExit) as e:
+                    entry['error'] = "%s: %s" % (name, e)
+                with self.__lock:
+                    self.busy[name] += time.time() - start
+
+            if index + 1 < len(self.stages):
+                queues[index+1].put(entry)
+            else:
+                results.put(entry)
+
+        # The last worker of a stage stops the next stage
+        with self.__lock:
+            running[index] = running[index] - 1
+            last = (running[index] == 0)
+        if last:
+            if index + 1 < len(self.stages):
+                for i in range(self.stages[index+1][2]):
+                    queues[index+1].put(STOP)
+            else:
+                results.put(STOP)
+
+
+
+    def run(self, items):
+        """Run the items through the pipeline
+
+        Positional argument:
+        items -- iterable of the items to process, consumed as the first stage gets ready for them
+
+        Returns:
+        results -- generator of (item, error) tuples in the order the items leave the pipeline. error is
+                   None when all the stages succeeded, otherwise the message of the failed stage.
+        """
+        queues = [Queue.Queue(self.depth * workers) for (name, function, workers) in self.stages]
+        results = Queue.Queue()
+        running = [workers for (name, function, workers) in self.stages]
+
+        threads = []
+        for index in range(len(self.stages)):
+            for i in range(self.stages[index][2]):
+                thread = threading.Thread(target=self.__worker, args=(index, queues, results, running))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        def feed():
+            for item in items:
+                queues[0].put({'item': item, 'error': None})
+            for i in range(self.stages[0][2]):
+                queues[0].put(STOP)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        start = time.time()
+        while True:
+            # A timeout keeps the main thread responsive to KeyboardInterrupt
+            try:
+                entry = results.get(True, 1)
+            except Queue.Empty:
+                continue
+            if entry is STOP:
+                break
+            yield (entry['item'], entry['error'])
+
+        self.wall = time.time() - start
+        feeder.join()
+        for thread in threads:
+            thread.join()
+
+
+
+    def summary(self):
+        """Summarize the occupancy of the stages
+
+        Returns:
+        text -- the busy time of each stage relative to the wall time and its workers
+        """
+        lines = ["Pipeline wall time: %.1f s" % (self.wall),
+                 "%-18s %8s %12s %12s" % ('stage', 'workers', 'busy (s)', 'occupancy')]
+        for (name, function, workers) in self.stages:
+            occupancy = 0.0
+            if self.wall > 0:
+                occupancy = self.busy[name] / (self.wall * workers)
+            lines.append("%-18s %8d %12.1f %11.0f%%" % (name, workers, self.busy[name], 100 * occupancy))
+
+        return '\n'.join(lines)+'\n'
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_plan.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Dry-run planner for the ArcticNet basemap tiles: estimate the tile count, data volume and runtime of a
+region from the MB-System datalist and .inf files only
+"""
+
+import glob
+import json
+import math as m
+from os import path
+import numpy as np
+import geospatial as geo
+from basetile import Basetile
+from tile_timing import TileTimer
+
+
+
+def read_datalist(datalist):
+    """List the swath files of a MB-System datalist, following the nested datalists
+
+    Keyword arguments:
+    datalist -- MB-System datalist
+
+    Returns:
+    files -- list of (path to swath file, MB-System format) tuples
+    """
+    files = []
+    directory = path.dirname(path.abspath(datalist))
+    processed = False
+
+    f = open(datalist, 'r')
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('$'):
+            # Datalist directives
+            if line.upper().startswith('$PROCESSED'):
+                processed = True
+            elif line.upper().startswith('$RAW'):
+                processed = False
+            continue
+
+        fields = line.split()
+        filename = fields[0]
+        if not path.isabs(filename):
+            filename = path.join(directory, filename)
+        mbformat = -1
+        if len(fields) > 1:
+            mbformat = int(fields[1])
+        elif not filename.endswith('.mb-1'):
+            mbformat = 0
+
+        if mbformat == -1:
+            files.extend(read_datalist(filename))
+        else:
+            if processed:
+                # Use the processed file (e.g. line.mb59 -> linep.mb59) when it exists
+                (root, ext) = path.splitext(filename)
+                if path.isfile(root+'p'+ext):
+                    filename = root+'p'+ext
+            files.append((filename, mbformat))
+    f.close()
+
+    return files
+
+
+
+def read_inf_bounds(filename):
+    """Read the geographic bounds of a swath file from its MB-System .inf file
+
+    Keyword arguments:
+    filename -- path to the swath file
+
+    Returns:
+    bounds -- (west, east, south, north) tuple. None when the .inf file does not exist or has no bounds.
+    """
+    if not path.isfile(filename+'.inf'):
+        return None
+
+    limits = dict()
+    f = open(filename+'.inf', 'r')
+    for line in f:
+        if line.startswith('Minimum Longitude:') or line.startswith('Minimum Latitude:'):
+            fields = line.split()
+            try:
+                limits[fields[1]] = (float(fields[2]), float(fields[5]))
+            except (IndexError, ValueError):
+                pass
+    f.close()
+
+    if 'Longitude:' not in limits or 'Latitude:' not in limits:
+        return None
+
+    return (limits['Longitude:'][0], limits['Longitude:'][1], limits['Latitude:'][0], limits['Latitude:'][1])
+
+
+
+def file_index(datalist):
+    """Build the bounding-box index of the swath files of a datalist
+
+    Keyword arguments:
+    datalist -- MB-System datalist
+
+    Returns:
+    index -- list of dicts with the 'file', its MB-System 'format', its 'bytes' and its 'bounds' (None when unknown)
+    """
+    index = []
+    for (filename, mbformat) in read_datalist(datalist):
+        entry = dict()
+        entry['file'] = filename
+        entry['format'] = mbformat
+        entry['bytes'] = 0
+        if path.isfile(filename):
+            entry['bytes'] = path.getsize(filename)
+        entry['bounds'] = read_inf_bounds(filename)
+        index.append(entry)
+
+    return index
+
+
+
+def overlap_fraction(bounds, region):
+    """Fraction of a bounding box lying within a region
+
+    Keyword arguments:
+    bounds -- (west, east, south, north) tuple
+    region -- (west, east, south, north) tuple
+
+    Returns:
+    fraction -- area fraction of bounds within region, between 0 and 1. Degenerate bounds count as 1 when they intersect.
+    """
+    dx = min(bounds[1], region[1]) - max(bounds[0], region[0])
+    dy = min(bounds[3], region[3]) - max(bounds[2], region[2])
+    if dx < 0 or dy < 0:
+        return 0.0
+
+    area = (bounds[1] - bounds[0]) * (bounds[3] - bounds[2])
+    if area <= 0:
+        return 1.0
+
+    return min(1.0, dx * dy / area)
+
+
+
+def product(datatype):
+    """Product made by a datatype: the topography datatypes 1 and 2 make the same product"""
+
+    if datatype == 1:
+        return 2
+    return datatype
+
+
+
+def load_history(pattern, datatype=2):
+    """Fit a runtime model per stage from the timing files of previous runs of a datatype
+
+    Each stage is modelled as a constant time per tile plus a time per grid cell, fitted by least
+    squares on the records of the previous runs.
+
+    Keyword arguments:
+    pattern -- glob pattern of the .jsonl timing files written by anbasemap -T
+    datatype -- MB-System datatype of the tiles whose records are used. Default: 2
+
+    Returns:
+    model -- dict of stage: (seconds per tile, seconds per cell). Empty when no timing was found.
+    """
+    records = []
+    for filename in glob.glob(pattern):
+        f = open(filename, 'r')
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get('cells') and record.get('datatype') is not None and product(int(record['datatype'])) == product(datatype):
+                    records.append(record)
+        f.close()
+
+    model = dict()
+    if not records:
+        return model
+
+    cells = np.array([record['cells'] for record in records], dtype=np.float64)
+    for stage in TileTimer.STAGES:
+        seconds = np.array([record[stage] for record in records], dtype=np.float64)
+        if len(np.unique(cells)) > 1:
+            (per_cell, per_tile) = np.polyfit(cells, seconds, 1)
+            model[stage] = (max(per_tile, 0.0), max(per_cell, 0.0))
+        else:
+            model[stage] = (seconds.mean(), 0.0)
+
+    return model
+
+
+
+def plan(datalist, region, cellsize, gridkind=1, mapkind=1, history=None, lon_step=0.5, lat_step=0.25, datatypes=[2]):
+    """Plan the basemap tiles of a region, one entry per tile and datatype
+
+    Keyword arguments:
+    datalist -- MB-System datalist
+    region -- region in west/east/south/north format
+    cellsize -- the spatial resolution of the tiles
+    gridkind -- grid kind of the run (the ESRI grid stage is only counted when 2, the chunked grid stage when 3). Default 1.
+    mapkind -- map kind of the run (the gif stage is only counted when 2, the quick-look replaces the Postscript map when 3). Default 1.
+    history -- glob pattern of the timing files of previous runs used to predict the runtime. Default: no prediction.
+    lon_step -- longitude extent of a tile in decimal degrees. Default 0.5.
+    lat_step -- latitude extent of a tile in decimal degrees. Default 0.25.
+    datatypes -- list of the MB-System datatypes of the products made. Default: [2]
+
+    Returns:
+    tiles -- list of dicts with the 'tilename', 'region', 'datatype', number of intersecting 'files', 'read_bytes'
+             (whole files read), 'data_bytes' (estimated bytes of data within the tile), 'nx', 'ny', 'grid_bytes'
+             and 'seconds' (predicted runtime from the previous runs of the datatype, None without history)
+    """
+    index = file_index(datalist)
+    # The runtime of each product is predicted from the previous runs of its datatype only
+    models = dict([(datatype, dict()) for datatype in datatypes])
+    if history:
+        for datatype in datatypes:
+            models[datatype] = load_history(history, datatype)
+
+    stages = ['grid', 'cookie_cut']
+    if gridkind == 2:
+        stages.append('make_esri_grid')
+    elif gridkind == 3:
+        stages.append('make_chunked_grid')
+    if mapkind == 3:
+        stages.append('make_quicklook')
+    else:
+        stages.append('ps_plot')
+    if mapkind == 2:
+        stages.append('make_gif_plot')
+
+    tiles = []
+    for (tilename, tile_region) in geo.basemap_lattice(region, lon_step, lat_step):
+        bounds = tuple([float(v) for v in tile_region.split('/')])
+        entry = {'tilename': tilename, 'region': tile_region, 'files': 0, 'read_bytes': 0, 'data_bytes': 0.0}
+        for swath in index:
+            if swath['bounds'] is None:
+                continue
+            fraction = overlap_fraction(swath['bounds'], bounds)
+            if fraction > 0:
+                entry['files'] = entry['files'] + 1
+                entry['read_bytes'] = entry['read_bytes'] + swath['bytes']
+                entry['data_bytes'] = entry['data_bytes'] + fraction * swath['bytes']
+
+        # Output grid size from the projected extent of the tile
+        geoinfo = Basetile(tilename, tile_region, cellsize).metadata['region']
+        xs = [geoinfo[corner][0] for corner in ['ul', 'ur', 'lr', 'll']]
+        ys = [geoinfo[corner][1] for corner in ['ul', 'ur', 'lr', 'll']]
+        entry['nx'] = int(m.ceil((max(xs) - min(xs)) / cellsize)) + 1
+        entry['ny'] = int(m.ceil((max(ys) - min(ys)) / cellsize)) + 1
+        entry['grid_bytes'] = 4 * entry['nx'] * entry['ny']
+
+        for datatype in datatypes:
+            product_entry = dict(entry)
+            product_entry['datatype'] = datatype
+            product_entry['seconds'] = None
+            model = models[datatype]
+            if model and entry['files'] > 0:
+                cells = entry['nx'] * entry['ny']
+                product_entry['seconds'] = sum([model[stage][0] + model[stage][1] * cells for stage in stages if stage in model])
+            tiles.append(product_entry)
+
+    # Files without .inf bounds cannot be placed in a tile
+    unknown = [swath['file'] for swath in index if swath['bounds'] is None]
+    if unknown:
+        print "Warning: %d swath file(s) have no .inf file and are not accounted for. Run mbdatalist -O to create them." % (len(unknown))
+
+    return tiles
+
+
+
+def report(tiles):
+    """Format the tile plan
+
+    Keyword arguments:
+    tiles -- list of tiles returned by plan()
+
+    Returns:
+    text -- the plan as a printable string
+    """
+    MB = 1024.0 * 1024.0
+
+    lines = ["%-18s %-26s %3s %6s %10s %10s %13s %9s %10s" \
+             % ('tilename', 'region', 'A', 'files', 'read (MB)', 'data (MB)', 'grid (nx*ny)', 'grid (MB)', 'time (s)')]
+    for tile in tiles:
+        if tile['files'] == 0:
+            continue
+        seconds = '-'
+        if tile['seconds'] is not None:
+            seconds = "%.0f" % (tile['seconds'])
+        lines.append("%-18s %-26s %3d %6d %10.1f %10.1f %13s %9.1f %10s" \
+                     % (tile['tilename'], tile['region'], tile['datatype'], tile['files'], tile['read_bytes'] / MB, tile['data_bytes'] / MB, \
+                        "%dx%d" % (tile['nx'], tile['ny']), tile['grid_bytes'] / MB, seconds))
+
+    nonempty = [tile for tile in tiles if tile['files'] > 0]
+    # The swath files of a tile are read once for all its datatypes
+    (lattice, read) = (dict(), dict())
+    for tile in tiles:
+        lattice[tile['tilename']] = tile
+    for tile in nonempty:
+        read[tile['tilename']] = tile
+    lines.append("")
+    lines.append("%d tile(s) in the lattice, %d with data, %d product(s) to make" % (len(lattice), len(read), len(nonempty)))
+    lines.append("Swath data read: %.1f MB (%.1f MB within the tiles)" \
+                 % (sum([tile['read_bytes'] for tile in read.values()]) / MB, sum([tile['data_bytes'] for tile in read.values()]) / MB))
+    lines.append("Output grids: %.1f MB" % (sum([tile['grid_bytes'] for tile in nonempty]) / MB))
+    predicted = [tile['seconds'] for tile in nonempty if tile['seconds'] is not None]
+    if predicted:
+        hours = sum(predicted) / 3600.0
+        unknown = len(nonempty) - len(predicted)
+        lines.append("Predicted runtime: %.1f hours%s" % (hours, " (%d product(s) without timing history of their datatype not counted)" % (unknown) if unknown else ''))
+    else:
+        lines.append("Predicted runtime: unknown (no timing history, see anbasemap -T)")
+
+    return '\n'.join(lines)+'\n'
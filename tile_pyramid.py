@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_pyramid.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Zoomable pyramid of 256x256 PNG web tiles (TMS or XYZ layout) built from the basemap tile grids
+
+The pyramid uses the Lambert conformal conic projection of the basemap tiles. Its finest level has the
+cellsize of the grids, and each coarser level is the 2x2 block average of the level below. The values of
+every pyramid tile are kept next to the images so that only the pyramid tiles covered by changed basemap
+tiles are rebuilt.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from multiprocessing import Pool, cpu_count
+from os import path
+from sys import exit
+import numpy as np
+import gridio
+import gridstore
+import quicklook
+from tile_job import atomic_write
+
+
+# Size of the pyramid tiles in pixels
+TILE_SIZE = 256
+
+# Southwest corner and side in meters of the square covered by the coarsest level. It holds the projected
+# WEST/EAST/SOUTH/NORTH limits of the basemap tiles (-172/-44/47.5/82, see basetile_process.sh), which
+# span x -2367259..6130254 and y -571179..3879278.
+PYRAMID_ORIGIN = (-2400000.0, -600000.0)
+PYRAMID_EXTENT = 8600000.0
+
+PROJ4_LCC = "+proj=lcc +lat_1=70 +lat_2=73 +lat_0=70 +lon_0=-105 +x_0=2000000 +y_0=2000000 +datum=WGS84 +units=m +no_defs"
+
+# Colors of the basemap tiles of each datatype (see Basetile.colors)
+COLORS = {1: {'palette': 'haxby', 'flip': False, 'equalize': False},
+          2: {'palette': 'haxby', 'flip': False, 'equalize': False},
+          3: {'palette': 'grayscale', 'flip': True, 'equalize': True},
+          4: {'palette': 'grayscale', 'flip': True, 'equalize': True}}
+
+# Maximum number of tiles of the overview level sampled to make the color palette table
+CPT_SAMPLE_TILES = 16
+
+MANIFEST = 'pyramid.json'
+
+
+
+def max_zoom(cellsize):
+    """Finest zoom level of a pyramid
+
+    Keyword arguments:
+    cellsize -- the spatial resolution of the basemap tile grids
+
+    Returns:
+    zoom -- number of levels above the finest one. Level 0 is a single tile covering PYRAMID_EXTENT from PYRAMID_ORIGIN.
+    """
+    return int(np.ceil(np.log2(PYRAMID_EXTENT / (TILE_SIZE * cellsize))))
+
+
+
+def tile_span(cellsize, zoom, maxzoom):
+    """Side in meters of the pyramid tiles of a zoom level"""
+
+    return TILE_SIZE * cellsize * 2 ** (maxzoom - zoom)
+
+
+
+def tile_extent(x, y, span):
+    """(xmin, xmax, ymin, ymax) in projected coordinates of a pyramid tile"""
+
+    (x0, y0) = PYRAMID_ORIGIN
+    return (x0 + x * span, x0 + (x + 1) * span, y0 + y * span, y0 + (y + 1) * span)
+
+
+
+def inside_pyramid(extent):
+    """True when an extent lies entirely inside the square covered by the pyramid"""
+
+    (x0, y0) = PYRAMID_ORIGIN
+    (xmin, xmax, ymin, ymax) = extent
+    return xmin >= x0 and ymin >= y0 and xmax <= x0 + PYRAMID_EXTENT and ymax <= y0 + PYRAMID_EXTENT
+
+
+
+def tiles_in_extent(extent, span, zoom):
+    """Pyramid tiles of a level intersecting an extent, clipped to the pyramid
+
+    Keyword arguments:
+    extent -- (xmin, xmax, ymin, ymax) tuple in projected coordinates
+    span -- side in meters of the pyramid tiles of the level
+    zoom -- the level, which has 2**zoom tiles along each side
+
+    Returns:
+    tiles -- list of the (x, y) TMS indices of the tiles
+    """
+    (x0, y0) = PYRAMID_ORIGIN
+    (xmin, xmax, ymin, ymax) = extent
+    last = 2 ** zoom - 1
+    columns = range(max(0, int(np.floor((xmin - x0) / span))), min(last, int(np.floor((xmax - x0) / span))) + 1)
+    rows = range(max(0, int(np.floor((ymin - y0) / span))), min(last, int(np.floor((ymax - y0) / span))) + 1)
+    return [(x, y) for x in columns for y in rows]
+
+
+
+def source_header(filename):
+    """Extent and size of a NetCDF grid or chunked grid store (see gridio.grid_header())"""
+
+    if filename.endswith(gridstore.EXTENSION):
+        return gridstore.store_header(filename)
+    return gridio.grid_header(filename)
+
+
+
+def read_source(filename, window=None):
+    """Read the nodes of a NetCDF grid or chunked grid store inside a window (see gridio.read_window()), or the whole grid"""
+
+    if filename.endswith(gridstore.EXTENSION):
+        return gridstore.read_store(filename, window)
+    if window is None:
+        return gridio.read_grid(filename)
+    return gridio.read_window(filename, *window)
+
+
+
+def data_name(outdir, zoom, x, y):
+    """Path to the values of a pyramid tile"""
+
+    return path.join(outdir, 'data', str(zoom), str(x), "%d.npy" % (y))
+
+
+
+def image_name(outdir, zoom, x, y, xyz=False):
+    """Path to the image of a pyramid tile. XYZ tiles count their rows from the top."""
+
+    if xyz:
+        y = 2 ** zoom - 1 - y
+    return path.join(outdir, str(zoom), str(x), "%d.png" % (y))
+
+
+
+def save(filename, write):
+    """Write a pyramid file atomically
+
+    Keyword arguments:
+    filename -- path to the file
+    write -- function writing the content to the temporary file name it is called with
+    """
+    if not path.isdir(path.dirname(filename)):
+        try:
+            os.makedirs(path.dirname(filename))
+        except OSError:
+            # Made by another worker in the meantime
+            if not path.isdir(path.dirname(filename)):
+                raise
+    tmpname = filename+'.%d.tmp' % (os.getpid())
+    write(tmpname)
+    os.rename(tmpname, filename)
+
+
+
+def discard(outdir, zoom, x, y, xyz):
+    """Remove the files of a pyramid tile without data"""
+
+    for filename in [data_name(outdir, zoom, x, y), image_name(outdir, zoom, x, y, xyz)]:
+        if path.isfile(filename):
+            os.remove(filename)
+
+
+
+def build_base_tile(args):
+    """Average the nodes of the basemap tile grids falling in each pixel of a pyramid tile of the finest level
+
+    Keyword arguments:
+    args -- (outdir, zoom, x, y, span, cellsize, grids, xyz) tuple. grids is the list of the grid files intersecting the tile.
+
+    Returns:
+    tile -- the (zoom, x, y) of the tile. None when the tile has no data.
+    """
+    (outdir, zoom, x, y, span, cellsize, grids, xyz) = args
+    total = np.zeros((TILE_SIZE, TILE_SIZE))
+    count = np.zeros((TILE_SIZE, TILE_SIZE))
+    for filename in grids:
+        grid = read_source(filename, tile_extent(x, y, span))
+        if grid is None:
+            continue
+        # Pixel of each node, counted from the west and from the north edges of the tile
+        columns = np.floor((grid['x'] - PYRAMID_ORIGIN[0]) / cellsize + 1e-6).astype(int) - x * TILE_SIZE
+        rows = (TILE_SIZE - 1) - (np.floor((grid['y'] - PYRAMID_ORIGIN[1]) / cellsize + 1e-6).astype(int) - y * TILE_SIZE)
+        (row, column) = np.meshgrid(rows, columns, indexing='ij')
+        valid = np.isfinite(grid['z']) & (row >= 0) & (row < TILE_SIZE) & (column >= 0) & (column < TILE_SIZE)
+        index = row[valid] * TILE_SIZE + column[valid]
+        total += np.bincount(index, grid['z'][valid], TILE_SIZE * TILE_SIZE).reshape(TILE_SIZE, TILE_SIZE)
+        count += np.bincount(index, None, TILE_SIZE * TILE_SIZE).reshape(TILE_SIZE, TILE_SIZE)
+
+    if not count.any():
+        discard(outdir, zoom, x, y, xyz)
+        return None
+
+    z = np.where(count > 0, total / np.maximum(count, 1), np.nan).astype(np.float32)
+    save(data_name(outdir, zoom, x, y), lambda tmpname: np.save(open(tmpname, 'wb'), z))
+    return (zoom, x, y)
+
+
+
+def build_overview_tile(args):
+    """Block average the four tiles of the level below a pyramid tile
+
+    Keyword arguments:
+    args -- (outdir, zoom, x, y, xyz) tuple
+
+    Returns:
+    tile -- the (zoom, x, y) of the tile. None when the tile has no data.
+    """
+    (outdir, zoom, x, y, xyz) = args
+    below = np.empty((2 * TILE_SIZE, 2 * TILE_SIZE), dtype=np.float32)
+    below[:] = np.nan
+    # The northern children (odd y) are at the top
+    for (dx, dy, row, column) in [(0, 1, 0, 0), (1, 1, 0, TILE_SIZE), (0, 0, TILE_SIZE, 0), (1, 0, TILE_SIZE, TILE_SIZE)]:
+        filename = data_name(outdir, zoom + 1, 2 * x + dx, 2 * y + dy)
+        if path.isfile(filename):
+            below[row:row+TILE_SIZE, column:column+TILE_SIZE] = np.load(filename)
+
+    blocks = below.reshape(TILE_SIZE, 2, TILE_SIZE, 2)
+    valid = np.isfinite(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    if not count.any():
+        discard(outdir, zoom, x, y, xyz)
+        return None
+
+    z = np.where(count > 0, total / np.maximum(count, 1), np.nan).astype(np.float32)
+
+    save(data_name(outdir, zoom, x, y), lambda tmpname: np.save(open(tmpname, 'wb'), z))
+    return (zoom, x, y)
+
+
+
+def render_tile(args):
+    """Render the image of a pyramid tile, transparent where there is no data
+
+    Keyword arguments:
+    args -- (outdir, zoom, x, y, cpt, xyz) tuple
+    """
+    (outdir, zoom, x, y, cpt, xyz) = args
+    z = np.load(data_name(outdir, zoom, x, y))
+    rgba = np.empty(z.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = quicklook.colorize(z, cpt)
+    rgba[..., 3] = np.where(np.isfinite(z), 255, 0)
+    save(image_name(outdir, zoom, x, y, xyz), lambda tmpname: quicklook.write_png(tmpname, rgba))
+
+
+
+def cpt_to_json(cpt):
+    """Color palette table as a JSON serializable dict"""
+
+    return {'z0': [float(v) for v in cpt['z0']], 'rgb0': [[float(c) for c in rgb] for rgb in cpt['rgb0']],
+            'z1': [float(v) for v in cpt['z1']], 'rgb1': [[float(c) for c in rgb] for rgb in cpt['rgb1']],
+            'N': [int(c) for c in cpt['N']]}
+
+
+
+def cpt_from_json(cpt):
+    """Color palette table from the dict written by cpt_to_json()"""
+
+    return {'z0': np.array(cpt['z0']), 'rgb0': np.array(cpt['rgb0']), 'z1': np.array(cpt['z1']),
+            'rgb1': np.array(cpt['rgb1']), 'N': tuple(cpt['N'])}
+
+
+
+class TilePyramid(object):
+    """Web tile pyramid of the basemap tile grids of one datatype and cellsize"""
+
+
+
+    def __init__(self, outdir, cellsize, datatype=2, xyz=False):
+        """Open a tile pyramid, creating its directory if necessary
+
+        Positional arguments:
+        outdir -- directory of the pyramid
+        cellsize -- the spatial resolution of the basemap tile grids
+
+        Keyword arguments:
+        datatype -- MB-System datatype of the grids, which sets the colors. Default: 2
+        xyz -- count the rows of the images from the top (XYZ, e.g. Leaflet and OpenLayers defaults) instead of from the bottom (TMS). Default: False
+        """
+        self.outdir = outdir
+        self.cellsize = float(cellsize)
+        self.datatype = datatype
+        self.xyz = xyz
+        self.maxzoom = max_zoom(self.cellsize)
+        self.manifest = {'cellsize': self.cellsize, 'layout': ['tms', 'xyz'][xyz], 'sources': {}, 'cpt': None,
+                         'origin': list(PYRAMID_ORIGIN), 'extent': PYRAMID_EXTENT}
+
+        if not path.isdir(outdir):
+            os.makedirs(outdir)
+        if path.isfile(path.join(outdir, MANIFEST)):
+            f = open(path.join(outdir, MANIFEST), 'r')
+            manifest = json.load(f)
+            f.close()
+            # A pyramid of another cellsize, layout or origin is rebuilt from scratch, its tiles having other indices
+            if all([manifest.get(key) == self.manifest[key] for key in ['cellsize', 'layout', 'origin', 'extent']]):
+                self.manifest = manifest
+            else:
+                for name in ['data'] + [d for d in os.listdir(outdir) if d.isdigit()]:
+                    if path.isdir(path.join(outdir, name)):
+                        shutil.rmtree(path.join(outdir, name))
+
+
+
+    def __tiles(self, extent, zoom):
+        """(zoom, x, y) of the pyramid tiles of a level intersecting an extent"""
+
+        return [(zoom, x, y) for (x, y) in tiles_in_extent(extent, tile_span(self.cellsize, zoom, self.maxzoom), zoom)]
+
+
+
+    def changed(self, grids):
+        """Find the pyramid tiles of the finest level affected by added, modified or removed grids
+
+        Positional arguments:
+        grids -- list of the paths to the basemap tile grids making the pyramid
+
+        Returns:
+        (sources, dirty, changed) -- dict of the signature of each grid, set of the (zoom, x, y) of the affected tiles
+                                     and number of changed grids
+        """
+        sources = dict()
+        dirty = set()
+        changed = 0
+        for filename in grids:
+            filename = path.abspath(filename)
+            status = os.stat(filename)
+            old = self.manifest['sources'].get(filename)
+            if old is not None and old['mtime'] == status.st_mtime and old['size'] == status.st_size:
+                sources[filename] = old
+                continue
+            (xmin, xmax, ymin, ymax, nx, ny) = source_header(filename)
+            if not inside_pyramid((xmin, xmax, ymin, ymax)):
+                print "Warning: %s extends outside the basemap limits, its nodes outside the tile pyramid are ignored" % (filename)
+            sources[filename] = {'mtime': status.st_mtime, 'size': status.st_size, 'extent': [xmin, xmax, ymin, ymax]}
+            changed = changed + 1
+            dirty.update(self.__tiles(sources[filename]['extent'], self.maxzoom))
+            if old is not None:
+                dirty.update(self.__tiles(old['extent'], self.maxzoom))
+
+        for (filename, old) in self.manifest['sources'].items():
+            if filename not in sources:
+                dirty.update(self.__tiles(old['extent'], self.maxzoom))
+                changed = changed + 1
+
+        return (sources, dirty, changed)
+
+
+
+    def __colors(self, cpt=None):
+        """Color palette table of the pyramid: from a file, or spanning the values of an overview level"""
+
+        if cpt is not None:
+            return quicklook.read_cpt(cpt)
+
+        # The finest level with few tiles is a block averaged sample of all the values
+        tiles = self.tiles()
+        sample = []
+        for zoom in range(self.maxzoom + 1):
+            level = [tile for tile in tiles if tile[0] == zoom]
+            if len(level) > CPT_SAMPLE_TILES:
+                break
+            sample = level
+
+        if sample:
+            values = np.concatenate([np.load(data_name(self.outdir, z, x, y)).ravel() for (z, x, y) in sample])
+        else:
+            values = np.array([np.nan])
+        colors = COLORS[self.datatype]
+        return quicklook.make_cpt(values, colors['palette'], colors['flip'], colors['equalize'])
+
+
+
+    def build(self, grids, processes=None, cpt=None):
+        """Build or update the pyramid
+
+        Positional arguments:
+        grids -- list of the paths to the basemap tile grids making the pyramid
+
+        Keyword arguments:
+        processes -- number of worker processes. Default: number of CPUs
+        cpt -- path to a GMT color palette table. Default: made from the values of the pyramid
+
+        Returns:
+        counts -- dict of the number of 'changed' grids, and of 'built' and 'rendered' pyramid tiles
+        """
+        (sources, dirty, changed) = self.changed(grids)
+        counts = {'changed': changed, 'built': 0, 'rendered': 0}
+
+        pool = Pool(processes or cpu_count())
+        try:
+            # Finest level, from the grids
+            span = tile_span(self.cellsize, self.maxzoom, self.maxzoom)
+            tasks = []
+            for (zoom, x, y) in sorted(dirty):
+                extent = tile_extent(x, y, span)
+                covering = [f for f in sorted(sources) if not (sources[f]['extent'][0] > extent[1] or sources[f]['extent'][1] < extent[0] \
+                                                               or sources[f]['extent'][2] > extent[3] or sources[f]['extent'][3] < extent[2])]
+                tasks.append((self.outdir, zoom, x, y, span, self.cellsize, covering, self.xyz))
+            built = [tile for tile in pool.map(build_base_tile, tasks) if tile is not None]
+            counts['built'] += len(tasks)
+
+            # Coarser levels, from the level below
+            level = dirty
+            for zoom in range(self.maxzoom - 1, -1, -1):
+                level = sorted(set([(zoom, x / 2, y / 2) for (z, x, y) in level]))
+                built.extend([tile for tile in pool.map(build_overview_tile, [(self.outdir, z, x, y, self.xyz) for (z, x, y) in level]) if tile is not None])
+                counts['built'] += len(level)
+
+            # A new color palette table changes all the images
+            palette = cpt_to_json(self.__colors(cpt))
+            if palette != self.manifest['cpt']:
+                built = self.tiles()
+            pool.map(render_tile, [(self.outdir, z, x, y, cpt_from_json(palette), self.xyz) for (z, x, y) in built])
+            counts['rendered'] = len(built)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.manifest['sources'] = sources
+        self.manifest['cpt'] = palette
+        self.manifest['updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        atomic_write(path.join(self.outdir, MANIFEST), json.dumps(self.manifest, indent=1, sort_keys=True))
+        self.write_tilemap()
+
+        return counts
+
+
+
+    def tiles(self):
+        """(zoom, x, y) of all the pyramid tiles with data"""
+
+        tiles = []
+        for zoom in range(self.maxzoom + 1):
+            directory = path.join(self.outdir, 'data', str(zoom))
+            if not path.isdir(directory):
+                continue
+            for x in os.listdir(directory):
+                tiles.extend([(zoom, int(x), int(y[:-len('.npy')])) for y in os.listdir(path.join(directory, x)) if y.endswith('.npy')])
+        return sorted(tiles)
+
+
+
+    def write_tilemap(self):
+        """Write the TMS tilemapresource.xml description of the pyramid"""
+
+        lines = ['<?xml version="1.0" encoding="utf-8"?>',
+                 '<TileMap version="1.0.0" tilemapservice="http://tms.osgeo.org/1.0.0">',
+                 '  <Title>ArcticNet basemap tiles</Title>',
+                 '  <SRS>%s</SRS>' % (PROJ4_LCC),
+                 '  <BoundingBox minx="%.1f" miny="%.1f" maxx="%.1f" maxy="%.1f"/>' % tuple(tile_extent(0, 0, tile_span(self.cellsize, 0, self.maxzoom))[i] for i in [0, 2, 1, 3]),
+                 '  <Origin x="%.1f" y="%.1f"/>' % (PYRAMID_ORIGIN),
+                 '  <TileFormat width="%d" height="%d" mime-type="image/png" extension="png"/>' % (TILE_SIZE, TILE_SIZE),
+                 '  <TileSets profile="none">']
+        for zoom in range(self.maxzoom + 1):
+            lines.append('    <TileSet href="%d" units-per-pixel="%.10g" order="%d"/>' \
+                         % (zoom, tile_span(self.cellsize, zoom, self.maxzoom) / TILE_SIZE, zoom))
+        lines.extend(['  </TileSets>', '</TileMap>'])
+        atomic_write(path.join(self.outdir, 'tilemapresource.xml'), '\n'.join(lines)+'\n')
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the web tile pyramid of ArcticNet basemap tile grids")
+    parser.add_argument('outdir', type=str, help='directory of the tile pyramid')
+    parser.add_argument('grids', type=str, nargs='*', help='basemap tile grids (.grd or .zgd) making the pyramid')
+    parser.add_argument('-c', '--catalog', help='take the grids of the given datatype and cellsize from this SQLite tile catalog')
+    parser.add_argument('-A', '--datatype', type=int, default=2, choices=[1, 2, 3, 4], help='MB-System datatype of the grids. Default: 2')
+    parser.add_argument('-E', '--cellsize', type=float, help='spatial resolution of the grids. Default: spacing of the first grid')
+    parser.add_argument('-C', '--cpt', help='GMT color palette table. Default: made from the values of the pyramid')
+    parser.add_argument('-j', '--processes', type=int, help='number of worker processes. Default: number of CPUs')
+    parser.add_argument('--xyz', action='store_true', help='count the rows of the images from the top (XYZ) instead of from the bottom (TMS)')
+    args = parser.parse_args()
+
+    grids = list(args.grids)
+    if args.catalog is not None:
+        import tile_catalog
+        if not path.isfile(args.catalog):
+            print "\nError: no such file %s found.\n" % (args.catalog)
+            exit(-1)
+        catalog = tile_catalog.TileCatalog(args.catalog)
+        # The chunked grids are read faster than the NetCDF grids
+        grids.extend([row['chunked_grid'] or row['grid'] for row in catalog.query(datatype=args.datatype, cellsize=args.cellsize) \
+                      if row['chunked_grid'] or row['grid']])
+        catalog.close()
+
+    missing = [f for f in grids if not path.isfile(f)]
+    if missing:
+        print "\nError: no such file %s found.\n" % (missing[0])
+        exit(-1)
+    if not grids:
+        print "\nError: no basemap tile grid given.\n"
+        exit(-1)
+
+    cellsize = args.cellsize
+    if cellsize is None:
+        (xmin, xmax, ymin, ymax, nx, ny) = source_header(grids[0])
+        cellsize = (xmax - xmin) / max(1, nx - 1)
+
+    pyramid = TilePyramid(args.outdir, cellsize, args.datatype, args.xyz)
+    start = time.time()
+    counts = pyramid.build(grids, args.processes, args.cpt)
+    print "Tile pyramid %s: %d changed grid(s), %d pyramid tile(s) rebuilt and %d rendered on %d level(s) in %.1f s" \
+        % (args.outdir, counts['changed'], counts['built'], counts['rendered'], pyramid.maxzoom + 1, time.time() - start)
+
+
+
+if __name__ == '__main__':
+    main()
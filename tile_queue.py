@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_queue.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+File-based work queue distributing basemap tiles to workers on several machines sharing a directory (e.g. NFS)
+
+A tile work item is a small JSON file moving between the pending, claimed, done and failed sub-directories
+of the queue directory. Items are claimed and released with atomic renames only, and a worker keeps its
+claim alive by touching the claimed file (heartbeat lease). Claims whose lease expired are put back in the
+pending directory.
+"""
+
+import errno
+import json
+import os
+import socket
+import threading
+import time
+from os import path
+from sys import exit
+from tile_job import atomic_write
+
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+
+
+def worker_id():
+    """Identifier of the current worker process
+
+    Returns:
+    worker -- host name and process id of the worker
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+
+class Lease(threading.Thread):
+    """Heartbeat thread keeping the claim of a work item alive"""
+
+
+
+    def __init__(self, filename, interval):
+        """Create a new heartbeat thread
+
+        Positional arguments:
+        filename -- path to the claimed work item to touch
+        interval -- time in seconds between two heartbeats
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.__stop = threading.Event()
+
+
+
+    def run(self):
+        """Touch the claimed work item until stopped"""
+
+        while not self.__stop.wait(self.interval):
+            try:
+                os.utime(self.filename, None)
+            except OSError:
+                # The claim expired and the item was put back in the queue
+                return
+
+
+
+    def stop(self):
+        """Stop the heartbeats"""
+
+        self.__stop.set()
+        self.join()
+
+
+
+class TileQueue(object):
+    """Queue of basemap tile work items in a shared directory"""
+
+
+
+    def __init__(self, directory, lease=300, max_attempts=3):
+        """Open a tile queue
+
+        Positional arguments:
+        directory -- path to the shared queue directory
+
+        Keyword arguments:
+        lease -- time in seconds after which a claim without heartbeat expires. Default: 300
+        max_attempts -- number of claims of a work item before it is marked as failed. Default: 3
+        """
+        self.directory = directory
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+
+
+    def __dir(self, state):
+        """Directory of the work items in a given state"""
+
+        return path.join(self.directory, state)
+
+
+
+    def __item(self, state, tilename):
+        """Path to a work item in a given state"""
+
+        return path.join(self.directory, state, tilename+'.json')
+
+
+
+    def __read(self, filename):
+        """Read a work item. Returns None when it does not exist (anymore)."""
+
+        try:
+            f = open(filename, 'r')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        item = json.load(f)
+        f.close()
+        return item
+
+
+
+    def now(self):
+        """Current time of the file server hosting the queue
+
+        The time is read from the modification time of a touched file so that the leases do not depend on
+        the clocks of the workers' hosts.
+
+        Returns:
+        now -- time in seconds since the epoch
+        """
+        clock = path.join(self.directory, 'clock')
+        f = open(clock, 'a')
+        f.close()
+        os.utime(clock, None)
+        return os.stat(clock).st_mtime
+
+
+
+    def create(self, settings, tiles):
+        """Create the queue and add the tiles not yet in it (coordinator)
+
+        A queue directory is only reused with the same settings: its done and claimed tiles were made with them.
+
+        Positional arguments:
+        settings -- dict of the run settings shared by all workers
+        tiles -- list of (tilename, region) tuples
+        """
+        if path.isfile(path.join(self.directory, 'settings.json')):
+            # Compared as read back by the workers
+            if self.settings() != json.loads(json.dumps(settings)):
+                print "\nError: the queue %s was created with different settings:" % (self.directory)
+                print "    %s\nCannot reuse it with:\n    %s\nUse another queue directory.\n" % (self.settings(), settings)
+                exit(-1)
+
+        for state in [PENDING, CLAIMED, DONE, FAILED]:
+            if not path.isdir(self.__dir(state)):
+                os.makedirs(self.__dir(state))
+
+        atomic_write(path.join(self.directory, 'settings.json'), json.dumps(settings, indent=1, sort_keys=True))
+
+        for (tilename, region) in tiles:
+            if any([path.isfile(self.__item(state, tilename)) for state in [PENDING, CLAIMED, DONE]]):
+                continue
+            if path.isfile(self.__item(FAILED, tilename)):
+                # Failed tiles are tried again by a new run
+                os.remove(self.__item(FAILED, tilename))
+            item = {'tilename': tilename, 'region': region, 'attempts': 0}
+            atomic_write(self.__item(PENDING, tilename), json.dumps(item, sort_keys=True))
+
+
+
+    def settings(self):
+        """Run settings written by the coordinator
+
+        Returns:
+        settings -- dict of the run settings
+        """
+        f = open(path.join(self.directory, 'settings.json'), 'r')
+        settings = json.load(f)
+        f.close()
+        return settings
+
+
+
+    def claim(self):
+        """Claim the next pending work item (worker)
+
+        Returns:
+        item -- dict of the claimed work item ('tilename', 'region', 'attempts', 'worker'). None when no item is pending.
+        """
+        for filename in sorted(os.listdir(self.__dir(PENDING))):
+            if not filename.endswith('.json'):
+                continue
+            tilename = filename[:-len('.json')]
+            try:
+                # The claimed item keeps the modification time of the pending one: touch it first so that the
+                # claim does not look expired to requeue_expired() before it is written
+                os.utime(self.__item(PENDING, tilename), None)
+                # Only one worker can rename the pending item
+                os.rename(self.__item(PENDING, tilename), self.__item(CLAIMED, tilename))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+
+            item = self.__read(self.__item(CLAIMED, tilename))
+            if item is None:
+                # Put back in the queue in the meantime
+                continue
+            item['attempts'] = item['attempts'] + 1
+            item['worker'] = worker_id()
+            atomic_write(self.__item(CLAIMED, tilename), json.dumps(item, sort_keys=True))
+            return item
+
+        return None
+
+
+
+    def owns(self, item):
+        """True when a work item is still claimed by the worker and attempt that claimed it
+
+        Positional arguments:
+        item -- the claimed work item
+        """
+        claimed = self.__read(self.__item(CLAIMED, item['tilename']))
+        return claimed is not None and claimed.get('worker') == item['worker'] and claimed['attempts'] == item['attempts']
+
+
+
+    def heartbeat(self, item):
+        """Start the heartbeat thread of a claimed work item
+
+        Positional arguments:
+        item -- the claimed work item
+
+        Returns:
+        lease -- the Lease thread. Call its stop() method once the work item is complete.
+        """
+        lease = Lease(self.__item(CLAIMED, item['tilename']), max(1.0, self.lease / 3.0))
+        lease.start()
+        return lease
+
+
+
+    def complete(self, item, status, result=None):
+        """Report a work item as done or failed
+
+        Positional arguments:
+        item -- the claimed work item
+        status -- True when the tile was made. False otherwise.
+
+        Keyword argument:
+        result -- dict of information to report back to the coordinator (products, elapsed time, error, ...)
+
+        Returns:
+        reported -- False when the lease of the claim expired and the item was put back in the queue, or claimed
+                    again: the item is then left to its new claim.
+        """
+        if not self.owns(item):
+            return False
+
+        item = dict(item)
+        item['finished'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        if result:
+            item['result'] = result
+
+        state = DONE
+        if not status:
+            # The tile is tried again by another claim until it fails too many times
+            if item['attempts'] < self.max_attempts:
+                state = PENDING
+            else:
+                state = FAILED
+
+        atomic_write(self.__item(state, item['tilename']), json.dumps(item, sort_keys=True))
+        if path.isfile(self.__item(CLAIMED, item['tilename'])):
+            os.remove(self.__item(CLAIMED, item['tilename']))
+        return True
+
+
+
+    def requeue_expired(self):
+        """Put back in the queue the claimed work items whose lease expired
+
+        Returns:
+        requeued -- list of the requeued tile names
+        """
+        requeued = []
+        now = self.now()
+        for filename in sorted(os.listdir(self.__dir(CLAIMED))):
+            if not filename.endswith('.json'):
+                continue
+            tilename = filename[:-len('.json')]
+            try:
+                if now - os.stat(self.__item(CLAIMED, tilename)).st_mtime < self.lease:
+                    continue
+                os.rename(self.__item(CLAIMED, tilename), self.__item(PENDING, tilename))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # Completed or requeued by someone else in the meantime
+                    continue
+                raise
+
+            item = self.__read(self.__item(PENDING, tilename))
+            if item is not None and item['attempts'] >= self.max_attempts:
+                item['result'] = {'error': 'lease of worker %s expired' % (item.get('worker'))}
+                atomic_write(self.__item(FAILED, tilename), json.dumps(item, sort_keys=True))
+                os.remove(self.__item(PENDING, tilename))
+            requeued.append(tilename)
+
+        return requeued
+
+
+
+    def items(self, state):
+        """List the work items in a given state
+
+        Positional arguments:
+        state -- one of 'pending', 'claimed', 'done' or 'failed'
+
+        Returns:
+        items -- list of the work items
+        """
+        items = []
+        for filename in sorted(os.listdir(self.__dir(state))):
+            if filename.endswith('.json'):
+                item = self.__read(path.join(self.__dir(state), filename))
+                if item is not None:
+                    items.append(item)
+        return items
+
+
+
+    def counts(self):
+        """Number of work items in each state
+
+        Returns:
+        counts -- dict of state: number of work items
+        """
+        counts = dict()
+        for state in [PENDING, CLAIMED, DONE, FAILED]:
+            counts[state] = len([f for f in os.listdir(self.__dir(state)) if f.endswith('.json')])
+        return counts
+
+
+
+    def __str__(self):
+        """print the number of work items in each state"""
+
+        counts = self.counts()
+        return "Queue %s: %d pending, %d claimed, %d done and %d failed tile(s)" \
+            % (self.directory, counts[PENDING], counts[CLAIMED], counts[DONE], counts[FAILED])
+
+
+
+def run_worker(queue, process, poll=10):
+    """Claim and process work items until the queue is empty
+
+    Positional arguments:
+    queue -- the TileQueue
+    process -- function called with a claimed work item. Returns a dict of results; raises an exception on failure.
+
+    Keyword argument:
+    poll -- time in seconds to wait for claimed items of other workers to complete or expire. Default: 10
+
+    Returns:
+    count -- number of work items processed by this worker
+    """
+    count = 0
+    while True:
+        item = queue.claim()
+        if item is None:
+            # Claims of dead workers are only given back once their lease expired
+            queue.requeue_expired()
+            counts = queue.counts()
+            if counts[PENDING] == 0 and counts[CLAIMED] == 0:
+                break
+            time.sleep(poll)
+            continue
+
+        lease = queue.heartbeat(item)
+        start = time.time()
+        try:
+            result = process(item)
+        except (Exception, SystemExit) as e:
+            lease.stop()
+            print "\nError: basemap tile %s failed: %s\n" % (item['tilename'], e)
+            reported = queue.complete(item, False, {'error': str(e), 'seconds': time.time() - start})
+        else:
+            lease.stop()
+            if result is None:
+                result = dict()
+            result['seconds'] = time.time() - start
+            reported = queue.complete(item, True, result)
+        if not reported:
+            print "The claim of basemap tile %s expired: it is left to its new claim" % (item['tilename'])
+        count = count + 1
+
+    return count
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_scatter.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Single pass gridding of the soundings of a region into all its basemap tiles
+
+Each swath file of the datalist is listed once and its soundings are routed, chunk by chunk, to the grid
+accumulator of every tile they fall in, halo of the gap filling included. The bounding boxes of the swath
+files (see tile_plan.file_index()) tell when no file is left for a tile: its grid is then written where mbgrid
+writes it and its accumulator released, so that only the tiles under the current files are held in memory.
+"""
+
+import time
+import numpy as np
+import soundings
+import tile_plan
+
+
+
+class TileScatter(object):
+    """Grid accumulators of the basemap tiles of a region, fed by a single stream of soundings"""
+
+
+
+    def __init__(self, tiles, datatype, outdir, method='mean', clip=2, mode=2):
+        """Create the accumulators of the tiles
+
+        Positional arguments:
+        tiles -- list of Basetile objects of a single datatype and cellsize
+        datatype -- MB-System datatype of the values (topography = 1 or 2; amplitude = 3; sidescan = 4)
+        outdir -- directory path in which to store the grids
+
+        Keyword arguments:
+        method -- 'mean' or 'median' of the soundings of a node, or 'mosaic' of backscatter samples (see Basetile.sounding_accumulator()). Default: 'mean'
+        clip -- gap filling distance in nodes, as in mbgrid -C<clip>/<mode>. Default: 2
+        mode -- gap filling mode, as in mbgrid -C<clip>/<mode>. Default: 2
+        """
+        self.tiles = tiles
+        self.datatype = datatype
+        self.outdir = outdir
+        self.method = method
+        self.clip = clip
+        self.mode = mode
+        self.flushed = []
+
+        # Tiles on the lattice of the region: column from the west, row from the south
+        region = [tile.metadata['region'] for tile in tiles]
+        self.lon_step = region[0]['xmax'] - region[0]['xmin']
+        self.lat_step = region[0]['ymax'] - region[0]['ymin']
+        self.west = min([r['xmin'] for r in region])
+        self.south = min([r['ymin'] for r in region])
+        columns = [int(round((r['xmin'] - self.west) / self.lon_step)) for r in region]
+        rows = [int(round((r['ymin'] - self.south) / self.lat_step)) for r in region]
+        self.__lattice = -np.ones((max(rows) + 1, max(columns) + 1), dtype=np.int64)
+        self.__lattice[rows, columns] = np.arange(len(tiles))
+
+        # Bounds of the soundings of each tile
+        self.bounds = np.array([tile.sounding_bounds(clip) for tile in tiles])
+        self.__accumulators = [None] * len(tiles)
+
+
+
+    def region(self):
+        """Geographic region of the soundings of all the tiles, in west/east/south/north format"""
+
+        return "%.8f/%.8f/%.8f/%.8f" % (self.bounds[:, 0].min(), self.bounds[:, 1].max(), self.bounds[:, 2].min(), self.bounds[:, 3].max())
+
+
+
+    def touched(self, bounds):
+        """Tiles whose soundings may be within a bounding box
+
+        Keyword argument:
+        bounds -- (west, east, south, north) tuple. None for an unknown bounding box: all the tiles
+
+        Returns:
+        tiles -- list of the indices of the tiles
+        """
+        if bounds is None:
+            return range(len(self.tiles))
+
+        return [int(i) for i in np.nonzero((self.bounds[:, 0] <= bounds[1]) & (self.bounds[:, 1] >= bounds[0]) & \
+                                           (self.bounds[:, 2] <= bounds[3]) & (self.bounds[:, 3] >= bounds[2]))[0]]
+
+
+
+    def route(self, lon, lat):
+        """Tiles of the soundings, a sounding in the halo of a neighbouring tile going to both
+
+        Keyword arguments:
+        lon -- array of the longitudes of the soundings
+        lat -- array of the latitudes of the soundings
+
+        Returns:
+        routes -- list of (tile index, array of the indices of its soundings) tuples
+        """
+        column = np.floor((lon - self.west) / self.lon_step).astype(np.int64)
+        row = np.floor((lat - self.south) / self.lat_step).astype(np.int64)
+        (rows, columns) = self.__lattice.shape
+
+        targets = []
+        soundings = []
+        for dr in [-1, 0, 1]:
+            for dc in [-1, 0, 1]:
+                (r, c) = (row + dr, column + dc)
+                inside = (r >= 0) & (r < rows) & (c >= 0) & (c < columns)
+                index = np.nonzero(inside)[0]
+                tile = self.__lattice[r[index], c[index]]
+                bounds = self.bounds[tile]
+                keep = (tile >= 0) & (lon[index] >= bounds[:, 0]) & (lon[index] <= bounds[:, 1]) & \
+                       (lat[index] >= bounds[:, 2]) & (lat[index] <= bounds[:, 3])
+                targets.append(tile[keep])
+                soundings.append(index[keep])
+
+        targets = np.concatenate(targets)
+        soundings = np.concatenate(soundings)
+        order = np.argsort(targets, kind='mergesort')
+        (targets, soundings) = (targets[order], soundings[order])
+        (tiles, starts) = np.unique(targets, return_index=True)
+        return zip([int(tile) for tile in tiles], np.split(soundings, starts[1:]))
+
+
+
+    def add(self, x, y, z, lon, lat, grazing=None):
+        """Add a chunk of soundings to the accumulators of the tiles they fall in
+
+        Keyword arguments:
+        x, y -- arrays of the projected coordinates of the soundings
+        z -- array of the values of the soundings
+        lon, lat -- arrays of the geographic coordinates of the soundings
+        grazing -- array of the grazing angles of the backscatter samples of a mosaic. Default: None
+        """
+        for (tile, index) in self.route(lon, lat):
+            if self.__accumulators[tile] is None:
+                self.__accumulators[tile] = self.tiles[tile].sounding_accumulator(self.method, self.clip)
+            if grazing is None:
+                self.__accumulators[tile].add(x[index], y[index], z[index])
+            else:
+                self.__accumulators[tile].add(x[index], y[index], z[index], grazing=grazing[index])
+
+
+
+    def flush(self, tile):
+        """Write the grid of a complete tile and release its accumulator
+
+        Keyword argument:
+        tile -- index of the tile
+
+        Returns:
+        soundings -- number of soundings of the tile. 0 when nothing was written.
+        """
+        accumulator = self.__accumulators[tile]
+        if accumulator is None:
+            return 0
+
+        self.tiles[tile].write_sounding_grid(self.outdir, accumulator, self.datatype, self.clip, self.mode)
+        self.__accumulators[tile] = None
+        self.flushed.append(tile)
+        return accumulator.soundings
+
+
+
+def scatter(datalist, tiles, datatype, outdir, method='mean', clip=2, mode=2):
+    """Grid the soundings of a datalist into all the tiles of a region in a single pass over the swath files
+
+    Keyword arguments:
+    datalist -- MB-System datalist
+    tiles -- list of Basetile objects of a single datatype and cellsize
+    datatype -- MB-System datatype of the values (topography = 1 or 2; amplitude = 3; sidescan = 4)
+    outdir -- directory path in which to store the grids
+    method -- 'mean' or 'median' of the soundings of a node, or 'mosaic' of backscatter samples (see Basetile.sounding_accumulator()). Default: 'mean'
+    clip -- gap filling distance in nodes, as in mbgrid -C<clip>/<mode>. Default: 2
+    mode -- gap filling mode, as in mbgrid -C<clip>/<mode>. Default: 2
+
+    Returns:
+    grids -- list of the tiles whose grid was written
+    """
+    if not tiles:
+        return []
+
+    start = time.time()
+    engine = TileScatter(tiles, datatype, outdir, method, clip, mode)
+    region = engine.region()
+    proj4 = tiles[0].metadata['proj4_proj_lcc']
+
+    # Number of swath files left for each tile
+    index = tile_plan.file_index(datalist)
+    files = [(swath, engine.touched(swath['bounds'])) for swath in index]
+    left = np.zeros(len(tiles), dtype=np.int64)
+    for (swath, touched) in files:
+        left[touched] += 1
+
+    total = 0
+    for (swath, touched) in files:
+        if not touched:
+            continue
+        for chunk in soundings.iter_soundings(swath['file'], region, datatype, proj4=proj4, mbformat=swath['format'], \
+                                              geographic=True, grazing=(method == 'mosaic')):
+            if method == 'mosaic':
+                (x, y, z, grazing, lon, lat) = chunk
+                engine.add(x, y, z, lon, lat, grazing)
+            else:
+                (x, y, z, lon, lat) = chunk
+                engine.add(x, y, z, lon, lat)
+        left[touched] -= 1
+        for tile in touched:
+            if left[tile] == 0:
+                total += engine.flush(tile)
+
+    print "Gridded %d soundings of %d swath file(s) into %d basemap tile(s) in %.1f s" \
+        % (total, len(index), len(engine.flushed), time.time() - start)
+
+    return [tiles[tile] for tile in engine.flushed]
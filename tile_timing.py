@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+########################################################################################################
+#
+# TITLE: tile_timing.py
+# AUTHOR: Jean-Guy Nistad
+#
+# Copyright (C) 2016  Jean-Guy Nistad
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+########################################################################################################
+
+"""
+Per-tile, per-stage timing report for the ArcticNet basemap tile runs
+"""
+
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+
+class StageRecord(object):
+    """Stage timings of a single basemap tile"""
+
+
+
+    def __init__(self, fields, stages):
+        """Create a new, empty, tile record
+
+        Positional arguments:
+        fields -- dict of the tile attributes
+        stages -- names of the stages to time
+        """
+        self.values = dict(fields)
+        for stage in stages:
+            self.values[stage] = 0.0
+        self.start = time.time()
+        self.__stack = []
+
+
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing a stage of the tile.
+
+        Stages may be nested (e.g. cookie_cut is called from within the gridding functions), in
+        which case the time of the inner stage is not counted in the outer stage.
+
+        Positional arguments:
+        name -- name of the stage (one of TileTimer.STAGES)
+        """
+        self.__stack.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            inner = self.__stack.pop()
+            if self.__stack:
+                self.__stack[-1] += elapsed
+            self.values[name] += elapsed - inner
+
+
+
+    def wrap(self, name, function):
+        """Wrap a function so that every call to it is timed as the given stage
+
+        Positional arguments:
+        name -- name of the stage (one of TileTimer.STAGES)
+        function -- function to wrap
+
+        Returns:
+        wrapped -- the timed function
+        """
+        def wrapped(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return wrapped
+
+
+
+class TileTimer(object):
+    """Record the time spent in each processing stage of each basemap tile"""
+
+    # Processing stages in the order they are run for a tile
+    STAGES = ['grid', 'cookie_cut', 'make_esri_grid', 'make_chunked_grid', 'ps_plot', 'make_gif_plot', 'make_quicklook']
+
+    # Tile attributes written along with the stage timings
+    FIELDS = ['tilename', 'datatype', 'cellsize', 'nx', 'ny', 'cells', 'valid_cells', 'grid_bytes']
+
+
+
+    def __init__(self, basename):
+        """Create a new tile timer writing to basename.jsonl and basename.csv
+
+        Positional arguments:
+        basename -- path and name, without extension, of the timing files
+        """
+        self.basename = basename
+        self.records = []
+        self.__lock = threading.Lock()
+
+        # The records are written as soon as a tile is done so that a killed run keeps its timings
+        self.__jsonl = open(basename+'.jsonl', 'w')
+        self.__csv_f = open(basename+'.csv', 'wb')
+        self.__csv = csv.DictWriter(self.__csv_f, fieldnames=self.FIELDS+self.STAGES+['total'], extrasaction='ignore')
+        self.__csv.writeheader()
+
+
+
+    def start_tile(self, tilename, datatype, cellsize):
+        """Start recording the stages of a new tile
+
+        Positional arguments:
+        tilename -- name of the basemap tile
+        datatype -- MB-System datatype of the tile
+        cellsize -- the spatial resolution of the tile
+
+        Returns:
+        record -- the StageRecord in which to time the stages of the tile
+        """
+        fields = dict.fromkeys(self.FIELDS)
+        fields['tilename'] = tilename
+        fields['datatype'] = datatype
+        fields['cellsize'] = cellsize
+        return StageRecord(fields, self.STAGES)
+
+
+
+    def end_tile(self, record, info=None):
+        """Finish a tile and write its record
+
+        Positional arguments:
+        record -- the StageRecord returned by start_tile()
+
+        Keyword argument:
+        info -- dict of tile attributes (see TileTimer.FIELDS) such as the grid size and number of data cells
+        """
+        values = record.values
+        if info:
+            for key in self.FIELDS:
+                if key in info:
+                    values[key] = info[key]
+        values['total'] = time.time() - record.start
+
+        # Tiles of different products may end concurrently
+        with self.__lock:
+            self.records.append(values)
+            self.__jsonl.write(json.dumps(values, sort_keys=True)+'\n')
+            self.__jsonl.flush()
+            self.__csv.writerow(values)
+            self.__csv_f.flush()
+
+
+
+    def summary(self, slowest=10):
+        """Summarize the recorded timings
+
+        Keyword argument:
+        slowest -- number of slowest tiles to list. Default: 10
+
+        Returns:
+        text -- the summary as a printable string
+        """
+        if not self.records:
+            return "No tile timings were recorded.\n"
+
+        lines = ["Timing summary for %d tile(s):" % (len(self.records)),
+                 "%-18s %10s %10s %10s %10s %10s" % ('stage', 'total (s)', 'p50 (s)', 'p90 (s)', 'p99 (s)', 'max (s)')]
+        for stage in self.STAGES+['total']:
+            values = np.array([record[stage] for record in self.records], dtype=np.float64)
+            (p50, p90, p99) = np.percentile(values, [50, 90, 99])
+            lines.append("%-18s %10.1f %10.2f %10.2f %10.2f %10.2f" % (stage, values.sum(), p50, p90, p99, values.max()))
+
+        lines.append("")
+        lines.append("Slowest tiles:")
+        ranked = sorted(self.records, key=lambda record: record['total'], reverse=True)
+        for record in ranked[:slowest]:
+            dominant = max(self.STAGES, key=lambda stage: record[stage])
+            lines.append("%-24s %-4s %10.1f s (%s: %.1f s, %s data cells)" \
+                         % (record['tilename'], "A%s" % (record['datatype']), record['total'], dominant, record[dominant], record['valid_cells']))
+
+        return '\n'.join(lines)+'\n'
+
+
+
+    def close(self):
+        """Close the timing files and write the summary to basename_summary.txt
+
+        Returns:
+        text -- the summary as a printable string
+        """
+        self.__jsonl.close()
+        self.__csv_f.close()
+
+        text = self.summary()
+        out = open(self.basename+'_summary.txt', 'w')
+        out.write(text)
+        out.close()
+
+        return text